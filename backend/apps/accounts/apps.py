@@ -5,3 +5,6 @@ class AccountsConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "apps.accounts"
     verbose_name = "Cuentas"
+
+    def ready(self):
+        from . import celery_metrics, signals  # noqa: F401
@@ -0,0 +1,63 @@
+"""
+Contadores de tareas Celery (started/succeeded/failed/retried) por nombre de tarea.
+
+Se conectan a las señales de Celery desde AccountsConfig.ready(), de modo que
+funcionan en cualquier worker que cargue Django. Los contadores van al registro
+de métricas en memoria y se exponen en /api/metrics/ y /api/metrics/prometheus/.
+"""
+from celery.signals import task_failure, task_postrun, task_prerun, task_retry
+
+from .metrics_registry import registry
+
+COUNTER_PREFIX = "celery_tasks"
+STATES = ("started", "succeeded", "failed", "retried")
+
+
+def counter_name(task_name, state):
+    return f"{COUNTER_PREFIX}:{task_name}:{state}"
+
+
+def parse_counter_name(name):
+    """Retorna (task_name, state) o None si el contador no es de Celery."""
+    prefix, _, rest = name.partition(":")
+    task_name, _, state = rest.rpartition(":")
+    if prefix != COUNTER_PREFIX or state not in STATES:
+        return None
+    return task_name, state
+
+
+def _task_name(sender):
+    return getattr(sender, "name", None) or str(sender)
+
+
+@task_prerun.connect(weak=False)
+def _on_task_prerun(sender=None, **kwargs):
+    registry.incr(counter_name(_task_name(sender), "started"))
+
+
+@task_postrun.connect(weak=False)
+def _on_task_postrun(sender=None, state=None, **kwargs):
+    if state == "SUCCESS":
+        registry.incr(counter_name(_task_name(sender), "succeeded"))
+
+
+@task_failure.connect(weak=False)
+def _on_task_failure(sender=None, **kwargs):
+    registry.incr(counter_name(_task_name(sender), "failed"))
+
+
+@task_retry.connect(weak=False)
+def _on_task_retry(sender=None, **kwargs):
+    registry.incr(counter_name(_task_name(sender), "retried"))
+
+
+def get_celery_task_counters():
+    """{task_name: {state: count}} de todos los workers."""
+    tasks = {}
+    for name, value in registry.get_counters().items():
+        parsed = parse_counter_name(name)
+        if parsed is None:
+            continue
+        task_name, state = parsed
+        tasks.setdefault(task_name, dict.fromkeys(STATES, 0))[state] = value
+    return tasks
@@ -0,0 +1,135 @@
+"""
+Cache compartido de decisiones ABAC entre workers.
+
+Las decisiones se guardan en el cache de Django con una clave formada por
+company, version de politicas, rol, departamento, ubicacion y accion, mas los
+valores de cualquier otra clave de contexto que usen las condiciones de la
+company (sitec_id, method, path...). Asi la decision es la misma para todos los
+usuarios con los mismos atributos:
+
+- Un cambio de politicas incrementa la version y deja obsoletas todas las claves.
+- Un cambio de perfil (rol, departamento, ubicacion, company) cambia la clave.
+
+Los contadores de hit/miss se acumulan en memoria y se vuelcan en lote al cache
+compartido; MetricsView los expone en /api/metrics/.
+"""
+import hashlib
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .policy_index import WRITE_ACTIONS
+
+DECISION_KEY = "abac:decision:{company_id}:{version}:{digest}"
+STATS_KEY = "metrics:abac_decision_cache:{name}"
+STATS_FLUSH_EVENTS = 100
+STATS_FLUSH_SECONDS = 10
+
+# Ya forman parte de la clave (company_id va en el prefijo)
+BASE_CONTEXT_KEYS = ("role", "department", "location")
+
+
+def decision_cache_enabled():
+    return getattr(settings, "ABAC_DECISION_CACHE_ENABLED", True)
+
+
+def decision_key(company_id, version, action, context, condition_keys):
+    parts = [str(context.get(key)) for key in BASE_CONTEXT_KEYS]
+    parts.append(action)
+    for key in sorted(condition_keys):
+        if key not in BASE_CONTEXT_KEYS and key != "company_id":
+            parts.append(f"{key}={context.get(key)}")
+    if action in WRITE_ACTIONS:
+        # Regla por defecto de transacciones depende del path
+        path = context.get("path", "").lower()
+        parts.append(f"tx={'transactions' in path or 'transacciones' in path}")
+    digest = hashlib.sha1("\x1f".join(parts).encode("utf-8")).hexdigest()
+    return DECISION_KEY.format(company_id=company_id, version=version, digest=digest)
+
+
+def get_cached_decisions(company_id, version, condition_keys, context, actions):
+    """Retorna {action: (allowed, policy_id, policy_action, policy_effect)} para los hits."""
+    keys = {
+        decision_key(company_id, version, action, context, condition_keys): action
+        for action in actions
+    }
+    try:
+        found = cache.get_many(list(keys))
+    except Exception:
+        found = {}
+    hits = {keys[key]: tuple(value) for key, value in found.items()}
+    return hits
+
+
+def store_decisions(company_id, version, condition_keys, context, decisions):
+    """Guarda {action: (allowed, policy_id, policy_action, policy_effect)}."""
+    if not decisions:
+        return
+    timeout = getattr(settings, "ABAC_DECISION_CACHE_TTL", 3600)
+    values = {
+        decision_key(company_id, version, action, context, condition_keys): value
+        for action, value in decisions.items()
+    }
+    try:
+        cache.set_many(values, timeout=timeout)
+    except Exception:
+        pass
+
+
+class _DecisionCacheStats:
+    """Contadores por proceso volcados periodicamente al cache compartido."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = {"hits": 0, "misses": 0}
+        self._last_flush = time.monotonic()
+
+    def record(self, hits, misses):
+        with self._lock:
+            self._pending["hits"] += hits
+            self._pending["misses"] += misses
+            pending = self._pending["hits"] + self._pending["misses"]
+            due = time.monotonic() - self._last_flush >= STATS_FLUSH_SECONDS
+            if pending < STATS_FLUSH_EVENTS and not due:
+                return
+            to_flush = dict(self._pending)
+            self._pending = {"hits": 0, "misses": 0}
+            self._last_flush = time.monotonic()
+        self._flush(to_flush)
+
+    def _flush(self, counts):
+        for name, value in counts.items():
+            if not value:
+                continue
+            key = STATS_KEY.format(name=name)
+            try:
+                cache.add(key, 0, timeout=None)
+                cache.incr(key, value)
+            except Exception:
+                pass
+
+    def snapshot(self):
+        with self._lock:
+            pending = dict(self._pending)
+        try:
+            shared = cache.get_many([STATS_KEY.format(name=name) for name in pending])
+        except Exception:
+            shared = {}
+        hits = pending["hits"] + shared.get(STATS_KEY.format(name="hits"), 0)
+        misses = pending["misses"] + shared.get(STATS_KEY.format(name="misses"), 0)
+        total = hits + misses
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": round(hits / total * 100, 2) if total else 0,
+        }
+
+
+decision_cache_stats = _DecisionCacheStats()
+
+
+def get_decision_cache_stats():
+    """Hits/misses agregados (cache compartido + pendientes de este proceso)."""
+    return decision_cache_stats.snapshot()
@@ -0,0 +1,89 @@
+"""
+Identidad del request: usuario, perfil, company, sitec activo y rol.
+
+Se resuelve una sola vez por request y se adjunta a `request.identity`, de modo
+que middlewares, ABAC, vistas y auditoria comparten el mismo perfil en lugar de
+consultar UserProfile cada uno por su cuenta.
+"""
+from functools import cached_property
+
+from apps.companies.models import Sitec
+
+from .models import UserProfile
+from .request_timing import timing_phase
+
+IDENTITY_ATTR = "identity"
+
+
+class RequestIdentity:
+    """Identidad resuelta para un usuario dentro de un request."""
+
+    def __init__(self, user, profile=None):
+        self.user = user
+        self.profile = profile
+
+    @property
+    def user_id(self):
+        return getattr(self.user, "pk", None)
+
+    @property
+    def company(self):
+        return self.profile.company if self.profile else None
+
+    @property
+    def company_id(self):
+        return self.profile.company_id if self.profile else None
+
+    @property
+    def role(self):
+        return self.profile.role if self.profile else None
+
+    @cached_property
+    def sitec(self):
+        # Sitec activo mas antiguo de la company; solo se consulta si alguien lo usa
+        if not self.company_id:
+            return None
+        return (
+            Sitec.objects.filter(company_id=self.company_id, status="active")
+            .order_by("created_at")
+            .first()
+        )
+
+
+def _base_request(request):
+    # DRF envuelve el HttpRequest; la identidad se guarda en el request de Django
+    return getattr(request, "_request", request)
+
+
+def resolve_identity(user):
+    """Construye la identidad de un usuario consultando su perfil (una query)."""
+    if not user or not getattr(user, "is_authenticated", False) or not getattr(user, "pk", None):
+        return RequestIdentity(user)
+    profile = UserProfile.objects.select_related("company").filter(user=user).first()
+    if profile is not None:
+        profile.user = user
+    return RequestIdentity(user, profile)
+
+
+def get_request_identity(request):
+    """
+    Retorna la identidad del request, resolviendola la primera vez.
+    Si el usuario del request cambia (p.ej. autenticacion DRF posterior a los
+    middlewares), la identidad se vuelve a resolver para el nuevo usuario.
+    """
+    user = getattr(request, "user", None)
+    base = _base_request(request)
+    identity = getattr(base, IDENTITY_ATTR, None)
+    if isinstance(identity, RequestIdentity) and identity.user_id == getattr(user, "pk", None):
+        return identity
+    with timing_phase(base, "tenant"):
+        identity = resolve_identity(user)
+    setattr(base, IDENTITY_ATTR, identity)
+    return identity
+
+
+def get_request_profile(request):
+    """Atajo para obtener el UserProfile del request (o None)."""
+    if request is None:
+        return None
+    return get_request_identity(request).profile
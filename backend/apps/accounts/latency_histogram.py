@@ -0,0 +1,207 @@
+"""
+Histogramas de latencia en escala logarítmica para métricas de observabilidad.
+
+Cada request incrementa un bucket del histograma de su endpoint y clase de
+estado (2xx, 3xx, 4xx, 5xx) en el slot horario actual, más la suma de
+duraciones en microsegundos para el promedio. Los incrementos se acumulan en
+memoria (metrics_registry) y se vuelcan al cache con cache.incr atómicos.
+Los límites de los buckets son fijos: crecen un factor sqrt(2) desde 0.5 ms,
+así que el error relativo de un percentil es como máximo ~41%, independiente
+del volumen de tráfico y sin guardar muestras.
+
+Las lecturas agregan los slots de las últimas `hours` horas y estiman
+p50/p90/p99 interpolando dentro del bucket en escala logarítmica. Además se
+mantiene un histograma acumulado sin expiración (slot "total") para la
+exposición Prometheus, donde los contadores deben ser monótonos.
+
+Los endpoints se identifican como "METODO:nombre de ruta" (ver
+ObservabilityMiddleware._get_endpoint_name) y se publican en un índice en el
+cache en cada volcado (metrics_registry.add_to_index), así que no hace falta
+una lista fija. Las lecturas piden las claves al cache en lotes de
+LOAD_BATCH_SIZE para acotar el tamaño de cada get_many.
+"""
+import bisect
+import math
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .metrics_registry import add_to_index, registry
+
+BASE_MS = 0.5
+GROWTH = math.sqrt(2)
+BUCKET_COUNT = 40  # Último límite finito ~370 s; más allá va al bucket de overflow
+BUCKET_BOUNDS = tuple(BASE_MS * GROWTH ** i for i in range(BUCKET_COUNT))
+
+SLOT_SECONDS = 3600
+STATUS_CLASSES = ("2xx", "3xx", "4xx", "5xx")
+PERCENTILES = (50, 90, 99)
+
+BUCKET_KEY = "metrics:latency:{slot}:{endpoint}:{status}:{bucket}"
+SUM_KEY = "metrics:latency:{slot}:{endpoint}:{status}:sum_us"
+ENDPOINTS_KEY = "metrics:latency:endpoints"
+TOTAL_SLOT = "total"
+LOAD_BATCH_SIZE = 2000
+
+# Endpoints vistos por este proceso (se republican en ENDPOINTS_KEY al volcar)
+_seen_endpoints = set()
+
+
+def retention_hours():
+    return max(1, int(getattr(settings, "OBSERVABILITY_RETENTION_HOURS", 24)))
+
+
+def bucket_index(duration_ms):
+    """Índice del primer bucket cuyo límite superior es >= duration_ms."""
+    return bisect.bisect_left(BUCKET_BOUNDS, duration_ms)
+
+
+def status_class(status_code):
+    return f"{min(max(int(status_code) // 100, 2), 5)}xx"
+
+
+def _slot(timestamp):
+    return int(timestamp // SLOT_SECONDS)
+
+
+def record_latency(endpoint, status_code, duration_ms, now=None):
+    """Registra un request: dos incrementos en memoria (bucket y suma)."""
+    now = time.time() if now is None else now
+    slot = _slot(now)
+    status = status_class(status_code)
+    bucket = bucket_index(duration_ms)
+    duration_us = int(round(duration_ms * 1000))
+    registry.add_many(
+        (
+            (BUCKET_KEY.format(slot=slot, endpoint=endpoint, status=status, bucket=bucket), 1),
+            (SUM_KEY.format(slot=slot, endpoint=endpoint, status=status), duration_us),
+        ),
+        timeout=(retention_hours() + 1) * SLOT_SECONDS,
+    )
+    registry.add_many(
+        (
+            (BUCKET_KEY.format(slot=TOTAL_SLOT, endpoint=endpoint, status=status, bucket=bucket), 1),
+            (SUM_KEY.format(slot=TOTAL_SLOT, endpoint=endpoint, status=status), duration_us),
+        ),
+        timeout=None,
+    )
+    _seen_endpoints.add(endpoint)
+
+
+def _publish_endpoints():
+    add_to_index(ENDPOINTS_KEY, set(_seen_endpoints))
+
+
+registry.on_flush(_publish_endpoints)
+
+
+def known_endpoints():
+    """Endpoints con métricas registradas por cualquier worker."""
+    registry.flush()
+    return sorted(set(cache.get(ENDPOINTS_KEY) or ()) | _seen_endpoints)
+
+
+class Histogram:
+    """Conteos por bucket más la suma de duraciones (ms)."""
+
+    def __init__(self):
+        self.counts = [0] * (BUCKET_COUNT + 1)
+        self.sum_ms = 0.0
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    def merge(self, other):
+        for index, value in enumerate(other.counts):
+            self.counts[index] += value
+        self.sum_ms += other.sum_ms
+        return self
+
+    def percentile(self, percentile):
+        total = self.count
+        if not total:
+            return 0
+        rank = percentile / 100 * total
+        seen = 0
+        for index, value in enumerate(self.counts):
+            if not value:
+                continue
+            if seen + value >= rank:
+                if index >= BUCKET_COUNT:
+                    return BUCKET_BOUNDS[-1]
+                upper = BUCKET_BOUNDS[index]
+                lower = BUCKET_BOUNDS[index - 1] if index else 0
+                fraction = (rank - seen) / value
+                if lower <= 0:
+                    return upper * fraction
+                # Interpolación geométrica dentro del bucket
+                return lower * (upper / lower) ** fraction
+            seen += value
+        return BUCKET_BOUNDS[-1]
+
+    def summary(self, window_seconds):
+        total = self.count
+        data = {
+            "requests": total,
+            "requests_per_second": round(total / window_seconds, 4) if window_seconds else 0,
+            "avg_response_time_ms": round(self.sum_ms / total, 2) if total else 0,
+        }
+        for percentile in PERCENTILES:
+            data[f"p{percentile}_response_time_ms"] = round(self.percentile(percentile), 2)
+        return data
+
+
+def load_histograms(endpoints, hours=1, now=None):
+    """
+    Retorna ({endpoint: {status_class: Histogram}}, window_seconds) para las
+    últimas `hours` horas (el slot actual cuenta hasta `now`).
+    """
+    registry.flush()
+    now = time.time() if now is None else now
+    hours = min(max(1, int(hours)), retention_hours())
+    current = _slot(now)
+    slots = range(current - hours + 1, current + 1)
+    window_seconds = (hours - 1) * SLOT_SECONDS + (now - current * SLOT_SECONDS)
+    return _load(endpoints, slots), window_seconds
+
+
+def load_total_histograms(endpoints):
+    """Histogramas acumulados desde el inicio: {endpoint: {status_class: Histogram}}."""
+    registry.flush()
+    return _load(endpoints, [TOTAL_SLOT])
+
+
+def _load(endpoints, slots):
+    histograms = {
+        endpoint: {status: Histogram() for status in STATUS_CLASSES} for endpoint in endpoints
+    }
+    keys = {}
+    for endpoint in endpoints:
+        for status in STATUS_CLASSES:
+            for slot in slots:
+                keys[SUM_KEY.format(slot=slot, endpoint=endpoint, status=status)] = (
+                    endpoint, status, None,
+                )
+                for bucket in range(BUCKET_COUNT + 1):
+                    keys[BUCKET_KEY.format(slot=slot, endpoint=endpoint, status=status, bucket=bucket)] = (
+                        endpoint, status, bucket,
+                    )
+                if len(keys) >= LOAD_BATCH_SIZE:
+                    _merge_values(histograms, keys)
+                    keys = {}
+    _merge_values(histograms, keys)
+    return histograms
+
+
+def _merge_values(histograms, keys):
+    if not keys:
+        return
+    for key, value in cache.get_many(list(keys)).items():
+        endpoint, status, bucket = keys[key]
+        histogram = histograms[endpoint][status]
+        if bucket is None:
+            histogram.sum_ms += value / 1000
+        else:
+            histogram.counts[bucket] += value
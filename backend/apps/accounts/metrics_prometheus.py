@@ -0,0 +1,113 @@
+"""
+Exposición de métricas en formato de texto Prometheus (versión 0.0.4).
+
+Todas las series usan el nombre de ruta resuelto como etiqueta `route`, así
+que la cardinalidad está acotada por el URLconf y no por los paths recibidos.
+Los endpoints y tareas se descubren de los índices publicados por los workers.
+"""
+from .celery_metrics import get_celery_task_counters
+from .latency_histogram import BUCKET_BOUNDS, BUCKET_COUNT, known_endpoints, load_total_histograms
+from .metrics_registry import registry
+from .middleware_observability import IN_FLIGHT_GAUGE
+from .middleware_query_budget import get_query_metrics
+from .middleware_server_timing import get_phase_metrics
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+PREFIX = "sitec"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(**labels):
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels.items()) + "}"
+
+
+def _split_endpoint(endpoint):
+    method, _, route = endpoint.partition(":")
+    return method, route
+
+
+def render_prometheus():
+    endpoints = known_endpoints()
+    histograms = load_total_histograms(endpoints)
+    gauges = registry.get_gauges()
+    lines = []
+
+    name = f"{PREFIX}_http_requests_total"
+    lines += [f"# HELP {name} Requests HTTP por ruta, método y clase de estado.", f"# TYPE {name} counter"]
+    for endpoint in endpoints:
+        method, route = _split_endpoint(endpoint)
+        for status, histogram in histograms[endpoint].items():
+            if histogram.count:
+                labels = _labels(route=route, method=method, status_class=status)
+                lines.append(f"{name}{labels} {histogram.count}")
+
+    name = f"{PREFIX}_http_request_errors_total"
+    lines += [f"# HELP {name} Respuestas 4xx y 5xx por ruta y método.", f"# TYPE {name} counter"]
+    for endpoint in endpoints:
+        method, route = _split_endpoint(endpoint)
+        errors = histograms[endpoint]["4xx"].count + histograms[endpoint]["5xx"].count
+        lines.append(f"{name}{_labels(route=route, method=method)} {errors}")
+
+    name = f"{PREFIX}_http_request_duration_seconds"
+    lines += [f"# HELP {name} Latencia de requests HTTP.", f"# TYPE {name} histogram"]
+    for endpoint in endpoints:
+        method, route = _split_endpoint(endpoint)
+        counts = [0] * (BUCKET_COUNT + 1)
+        total_ms = 0.0
+        for histogram in histograms[endpoint].values():
+            for index, value in enumerate(histogram.counts):
+                counts[index] += value
+            total_ms += histogram.sum_ms
+        cumulative = 0
+        for index, bound in enumerate(BUCKET_BOUNDS):
+            cumulative += counts[index]
+            labels = _labels(route=route, method=method, le=f"{bound / 1000:.6g}")
+            lines.append(f"{name}_bucket{labels} {cumulative}")
+        cumulative += counts[BUCKET_COUNT]
+        lines.append(f"{name}_bucket{_labels(route=route, method=method, le='+Inf')} {cumulative}")
+        lines.append(f"{name}_sum{_labels(route=route, method=method)} {total_ms / 1000:.6f}")
+        lines.append(f"{name}_count{_labels(route=route, method=method)} {cumulative}")
+
+    name = f"{PREFIX}_http_requests_in_flight"
+    lines += [f"# HELP {name} Requests HTTP en curso por ruta y método.", f"# TYPE {name} gauge"]
+    for endpoint in endpoints:
+        method, route = _split_endpoint(endpoint)
+        value = gauges.get(IN_FLIGHT_GAUGE.format(endpoint=endpoint), 0)
+        lines.append(f"{name}{_labels(route=route, method=method)} {value}")
+
+    counters = registry.get_counters()
+    db_metrics = get_query_metrics(counters)
+    for field, name, help_text, scale in (
+        ("queries", f"{PREFIX}_db_queries_total", "Queries SQL por ruta y método.", 1),
+        ("db_time_ms", f"{PREFIX}_db_query_duration_seconds_total", "Tiempo total en SQL por ruta y método.", 1000),
+        ("duplicate_queries", f"{PREFIX}_db_duplicate_queries_total", "Queries repetidas con la misma forma (N+1).", 1),
+        ("budget_exceeded", f"{PREFIX}_db_query_budget_exceeded_total", "Requests que excedieron el presupuesto de queries.", 1),
+    ):
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} counter"]
+        for endpoint, data in sorted(db_metrics.items()):
+            method, route = _split_endpoint(endpoint)
+            value = data[field] / scale if scale != 1 else data[field]
+            lines.append(f"{name}{_labels(route=route, method=method)} {value}")
+
+    phase_metrics = get_phase_metrics(counters)
+    for field, name, help_text, scale in (
+        ("total_ms", f"{PREFIX}_request_phase_seconds_total", "Tiempo por fase del request (Server-Timing).", 1000),
+        ("count", f"{PREFIX}_request_phase_count_total", "Requests que pasaron por cada fase.", 1),
+    ):
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} counter"]
+        for endpoint, phases in sorted(phase_metrics.items()):
+            method, route = _split_endpoint(endpoint)
+            for phase, data in sorted(phases.items()):
+                value = data[field] / scale if scale != 1 else data[field]
+                lines.append(f"{name}{_labels(route=route, method=method, phase=phase)} {value}")
+
+    name = f"{PREFIX}_celery_tasks_total"
+    lines += [f"# HELP {name} Tareas Celery por nombre y estado.", f"# TYPE {name} counter"]
+    for task_name, states in sorted(get_celery_task_counters().items()):
+        for state, value in states.items():
+            lines.append(f"{name}{_labels(task=task_name, state=state)} {value}")
+
+    return "\n".join(lines) + "\n"
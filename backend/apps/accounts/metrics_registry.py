@@ -0,0 +1,189 @@
+"""
+Registro de métricas en memoria por worker, volcado periódicamente al cache.
+
+El request solo incrementa contadores en memoria (bajo un lock). Un hilo
+daemon vuelca lo acumulado cada OBSERVABILITY_FLUSH_SECONDS al cache
+compartido con cache.incr, que es atómico, de modo que los contadores de
+todos los workers se suman sin perder incrementos. Las lecturas
+(/api/metrics/) vuelcan primero lo pendiente del proceso actual; lo de otros
+workers llega con un retraso máximo de un intervalo de volcado.
+
+Los gauges (p. ej. requests en curso) no se pueden sumar como deltas porque un
+worker que muere dejaría valores colgados: cada worker publica su valor
+actual en una clave propia con expiración y la lectura suma los workers vivos.
+"""
+import atexit
+import os
+import socket
+import threading
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.cache import cache
+
+COUNTER_KEY = "metrics:counter:{name}"
+COUNTERS_INDEX_KEY = "metrics:counters"
+GAUGE_KEY = "metrics:gauge:{worker}"
+WORKERS_INDEX_KEY = "metrics:workers"
+COUNTER_TIMEOUT = None
+
+
+def incr_shared(key, delta, timeout):
+    """cache.incr creando la clave si no existe."""
+    try:
+        return cache.incr(key, delta)
+    except ValueError:
+        if cache.add(key, delta, timeout=timeout):
+            return delta
+        return cache.incr(key, delta)
+
+
+def flush_interval():
+    return max(0.1, float(getattr(settings, "OBSERVABILITY_FLUSH_SECONDS", 5)))
+
+
+def add_to_index(key, names):
+    """
+    Agrega `names` a un índice compartido (lista en el cache). get + set no es
+    atómico: si dos workers publican a la vez uno sobrescribe al otro. Por eso
+    cada volcado vuelve a publicar todos los nombres del proceso (solo escribe
+    si falta alguno) y lo perdido reaparece en el siguiente volcado.
+    """
+    names = set(names)
+    if not names:
+        return
+    known = set(cache.get(key) or ())
+    if not names <= known:
+        cache.set(key, sorted(known | names), timeout=None)
+
+
+class MetricsRegistry:
+    """Contadores {clave de cache: (delta, timeout)} pendientes de volcar."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = defaultdict(int)
+        self._timeouts = {}
+        self._gauges = defaultdict(int)
+        self._counter_names = set()
+        self._flush_hooks = []
+        self._thread = None
+        self._pid = None
+        self._stop = threading.Event()
+
+    def add(self, key, value=1, timeout=COUNTER_TIMEOUT):
+        """Incremento en memoria de una clave del cache compartido."""
+        self._ensure_thread()
+        with self._lock:
+            self._pending[key] += value
+            self._timeouts[key] = timeout
+
+    def add_many(self, values, timeout=COUNTER_TIMEOUT):
+        self._ensure_thread()
+        with self._lock:
+            for key, value in values:
+                self._pending[key] += value
+                self._timeouts[key] = timeout
+
+    def incr(self, name, value=1):
+        """Contador con nombre, leído con get_counters()."""
+        self.add(COUNTER_KEY.format(name=name), value)
+        self._counter_names.add(name)
+
+    def gauge_add(self, name, delta):
+        """Modifica un gauge de este worker (se publica al volcar)."""
+        self._ensure_thread()
+        with self._lock:
+            self._gauges[name] += delta
+
+    @property
+    def worker_id(self):
+        return f"{socket.gethostname()}:{os.getpid()}"
+
+    def on_flush(self, hook):
+        """Registra una función a ejecutar en cada volcado (p. ej. publicar índices)."""
+        if hook not in self._flush_hooks:
+            self._flush_hooks.append(hook)
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, defaultdict(int)
+            timeouts, self._timeouts = self._timeouts, {}
+            gauges = {name: value for name, value in self._gauges.items() if value}
+        for key, value in pending.items():
+            if not value:
+                continue
+            try:
+                incr_shared(key, value, timeouts.get(key))
+            except Exception:
+                # Silenciar errores de métricas para no afectar la aplicación
+                pass
+        try:
+            self._publish(gauges)
+        except Exception:
+            pass
+        for hook in self._flush_hooks:
+            try:
+                hook()
+            except Exception:
+                pass
+
+    def _publish(self, gauges):
+        add_to_index(COUNTERS_INDEX_KEY, self._counter_names)
+        worker = self.worker_id
+        if gauges or cache.get(GAUGE_KEY.format(worker=worker)):
+            cache.set(GAUGE_KEY.format(worker=worker), gauges, timeout=max(30, 3 * flush_interval()))
+            add_to_index(WORKERS_INDEX_KEY, [worker])
+
+    def get_counters(self, names=None):
+        """Valores compartidos de los contadores (todos los registrados si names es None)."""
+        self.flush()
+        if names is None:
+            names = set(cache.get(COUNTERS_INDEX_KEY) or ()) | self._counter_names
+        keys = {COUNTER_KEY.format(name=name): name for name in names}
+        try:
+            found = cache.get_many(list(keys))
+        except Exception:
+            found = {}
+        return {name: found.get(key, 0) for key, name in keys.items()}
+
+    def get_gauges(self):
+        """Suma de los gauges publicados por los workers vivos."""
+        self.flush()
+        workers = cache.get(WORKERS_INDEX_KEY) or []
+        snapshots = cache.get_many([GAUGE_KEY.format(worker=worker) for worker in workers])
+        alive = [worker for worker in workers if GAUGE_KEY.format(worker=worker) in snapshots]
+        if len(alive) != len(workers):
+            # Podar workers cuyo snapshot expiró
+            cache.set(WORKERS_INDEX_KEY, alive, timeout=None)
+        totals = defaultdict(int)
+        for snapshot in snapshots.values():
+            for name, value in snapshot.items():
+                totals[name] += value
+        return dict(totals)
+
+    def _ensure_thread(self):
+        # Tras un fork (gunicorn --preload) el hilo del padre no existe en el hijo
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        with self._lock:
+            if self._pid == pid:
+                return
+            self._pending = defaultdict(int)
+            self._timeouts = {}
+            self._gauges = defaultdict(int)
+            self._pid = pid
+            self._stop = threading.Event()
+            self._thread = threading.Thread(
+                target=self._run, args=(self._stop,), name="metrics-flush", daemon=True
+            )
+            self._thread.start()
+
+    def _run(self, stop):
+        while not stop.wait(flush_interval()):
+            self.flush()
+
+
+registry = MetricsRegistry()
+atexit.register(registry.flush)
@@ -6,9 +6,8 @@ from collections import defaultdict
 from django.core.cache import cache
 from django.http import JsonResponse
 
-from apps.companies.models import Sitec
-
-from .models import UserProfile
+from .identity import get_request_identity
+from .request_timing import timing_phase
 
 
 class CompanySitecMiddleware:
@@ -22,15 +21,12 @@ class CompanySitecMiddleware:
         request.sitec = None
 
         user = getattr(request, "user", None)
-        if user and user.is_authenticated:
-            profile = UserProfile.objects.select_related("company").filter(user=user).first()
-            if profile and profile.company:
-                request.company = profile.company
-                request.sitec = (
-                    Sitec.objects.filter(company=profile.company, status="active")
-                    .order_by("created_at")
-                    .first()
-                )
+        with timing_phase(request, "tenant"):
+            if user and user.is_authenticated:
+                identity = get_request_identity(request)
+                if identity.company:
+                    request.company = identity.company
+                    request.sitec = identity.sitec
 
         if self._requires_company_sitec(request) and user and user.is_authenticated:
             if request.company is None or request.sitec is None:
@@ -1,13 +1,20 @@
 """
 Middleware para métricas de observabilidad
-- Request timing
+- Request timing (histogramas de latencia, ver latency_histogram.py)
 - Error rates
-- Request counts por endpoint
+- Request counts por endpoint (nombre de ruta resuelto)
+- Requests en curso por endpoint
 """
 import time
-from django.core.cache import cache
 from django.conf import settings
 
+from .latency_histogram import Histogram, known_endpoints, load_histograms, record_latency
+from .metrics_registry import registry
+from .request_timing import get_timings
+
+KNOWN_METHODS = frozenset(["GET", "HEAD", "POST", "PUT", "PATCH", "DELETE", "OPTIONS"])
+IN_FLIGHT_GAUGE = "in_flight:{endpoint}"
+
 
 class ObservabilityMiddleware:
     """
@@ -29,70 +36,57 @@ class ObservabilityMiddleware:
         start_time = time.time()
         
         # Obtener respuesta
-        response = self.get_response(request)
+        try:
+            response = self.get_response(request)
+        finally:
+            in_flight = getattr(request, "_metrics_in_flight", None)
+            if in_flight:
+                registry.gauge_add(in_flight, -1)
         
-        # Calcular tiempo de respuesta
-        duration_ms = (time.time() - start_time) * 1000
+        # Calcular tiempo de respuesta (desde el inicio de la cadena si hay ServerTimingMiddleware)
+        timings = get_timings(request)
+        if timings is not None:
+            duration_ms = timings.elapsed_ms()
+        else:
+            duration_ms = (time.time() - start_time) * 1000
         
-        # Registrar métricas
+        # Registrar métricas (el header X-Response-Time-ms lo escribe ServerTimingMiddleware)
         self._record_metrics(request, response, duration_ms)
         
-        # Agregar header de timing
-        response["X-Response-Time-ms"] = f"{duration_ms:.2f}"
-        
         return response
     
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        # La ruta ya está resuelta: contar el request como en curso
+        if self.metrics_enabled:
+            gauge = IN_FLIGHT_GAUGE.format(endpoint=self._get_endpoint_name(request))
+            registry.gauge_add(gauge, 1)
+            request._metrics_in_flight = gauge
+        return None
+    
     def _record_metrics(self, request, response, duration_ms):
-        """Registra métricas en cache (para análisis posterior)"""
+        """Registra la latencia en el histograma del endpoint (incr atómicos en cache)"""
         try:
             endpoint = self._get_endpoint_name(request)
-            
-            # Métricas de timing
-            timing_key = f"metrics:timing:{endpoint}"
-            timings = cache.get(timing_key, [])
-            timings.append(duration_ms)
-            # Mantener solo últimos 100 timings
-            if len(timings) > 100:
-                timings = timings[-100:]
-            cache.set(timing_key, timings, timeout=3600)  # 1 hora
-            
-            # Métricas de conteo
-            count_key = f"metrics:count:{endpoint}"
-            count = cache.get(count_key, 0)
-            cache.set(count_key, count + 1, timeout=3600)
-            
-            # Métricas de errores
-            if response.status_code >= 400:
-                error_key = f"metrics:errors:{endpoint}"
-                error_count = cache.get(error_key, 0)
-                cache.set(error_key, error_count + 1, timeout=3600)
-                
-                # Registrar errores por código de estado
-                status_key = f"metrics:status:{response.status_code}:{endpoint}"
-                status_count = cache.get(status_key, 0)
-                cache.set(status_key, status_count + 1, timeout=3600)
+            record_latency(endpoint, response.status_code, duration_ms)
         except Exception:
             # Silenciar errores de métricas para no afectar la aplicación
             pass
     
     def _get_endpoint_name(self, request):
-        """Obtiene un nombre identificable del endpoint"""
-        path = request.path
-        method = request.method
-        
-        # Normalizar path
-        if path.startswith("/api/"):
-            # Extraer nombre del endpoint
-            parts = path.split("/")
-            if len(parts) >= 3:
-                # Ejemplo: /api/dashboard/kpi/ -> dashboard.kpi
-                endpoint = ".".join(parts[2:-1] if parts[-1] == "" else parts[2:])
-            else:
-                endpoint = "unknown"
-        else:
-            endpoint = "static"
-        
-        return f"{method}:{endpoint}"
+        return get_endpoint_name(request)
+
+
+def get_endpoint_name(request):
+    """
+    Obtiene un nombre identificable del endpoint: "METODO:nombre de ruta".
+    Se usa la ruta resuelta (no el path) para acotar la cardinalidad.
+    """
+    method = request.method if request.method in KNOWN_METHODS else "OTHER"
+    match = getattr(request, "resolver_match", None)
+    if match is None:
+        # 404 u otra respuesta antes de resolver la URL
+        return f"{method}:unmatched"
+    return f"{method}:{match.view_name or match.route}"
 
 
 class RequestMetricsView:
@@ -111,9 +105,11 @@ class RequestMetricsView:
             hours: Horas de datos a obtener (default: 1)
         
         Returns:
-            dict con métricas
+            dict con métricas: por endpoint y clase de estado, requests,
+            requests/segundo, promedio y p50/p90/p99
         """
         metrics = {
+            "window_hours": hours,
             "endpoints": {},
             "summary": {
                 "total_requests": 0,
@@ -124,54 +120,43 @@ class RequestMetricsView:
         
         try:
             # Obtener todos los endpoints si no se especifica uno
-            if endpoint:
-                endpoints = [endpoint]
-            else:
-                # Obtener todos los endpoints conocidos (simplificado)
-                endpoints = [
-                    "GET:dashboard.kpi",
-                    "GET:dashboard.trends",
-                    "GET:roi",
-                    "POST:wizard.steps.save",
-                    "POST:wizard.submit",
-                    "POST:sync",
-                ]
+            endpoints = [endpoint] if endpoint else known_endpoints()
+            histograms, window_seconds = load_histograms(endpoints, hours=hours)
+            in_flight = registry.get_gauges()
             
-            total_requests = 0
+            overall = Histogram()
             total_errors = 0
-            total_timing = 0
-            timing_count = 0
-            
             for ep in endpoints:
-                count_key = f"metrics:count:{ep}"
-                error_key = f"metrics:errors:{ep}"
-                timing_key = f"metrics:timing:{ep}"
-                
-                count = cache.get(count_key, 0)
-                errors = cache.get(error_key, 0)
-                timings = cache.get(timing_key, [])
-                
-                avg_timing = sum(timings) / len(timings) if timings else 0
+                by_status = histograms[ep]
+                combined = Histogram()
+                for histogram in by_status.values():
+                    combined.merge(histogram)
+                if not combined.count and not endpoint:
+                    continue
                 
-                metrics["endpoints"][ep] = {
-                    "requests": count,
-                    "errors": errors,
-                    "error_rate": (errors / count * 100) if count > 0 else 0,
-                    "avg_response_time_ms": round(avg_timing, 2),
-                    "min_response_time_ms": round(min(timings), 2) if timings else 0,
-                    "max_response_time_ms": round(max(timings), 2) if timings else 0,
+                errors = by_status["4xx"].count + by_status["5xx"].count
+                data = combined.summary(window_seconds)
+                data["errors"] = errors
+                data["error_rate"] = (errors / data["requests"] * 100) if data["requests"] > 0 else 0
+                data["status_classes"] = {
+                    status: histogram.summary(window_seconds)
+                    for status, histogram in by_status.items()
+                    if histogram.count
                 }
+                data["in_flight"] = in_flight.get(IN_FLIGHT_GAUGE.format(endpoint=ep), 0)
+                metrics["endpoints"][ep] = data
                 
-                total_requests += count
+                overall.merge(combined)
                 total_errors += errors
-                total_timing += sum(timings)
-                timing_count += len(timings)
             
             # Calcular resumen
-            metrics["summary"]["total_requests"] = total_requests
+            summary = overall.summary(window_seconds)
+            metrics["summary"].update(summary)
+            metrics["summary"]["total_requests"] = summary["requests"]
             metrics["summary"]["total_errors"] = total_errors
-            metrics["summary"]["error_rate"] = (total_errors / total_requests * 100) if total_requests > 0 else 0
-            metrics["summary"]["avg_response_time_ms"] = round(total_timing / timing_count, 2) if timing_count > 0 else 0
+            metrics["summary"]["error_rate"] = (
+                (total_errors / summary["requests"] * 100) if summary["requests"] > 0 else 0
+            )
             
         except Exception as e:
             metrics["error"] = str(e)
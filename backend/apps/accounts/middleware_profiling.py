@@ -0,0 +1,88 @@
+"""
+Middleware para perfilar requests con cProfile
+- Bajo demanda: header "X-Profile: 1" o parámetro "?_profile=1", solo para
+  superusuarios o con el header "X-Profile-Token: <PROFILING_TOKEN>"
+- Automático: una fracción PROFILING_SAMPLE_RATE de los requests se perfila y
+  el perfil se conserva solo si el request supera OBS_SLOW_REQUEST_MS
+
+Los perfiles se guardan en storage/profiles (ver profiling.py) y se consultan
+en /api/metrics/profiles/.
+"""
+import cProfile
+import hmac
+import logging
+import random
+import time
+
+from django.conf import settings
+
+from .middleware_observability import get_endpoint_name
+from .profiling import save_profile
+
+logger = logging.getLogger(__name__)
+
+TRIGGER_ON_DEMAND = "on-demand"
+TRIGGER_SLOW_SAMPLE = "slow-sample"
+
+
+class ProfilingMiddleware:
+    """
+    Middleware que captura un perfil cProfile del resto de la cadena de
+    middlewares y la vista. Debe ir después de AuthenticationMiddleware.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        trigger = self._get_trigger(request)
+        if trigger is None:
+            return self.get_response(request)
+
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Ya hay otro profiler activo en este hilo
+            return self.get_response(request)
+        start = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            profiler.disable()
+        duration_ms = (time.perf_counter() - start) * 1000
+
+        if trigger == TRIGGER_SLOW_SAMPLE and duration_ms < self._slow_threshold():
+            return response
+
+        try:
+            profile_id = save_profile(profiler, get_endpoint_name(request), duration_ms, trigger)
+        except Exception:
+            logger.warning("No se pudo guardar el perfil del request", exc_info=True)
+            return response
+        if trigger == TRIGGER_ON_DEMAND:
+            response["X-Profile-Id"] = profile_id
+        return response
+
+    def _get_trigger(self, request):
+        if not getattr(settings, "PROFILING_ENABLED", True):
+            return None
+        requested = (
+            request.META.get("HTTP_X_PROFILE") == "1" or request.GET.get("_profile") == "1"
+        )
+        if requested and self._is_privileged(request):
+            return TRIGGER_ON_DEMAND
+        sample_rate = float(getattr(settings, "PROFILING_SAMPLE_RATE", 0))
+        if sample_rate > 0 and random.random() < sample_rate:
+            return TRIGGER_SLOW_SAMPLE
+        return None
+
+    def _is_privileged(self, request):
+        token = getattr(settings, "PROFILING_TOKEN", "")
+        if token and hmac.compare_digest(request.META.get("HTTP_X_PROFILE_TOKEN", ""), token):
+            return True
+        user = getattr(request, "user", None)
+        return bool(user and user.is_authenticated and user.is_superuser)
+
+    def _slow_threshold(self):
+        return int(getattr(settings, "OBS_SLOW_REQUEST_MS", 800))
@@ -0,0 +1,217 @@
+"""
+Middleware para instrumentación de queries SQL por request
+- Número de queries y tiempo total de SQL (execute_wrapper en todas las conexiones)
+- Queries repetidas con la misma forma (patrones N+1)
+- Headers X-DB-Queries / X-DB-Time-ms (solo DEBUG, staff o INTERNAL_IPS) y fase
+  "db" de Server-Timing
+- Presupuesto de queries por ruta con warning estructurado si se excede
+
+En respuestas streaming (StreamingHttpResponse, p. ej. la exportación de
+auditoría) la medición sigue mientras se consume el cuerpo y se registra al
+cerrarse el stream. Los headers ya se enviaron para entonces, así que esas
+respuestas no llevan X-DB-* ni fase "db" en Server-Timing; sus queries sí
+cuentan en el registro y en el presupuesto. Las respuestas streaming async
+(ASGI) solo miden hasta que la vista retorna.
+"""
+import json
+import logging
+import re
+import time
+from collections import Counter
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.db import connections
+
+from .metrics_registry import registry
+from .middleware_observability import get_endpoint_name
+from .request_timing import can_see_diagnostics, get_timings
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_QUERY_BUDGET = 10
+TOP_REPEATED = 5
+FINGERPRINT_MAX_LENGTH = 300
+
+_STRING_RE = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_RE = re.compile(r"\b\d+(?:\.\d+)?\b")
+_IN_LIST_RE = re.compile(r"\(\s*(?:%s|\?)(?:\s*,\s*(?:%s|\?))*\s*\)")
+_SPACES_RE = re.compile(r"\s+")
+
+
+def fingerprint(sql):
+    """Forma de una query: sin literales y con listas IN (...) colapsadas."""
+    sql = _STRING_RE.sub("?", sql)
+    sql = _NUMBER_RE.sub("?", sql)
+    sql = _IN_LIST_RE.sub("(...)", sql)
+    return _SPACES_RE.sub(" ", sql).strip()[:FINGERPRINT_MAX_LENGTH]
+
+
+class QueryRecorder:
+    """execute_wrapper que acumula conteo, tiempo y SQL ejecutado."""
+
+    def __init__(self):
+        self.count = 0
+        self.duration_ms = 0.0
+        # SQL con placeholders; se normaliza solo al reportar
+        self.statements = Counter()
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.duration_ms += (time.perf_counter() - start) * 1000
+            self.count += 1
+            self.statements[sql] += 1
+
+    def repeated(self):
+        """[(fingerprint, veces)] de las formas ejecutadas más de una vez."""
+        shapes = Counter()
+        for sql, count in self.statements.items():
+            shapes[fingerprint(sql)] += count
+        return [(shape, count) for shape, count in shapes.most_common() if count > 1]
+
+
+def get_query_budget(endpoint):
+    """Presupuesto para "METODO:ruta"; DB_QUERY_BUDGETS acepta "METODO:ruta" o "ruta"."""
+    budgets = getattr(settings, "DB_QUERY_BUDGETS", {})
+    _, _, route = endpoint.partition(":")
+    for key in (endpoint, route):
+        if key in budgets:
+            return budgets[key]
+    return getattr(settings, "DB_QUERY_BUDGET", DEFAULT_QUERY_BUDGET)
+
+
+class _MeasuredStream:
+    """
+    Iterador del cuerpo streaming que llama a `on_close` una sola vez al
+    cerrarse la respuesta (el handler siempre llama a close(), aunque el
+    cliente corte o el stream no se haya empezado a consumir).
+    """
+
+    def __init__(self, content, on_close):
+        self._content = iter(content)
+        self._on_close = on_close
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._content)
+
+    def close(self):
+        on_close, self._on_close = self._on_close, None
+        if on_close is not None:
+            on_close()
+
+
+class QueryBudgetMiddleware:
+    """
+    Middleware que mide las queries SQL de cada request y las registra por ruta
+    en el registro de métricas (db_queries, db_time_us, db_duplicate_queries,
+    db_budget_exceeded).
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.enabled = getattr(settings, "DB_QUERY_INSTRUMENTATION_ENABLED", True)
+
+    def __call__(self, request):
+        if not self.enabled:
+            return self.get_response(request)
+
+        recorder = QueryRecorder()
+        stack = ExitStack()
+        with stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(recorder))
+            response = self.get_response(request)
+            request.db_queries = recorder
+            if response.streaming and not getattr(response, "is_async", False):
+                # El cuerpo se genera después de retornar: medir hasta cerrar el stream
+                wrappers = stack.pop_all()
+
+                def finish():
+                    wrappers.close()
+                    self._safe_record(request, response, recorder, headers=False)
+
+                response.streaming_content = _MeasuredStream(response.streaming_content, finish)
+                return response
+
+        self._safe_record(request, response, recorder, headers=True)
+        return response
+
+    def _safe_record(self, request, response, recorder, headers):
+        try:
+            self._record(request, response, recorder, headers)
+        except Exception:
+            # Silenciar errores de métricas para no afectar la aplicación
+            logger.debug("No se pudieron registrar métricas de queries", exc_info=True)
+
+    def _record(self, request, response, recorder, headers=True):
+        endpoint = get_endpoint_name(request)
+        repeated = recorder.repeated() if recorder.count > 1 else []
+        duplicates = sum(count - 1 for _, count in repeated)
+
+        if headers:
+            if can_see_diagnostics(request):
+                response["X-DB-Queries"] = str(recorder.count)
+                response["X-DB-Time-ms"] = f"{recorder.duration_ms:.2f}"
+            timings = get_timings(request)
+            if timings is not None:
+                timings.add("db", recorder.duration_ms, f"{recorder.count} queries")
+
+        registry.incr(f"db_queries:{endpoint}", recorder.count)
+        registry.incr(f"db_time_us:{endpoint}", int(recorder.duration_ms * 1000))
+        if duplicates:
+            registry.incr(f"db_duplicate_queries:{endpoint}", duplicates)
+
+        budget = get_query_budget(endpoint)
+        if budget is not None and recorder.count > budget:
+            registry.incr(f"db_budget_exceeded:{endpoint}")
+            payload = {
+                "endpoint": endpoint,
+                "path": request.path,
+                "status_code": response.status_code,
+                "queries": recorder.count,
+                "budget": budget,
+                "db_time_ms": round(recorder.duration_ms, 2),
+                "duplicate_queries": duplicates,
+                "top_repeated": [
+                    {"fingerprint": shape, "count": count}
+                    for shape, count in repeated[:TOP_REPEATED]
+                ],
+                "request_id": getattr(request, "request_id", None),
+            }
+            logger.warning(
+                "DB query budget exceeded: %s",
+                json.dumps(payload, ensure_ascii=False),
+                extra={"db_query_budget": payload},
+            )
+
+
+QUERY_COUNTERS = ("db_queries", "db_time_us", "db_duplicate_queries", "db_budget_exceeded")
+
+
+def get_query_metrics(counters=None):
+    """{endpoint: {queries, db_time_ms, duplicate_queries, budget_exceeded}} acumulados."""
+    counters = registry.get_counters() if counters is None else counters
+    metrics = {}
+    for name, value in counters.items():
+        prefix, _, endpoint = name.partition(":")
+        if prefix not in QUERY_COUNTERS or not endpoint:
+            continue
+        data = metrics.setdefault(
+            endpoint,
+            {"queries": 0, "db_time_ms": 0, "duplicate_queries": 0, "budget_exceeded": 0},
+        )
+        if prefix == "db_queries":
+            data["queries"] = value
+        elif prefix == "db_time_us":
+            data["db_time_ms"] = round(value / 1000, 2)
+        elif prefix == "db_duplicate_queries":
+            data["duplicate_queries"] = value
+        else:
+            data["budget_exceeded"] = value
+    return metrics
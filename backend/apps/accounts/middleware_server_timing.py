@@ -0,0 +1,109 @@
+"""
+Middleware para el header Server-Timing y los headers de tiempo de respuesta.
+
+Es el único lugar que escribe X-Response-Time-ms. Debe ser el primer
+middleware de la lista (después de SecurityMiddleware/WhiteNoise) para que el
+total cubra toda la cadena. Las fases se describen en request_timing.py y se
+registran por ruta en el registro de métricas (phase_time_us, phase_count).
+Server-Timing solo se envía con SERVER_TIMING_ENABLED y a quien pasa
+can_see_diagnostics (DEBUG, staff o INTERNAL_IPS).
+"""
+import logging
+import time
+
+from django.conf import settings
+
+from .metrics_registry import registry
+from .middleware_observability import get_endpoint_name
+from .request_timing import PHASES, RequestTimings, can_see_diagnostics
+
+logger = logging.getLogger(__name__)
+
+PHASE_COUNTERS = ("phase_time_us", "phase_count")
+
+
+class ServerTimingMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.enabled = getattr(settings, "SERVER_TIMING_ENABLED", False)
+
+    def __call__(self, request):
+        timings = RequestTimings()
+        request.timings = timings
+        response = self.get_response(request)
+        total_ms = timings.elapsed_ms()
+
+        response["X-Response-Time-ms"] = f"{total_ms:.2f}"
+        if self.enabled and can_see_diagnostics(request):
+            response["Server-Timing"] = timings.header_value(total_ms)
+        try:
+            self._record(request, timings)
+        except Exception:
+            # Silenciar errores de métricas para no afectar la aplicación
+            logger.debug("No se pudieron registrar las fases del request", exc_info=True)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        timings = request.timings
+        request._view_started = (time.perf_counter(), timings.durations.get("abac", 0.0))
+        return None
+
+    def process_template_response(self, request, response):
+        # La vista ya retornó; lo que sigue es el renderizado
+        self._close_view(request)
+        render_started = time.perf_counter()
+        timings = request.timings
+
+        def _render_finished(rendered):
+            timings.add("render", (time.perf_counter() - render_started) * 1000)
+
+        response.add_post_render_callback(_render_finished)
+        return response
+
+    def process_exception(self, request, exception):
+        self._close_view(request)
+        return None
+
+    def _close_view(self, request):
+        started = getattr(request, "_view_started", None)
+        if started is None:
+            return
+        request._view_started = None
+        start, abac_before = started
+        timings = request.timings
+        abac_during_view = timings.durations.get("abac", 0.0) - abac_before
+        view_ms = (time.perf_counter() - start) * 1000 - abac_during_view
+        timings.add("view", max(0.0, view_ms))
+
+    def _record(self, request, timings):
+        # Respuestas sin renderizado diferido (JsonResponse, HttpResponse)
+        self._close_view(request)
+        endpoint = get_endpoint_name(request)
+        for phase in PHASES:
+            duration = timings.durations.get(phase)
+            if duration is None:
+                continue
+            registry.incr(f"phase_time_us:{phase}:{endpoint}", int(duration * 1000))
+            registry.incr(f"phase_count:{phase}:{endpoint}")
+
+
+def get_phase_metrics(counters=None):
+    """{endpoint: {fase: {"count", "total_ms", "avg_ms"}}} acumulados."""
+    counters = registry.get_counters() if counters is None else counters
+    metrics = {}
+    for name, value in counters.items():
+        prefix, _, rest = name.partition(":")
+        if prefix not in PHASE_COUNTERS:
+            continue
+        phase, _, endpoint = rest.partition(":")
+        data = metrics.setdefault(endpoint, {}).setdefault(
+            phase, {"count": 0, "total_ms": 0, "avg_ms": 0}
+        )
+        if prefix == "phase_count":
+            data["count"] = value
+        else:
+            data["total_ms"] = round(value / 1000, 2)
+    for phases in metrics.values():
+        for data in phases.values():
+            data["avg_ms"] = round(data["total_ms"] / data["count"], 2) if data["count"] else 0
+    return metrics
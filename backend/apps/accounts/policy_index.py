@@ -0,0 +1,211 @@
+"""
+Indice compilado de politicas ABAC por company.
+
+Las politicas activas de una company se cargan una sola vez, se agrupan por
+accion exacta, sufijo ("recurso.accion" vs "accion"), prefijo wildcard
+("recurso.*") y global ("*"), y sus condiciones se pre-procesan. El indice se
+guarda en un cache local del proceso, indexado por la version de politicas de
+la company. La version vive en el cache compartido de Django y se incrementa
+cuando se guarda o elimina un AccessPolicy (ver signals.py), de modo que todos
+los workers recompilan en la siguiente evaluacion.
+"""
+import threading
+import time
+from dataclasses import dataclass, field
+
+from django.core.cache import cache
+
+from .models import AccessPolicy
+
+POLICY_VERSION_KEY = "abac:policy_version:{company_id}"
+CONDITION_KEYS_KEY = "abac:condition_keys:{company_id}:{version}"
+POLICY_VERSION_TIMEOUT = None  # Sin expiracion; se invalida por incremento
+POLICY_CONDITION_KEYS_TIMEOUT = 86400
+
+WRITE_ACTIONS = frozenset(["create", "update", "partial_update", "destroy"])
+
+_local_index = {}
+_local_lock = threading.Lock()
+
+
+def _new_version():
+    # Basada en tiempo para no reutilizar versiones si el cache se vacia
+    return int(time.time() * 1000)
+
+
+def get_policy_version(company_id):
+    """Retorna la version actual de politicas de la company."""
+    key = POLICY_VERSION_KEY.format(company_id=company_id)
+    try:
+        version = cache.get(key)
+        if version is None:
+            cache.add(key, _new_version(), timeout=POLICY_VERSION_TIMEOUT)
+            version = cache.get(key)
+    except Exception:
+        version = None
+    # Sin cache disponible no es posible coordinar workers: siempre recompilar
+    return version if version is not None else _new_version()
+
+
+def bump_policy_version(company_id):
+    """Invalida el indice compilado de la company en todos los workers."""
+    key = POLICY_VERSION_KEY.format(company_id=company_id)
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, _new_version(), timeout=POLICY_VERSION_TIMEOUT)
+    except Exception:
+        pass
+    with _local_lock:
+        _local_index.pop(str(company_id), None)
+
+
+def _compile_conditions(conditions):
+    compiled = []
+    for key, expected in (conditions or {}).items():
+        if isinstance(expected, list):
+            try:
+                compiled.append((key, True, frozenset(expected)))
+            except TypeError:
+                compiled.append((key, True, tuple(expected)))
+        else:
+            compiled.append((key, False, expected))
+    return tuple(compiled)
+
+
+@dataclass(frozen=True)
+class CompiledPolicy:
+    position: int
+    id: str
+    action: str
+    effect: str
+    priority: int
+    conditions: tuple
+
+    def matches(self, context):
+        for key, is_list, expected in self.conditions:
+            actual = context.get(key)
+            if is_list:
+                if actual not in expected:
+                    return False
+            elif actual != expected:
+                return False
+        return True
+
+
+@dataclass
+class CompiledPolicySet:
+    """Politicas activas de una company agrupadas para busqueda directa."""
+
+    version: int
+    policies: list = field(default_factory=list)
+    exact: dict = field(default_factory=dict)
+    suffix: dict = field(default_factory=dict)
+    prefix: list = field(default_factory=list)
+    global_policies: list = field(default_factory=list)
+    read_only: dict = field(default_factory=dict)
+    condition_keys: frozenset = frozenset()
+
+    def __bool__(self):
+        return bool(self.policies)
+
+    def candidates(self, action_name):
+        """Politicas cuya accion coincide, en orden de prioridad descendente."""
+        found = {}
+        for policy in self.exact.get(action_name, ()):
+            found[policy.position] = policy
+        for policy in self.suffix.get(action_name, ()):
+            found[policy.position] = policy
+        for prefix, policy in self.prefix:
+            if action_name.startswith(prefix):
+                found[policy.position] = policy
+        for policy in self.global_policies:
+            found[policy.position] = policy
+        return [found[position] for position in sorted(found)]
+
+
+def compile_policies(policies, version):
+    """Construye un CompiledPolicySet a partir de politicas ordenadas por -priority."""
+    compiled = CompiledPolicySet(version=version)
+    condition_keys = set()
+    for position, policy in enumerate(policies):
+        item = CompiledPolicy(
+            position=position,
+            id=str(policy.id),
+            action=policy.action,
+            effect=policy.effect,
+            priority=policy.priority,
+            conditions=_compile_conditions(policy.conditions),
+        )
+        compiled.policies.append(item)
+        condition_keys.update(key for key, _, _ in item.conditions)
+        action = item.action
+        if action == "*":
+            compiled.global_policies.append(item)
+            continue
+        compiled.exact.setdefault(action, []).append(item)
+        if action.endswith(".*"):
+            compiled.prefix.append((action[:-2], item))
+        parts = action.split(".")
+        if len(parts) == 2:
+            compiled.suffix.setdefault(parts[1], []).append(item)
+            if parts[1] == "read" and item.effect == "allow":
+                compiled.read_only.setdefault(parts[0], []).append(item)
+    compiled.condition_keys = frozenset(condition_keys)
+    return compiled
+
+
+def get_local_policies(company_id, version):
+    """Indice compilado de este proceso si coincide con la version, o None."""
+    compiled = _local_index.get(str(company_id))
+    if compiled is not None and compiled.version == version:
+        return compiled
+    return None
+
+
+def get_condition_keys(company_id, version):
+    """
+    Claves de contexto usadas por las condiciones de la company.
+    Se consulta primero el indice local y luego el publicado en el cache
+    compartido por el worker que compilo; None si nadie ha compilado aun.
+    """
+    compiled = get_local_policies(company_id, version)
+    if compiled is not None:
+        return compiled.condition_keys
+    try:
+        keys = cache.get(CONDITION_KEYS_KEY.format(company_id=company_id, version=version))
+    except Exception:
+        return None
+    return frozenset(keys) if keys is not None else None
+
+
+def get_compiled_policies(company_id, version=None):
+    """Retorna el indice compilado vigente para la company."""
+    company_key = str(company_id)
+    if version is None:
+        version = get_policy_version(company_key)
+    compiled = get_local_policies(company_key, version)
+    if compiled is not None:
+        return compiled
+
+    policies = AccessPolicy.objects.filter(company_id=company_id, is_active=True).order_by(
+        "-priority"
+    )
+    compiled = compile_policies(list(policies), version)
+    with _local_lock:
+        _local_index[company_key] = compiled
+    try:
+        cache.set(
+            CONDITION_KEYS_KEY.format(company_id=company_key, version=version),
+            sorted(compiled.condition_keys),
+            timeout=POLICY_CONDITION_KEYS_TIMEOUT,
+        )
+    except Exception:
+        pass
+    return compiled
+
+
+def clear_local_index():
+    """Vacia el cache local del proceso (util en tests)."""
+    with _local_lock:
+        _local_index.clear()
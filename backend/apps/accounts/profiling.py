@@ -0,0 +1,90 @@
+"""
+Almacenamiento de perfiles cProfile de requests en storage/profiles.
+
+Cada perfil es un archivo .prof (pstats, compatible con snakeviz/pstats) cuyo
+nombre contiene los metadatos: timestamp, método, ruta, duración y motivo
+("on-demand" o "slow-sample"). Se conservan como máximo PROFILING_MAX_FILES
+archivos; al guardar uno nuevo se borran los más antiguos.
+"""
+import io
+import pstats
+import re
+import time
+import uuid
+from pathlib import Path
+
+from django.conf import settings
+
+PROFILE_SUFFIX = ".prof"
+PROFILE_ID_RE = re.compile(r"^[A-Za-z0-9_.-]+$")
+_UNSAFE_CHARS_RE = re.compile(r"[^A-Za-z0-9.-]+")
+
+
+def get_profiles_dir():
+    path = Path(getattr(settings, "PROFILING_DIR", Path(settings.BASE_DIR) / "storage" / "profiles"))
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+def _slug(value):
+    return _UNSAFE_CHARS_RE.sub("-", value).strip("-")[:80] or "unknown"
+
+
+def save_profile(profiler, endpoint, duration_ms, trigger):
+    """Guarda el perfil y aplica la retención. Retorna el id del perfil."""
+    method, _, route = endpoint.partition(":")
+    profile_id = "_".join([
+        time.strftime("%Y%m%dT%H%M%S", time.gmtime()),
+        _slug(method),
+        _slug(route),
+        f"{int(duration_ms)}ms",
+        trigger,
+        uuid.uuid4().hex[:8],
+    ])
+    directory = get_profiles_dir()
+    profiler.dump_stats(str(directory / f"{profile_id}{PROFILE_SUFFIX}"))
+    _apply_retention(directory)
+    return profile_id
+
+
+def _apply_retention(directory):
+    max_files = max(1, int(getattr(settings, "PROFILING_MAX_FILES", 50)))
+    files = sorted(directory.glob(f"*{PROFILE_SUFFIX}"), key=lambda path: path.name)
+    for path in files[:-max_files]:
+        path.unlink(missing_ok=True)
+
+
+def list_profiles():
+    """Perfiles disponibles, del más reciente al más antiguo."""
+    profiles = []
+    for path in sorted(get_profiles_dir().glob(f"*{PROFILE_SUFFIX}"), reverse=True):
+        parts = path.stem.split("_")
+        if len(parts) != 6:
+            continue
+        timestamp, method, route, duration, trigger, _ = parts
+        profiles.append({
+            "id": path.stem,
+            "created_at": timestamp,
+            "method": method,
+            "route": route,
+            "duration_ms": int(duration.rstrip("ms") or 0),
+            "trigger": trigger,
+            "size_bytes": path.stat().st_size,
+        })
+    return profiles
+
+
+def get_profile_path(profile_id):
+    """Ruta del perfil o None si el id no es válido o no existe."""
+    if not PROFILE_ID_RE.match(profile_id or ""):
+        return None
+    path = get_profiles_dir() / f"{profile_id}{PROFILE_SUFFIX}"
+    return path if path.is_file() else None
+
+
+def render_profile_text(path, limit=50):
+    """Resumen legible: funciones ordenadas por tiempo acumulado."""
+    output = io.StringIO()
+    stats = pstats.Stats(str(path), stream=output)
+    stats.sort_stats("cumulative").print_stats(limit)
+    return output.getvalue()
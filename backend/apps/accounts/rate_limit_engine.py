@@ -0,0 +1,438 @@
+"""
+Motor de rate limiting por ventana deslizante con contadores atómicos.
+
+Cada ventana se divide en sub-ventanas fijas (buckets). Por request:
+- `incr` atómico del bucket actual de cada dimensión (IP, usuario)
+- un único `get_many` con los buckets anteriores de todas las dimensiones
+
+El conteo de la ventana es la suma de los buckets completos más la fracción
+aún vigente del bucket más antiguo (sliding window counter). De ese mismo
+resultado salen la decisión, el registro y los datos de los headers
+X-RateLimit-*, sin volver a leer el cache. Si el request se rechaza se
+descuenta de nuevo, de modo que los rechazos no consumen cupo.
+
+LocalTokenBucketLimiter es el modo opcional de dos niveles: cada worker
+consume tokens de un bucket local por regla y solo sincroniza con el cache
+compartido (un incr con lo consumido + un get_many) cada N ms o N requests.
+Un hilo daemon por proceso (y atexit) vuelca lo pendiente de las claves
+inactivas, y las claves descartadas del LRU vuelcan lo suyo al salir.
+"""
+import atexit
+import math
+import os
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from dataclasses import dataclass
+
+from django.core.cache import cache
+
+DEFAULT_SUB_WINDOWS = 10
+DEFAULT_MEMORY_MAX_KEYS = 1000
+DEFAULT_SYNC_INTERVAL_MS = 250
+DEFAULT_SYNC_REQUESTS = 20
+DEFAULT_OVER_ADMISSION = 0.1
+DEFAULT_FLUSH_SECONDS = 1.0
+BUCKET_KEY = "rl:{dimension}:{ident}:{endpoint}:{method}:{size}:{index}"
+
+
+@dataclass(frozen=True)
+class LimitRule:
+    dimension: str  # "ip" o "user"
+    ident: str
+    max_requests: int
+    window: int
+
+
+class BoundedLRU:
+    """
+    Dict LRU acotado; al superar max_size se descarta el menos usado en O(1).
+    `on_evict(key, value)` se llama con cada entrada descartada.
+    """
+
+    def __init__(self, max_size=DEFAULT_MEMORY_MAX_KEYS, on_evict=None):
+        self.max_size = max(1, int(max_size))
+        self._data = OrderedDict()
+        self._on_evict = on_evict
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        try:
+            self._data.move_to_end(key)
+        except KeyError:
+            return default
+        return self._data[key]
+
+    def set(self, key, value):
+        self._data[key] = value
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            evicted_key, evicted = self._data.popitem(last=False)
+            if self._on_evict is not None:
+                self._on_evict(evicted_key, evicted)
+
+    def pop(self, key, default=None):
+        return self._data.pop(key, default)
+
+    def items(self):
+        return list(self._data.items())
+
+
+class CacheCounterStore:
+    """Contadores en el cache de Django con fallback a memoria local."""
+
+    def __init__(self, memory_max_keys=DEFAULT_MEMORY_MAX_KEYS):
+        # Cache en memoria como fallback (no usar en producción con múltiples workers)
+        self._memory_cache = BoundedLRU(memory_max_keys)
+        self._memory_lock = threading.Lock()
+
+    def incr(self, key, timeout, delta=1):
+        try:
+            try:
+                return cache.incr(key, delta)
+            except ValueError:
+                if cache.add(key, delta, timeout=timeout):
+                    return delta
+                return cache.incr(key, delta)
+        except Exception:
+            return self._memory_incr(key, timeout, delta)
+
+    def decr(self, key, timeout):
+        try:
+            cache.decr(key)
+        except ValueError:
+            # El bucket expiró entre incr y decr: no hay nada que descontar
+            pass
+        except Exception:
+            self._memory_incr(key, timeout, -1)
+
+    def get_many(self, keys):
+        try:
+            return cache.get_many(keys)
+        except Exception:
+            now = time.time()
+            found = {}
+            with self._memory_lock:
+                for key in keys:
+                    entry = self._memory_cache.get(key)
+                    if entry and entry["expires_at"] > now:
+                        found[key] = entry["count"]
+            return found
+
+    def _memory_incr(self, key, timeout, delta):
+        now = time.time()
+        with self._memory_lock:
+            entry = self._memory_cache.get(key)
+            if not entry or entry["expires_at"] <= now:
+                entry = {"count": 0, "expires_at": now + timeout}
+                self._memory_cache.set(key, entry)
+            entry["count"] += delta
+            return entry["count"]
+
+
+class SlidingWindowLimiter:
+    """Evalúa y registra varias reglas de rate limit para un request."""
+
+    def __init__(self, store=None, sub_windows=DEFAULT_SUB_WINDOWS):
+        self.store = store or CacheCounterStore()
+        self.sub_windows = max(1, int(sub_windows))
+
+    def _bucket_size(self, window):
+        return max(1, int(math.ceil(window / self.sub_windows)))
+
+    def _key(self, rule, endpoint, method, size, index):
+        return BUCKET_KEY.format(
+            dimension=rule.dimension,
+            ident=rule.ident,
+            endpoint=endpoint,
+            method=method,
+            size=size,
+            index=index,
+        )
+
+    def _plan(self, rule, endpoint, method, now):
+        size = self._bucket_size(rule.window)
+        buckets = int(math.ceil(rule.window / size))
+        index = int(now // size)
+        # Buckets previos: index-buckets .. index-1 (el más antiguo se pondera)
+        older = [self._key(rule, endpoint, method, size, i) for i in range(index - buckets, index)]
+        current = self._key(rule, endpoint, method, size, index)
+        return size, index, older, current
+
+    @staticmethod
+    def _window_count(now, size, index, older, current_count, previous):
+        oldest_weight = 1.0 - (now - index * size) / size
+        total = current_count
+        for position, key in enumerate(older):
+            value = previous.get(key) or 0
+            total += value * oldest_weight if position == 0 else value
+        return int(math.ceil(total - 1e-9))
+
+    def hit(self, rules, endpoint, method, now=None):
+        """
+        Registra el request en todas las reglas y retorna el resultado:
+        {"limited", "limit", "remaining", "reset_at", "type", "window"}.
+        """
+        now = time.time() if now is None else now
+        plans = []
+        previous_keys = []
+        for rule in rules:
+            size, index, older, current = self._plan(rule, endpoint, method, now)
+            plans.append((rule, size, index, older, current))
+            previous_keys.extend(older)
+
+        counts = []
+        for rule, size, index, older, current in plans:
+            counts.append(self.store.incr(current, timeout=rule.window + size))
+        previous = self.store.get_many(previous_keys) if previous_keys else {}
+
+        results = []
+        for (rule, size, index, older, current), current_count in zip(plans, counts):
+            total = self._window_count(now, size, index, older, current_count, previous)
+            results.append({
+                "rule": rule,
+                "current": current,
+                "timeout": rule.window + size,
+                "count": total,
+                "limited": total > rule.max_requests,
+                "reset_at": now + rule.window,
+            })
+
+        limited = next((item for item in results if item["limited"]), None)
+        if limited is not None:
+            # Los requests rechazados no consumen cupo
+            for item in results:
+                self.store.decr(item["current"], timeout=item["timeout"])
+            rule = limited["rule"]
+            return {
+                "limited": True,
+                "limit": rule.max_requests,
+                "remaining": 0,
+                "reset_at": limited["reset_at"],
+                "type": rule.dimension,
+                "window": rule.window,
+            }
+
+        if not results:
+            return {"limited": False, "limit": 0, "remaining": 0, "reset_at": now, "type": None, "window": 0}
+
+        return {
+            "limited": False,
+            "limit": min(item["rule"].max_requests for item in results),
+            "remaining": max(0, min(item["rule"].max_requests - item["count"] for item in results)),
+            "reset_at": min(item["reset_at"] for item in results),
+            "type": None,
+            "window": min(item["rule"].window for item in results),
+        }
+
+
+class _LocalBucket:
+    __slots__ = ("tokens", "pending", "admitted", "last_sync", "touched")
+
+    def __init__(self):
+        self.tokens = 0
+        self.pending = 0
+        self.admitted = 0
+        self.last_sync = None
+        self.touched = time.monotonic()
+
+
+class LocalTokenBucketLimiter(SlidingWindowLimiter):
+    """
+    Rate limiting de dos niveles.
+
+    Cada worker guarda por regla un bucket local con los tokens restantes según
+    el último conteo compartido, y decide sin tocar el cache. Lo admitido se
+    acumula en `pending` y se reconcilia (incr del bucket actual + get_many de
+    los anteriores) cuando pasan `sync_interval_ms` o cuando el worker ha
+    admitido `sync_requests` requests desde la última sincronización.
+
+    Entre sincronizaciones otros workers también consumen cupo, así que el
+    total puede exceder el límite. `over_admission` acota ese exceso: cada
+    worker sincroniza antes de admitir más de `max_requests * over_admission`
+    requests sin reconciliar (mínimo 1, es decir, sincronizar en cada request).
+
+    El lock solo protege el estado local: la sincronización se planea bajo el
+    lock (se toma lo pendiente), las llamadas al cache se hacen fuera y el
+    resultado se aplica al volver a tomarlo. Lo consumido mientras tanto
+    sigue en `pending` y se descuenta de los tokens.
+    """
+
+    def __init__(
+        self,
+        store=None,
+        sub_windows=DEFAULT_SUB_WINDOWS,
+        sync_interval_ms=DEFAULT_SYNC_INTERVAL_MS,
+        sync_requests=DEFAULT_SYNC_REQUESTS,
+        over_admission=DEFAULT_OVER_ADMISSION,
+        max_keys=DEFAULT_MEMORY_MAX_KEYS,
+    ):
+        super().__init__(store=store, sub_windows=sub_windows)
+        self.sync_interval = max(0, sync_interval_ms) / 1000.0
+        self.sync_requests = max(1, int(sync_requests))
+        self.over_admission = max(0.0, float(over_admission))
+        self._buckets = BoundedLRU(max_keys, on_evict=self._on_evict)
+        self._evicted = []
+        self._lock = threading.Lock()
+        _LIVE_LIMITERS.add(self)
+
+    def _batch_size(self, rule):
+        allowed = int(rule.max_requests * self.over_admission)
+        return max(1, min(self.sync_requests, allowed))
+
+    def _on_evict(self, key, bucket):
+        # Se llama bajo self._lock (desde BoundedLRU.set); se escribe fuera
+        if bucket.pending:
+            self._evicted.append((key, bucket.pending))
+
+    def _take_evicted(self):
+        evicted, self._evicted = self._evicted, []
+        return evicted
+
+    def _write_pending(self, items, now):
+        """incr del bucket actual con lo consumido y no reconciliado (sin lock)."""
+        for (rule, endpoint, method), pending in items:
+            size, index, older, current = self._plan(rule, endpoint, method, now)
+            self.store.incr(current, timeout=rule.window + size, delta=pending)
+
+    def _fetch_total(self, rule, endpoint, method, pending, now):
+        """Conteo compartido de la ventana tras sumar `pending` (sin lock)."""
+        size, index, older, current = self._plan(rule, endpoint, method, now)
+        if pending:
+            current_count = self.store.incr(current, timeout=rule.window + size, delta=pending)
+            previous = self.store.get_many(older) if older else {}
+        else:
+            previous = self.store.get_many(older + [current])
+            current_count = previous.get(current) or 0
+        return self._window_count(now, size, index, older, current_count, previous)
+
+    def flush(self, now=None, idle_only=False):
+        """
+        Reconcilia lo pendiente con el cache compartido. Con `idle_only` solo
+        las claves sin requests en el último sync_interval (las activas se
+        sincronizan solas en hit()).
+        """
+        now = time.time() if now is None else now
+        idle_since = time.monotonic() - self.sync_interval
+        with self._lock:
+            items = self._take_evicted()
+            for key, bucket in self._buckets.items():
+                if bucket.pending and (not idle_only or bucket.touched <= idle_since):
+                    items.append((key, bucket.pending))
+                    bucket.pending = 0
+                    bucket.admitted = 0
+        self._write_pending(items, now)
+
+    def hit(self, rules, endpoint, method, now=None):
+        now = time.time() if now is None else now
+        if not rules:
+            return {"limited": False, "limit": 0, "remaining": 0, "reset_at": now, "type": None, "window": 0}
+        _ensure_flusher()
+
+        # 1) Bajo el lock: buckets y plan de sincronización
+        syncs = []
+        with self._lock:
+            buckets = []
+            for rule in rules:
+                key = (rule, endpoint, method)
+                bucket = self._buckets.get(key)
+                if bucket is None:
+                    bucket = _LocalBucket()
+                    self._buckets.set(key, bucket)
+                if (
+                    bucket.last_sync is None
+                    or now - bucket.last_sync >= self.sync_interval
+                    or bucket.admitted >= self._batch_size(rule)
+                ):
+                    syncs.append((rule, bucket, bucket.pending))
+                    bucket.pending = 0
+                    bucket.admitted = 0
+                buckets.append((rule, bucket))
+            evicted = self._take_evicted()
+
+        # 2) Sin lock: I/O con el cache compartido
+        self._write_pending(evicted, now)
+        totals = [
+            (rule, bucket, self._fetch_total(rule, endpoint, method, pending, now))
+            for rule, bucket, pending in syncs
+        ]
+
+        # 3) Bajo el lock: aplicar el conteo y decidir
+        with self._lock:
+            for rule, bucket, total in totals:
+                if bucket.last_sync is None or now >= bucket.last_sync:
+                    bucket.tokens = rule.max_requests - total - bucket.pending
+                    bucket.last_sync = now
+            touched = time.monotonic()
+            for _, bucket in buckets:
+                bucket.touched = touched
+
+            # Los requests rechazados no consumen tokens
+            limited = next(((rule, bucket) for rule, bucket in buckets if bucket.tokens <= 0), None)
+            if limited is not None:
+                rule = limited[0]
+                return {
+                    "limited": True,
+                    "limit": rule.max_requests,
+                    "remaining": 0,
+                    "reset_at": now + rule.window,
+                    "type": rule.dimension,
+                    "window": rule.window,
+                }
+
+            for rule, bucket in buckets:
+                bucket.tokens -= 1
+                bucket.pending += 1
+                bucket.admitted += 1
+
+            return {
+                "limited": False,
+                "limit": min(rule.max_requests for rule, _ in buckets),
+                "remaining": max(0, min(bucket.tokens for _, bucket in buckets)),
+                "reset_at": now + min(rule.window for rule, _ in buckets),
+                "type": None,
+                "window": min(rule.window for rule, _ in buckets),
+            }
+
+
+# Volcado periódico de claves inactivas: un hilo por proceso para todos los
+# limiters vivos (se recrea tras un fork, como en metrics_registry)
+_LIVE_LIMITERS = weakref.WeakSet()
+_flusher_lock = threading.Lock()
+_flusher_pid = None
+
+
+def _flush_all(idle_only=False):
+    for limiter in list(_LIVE_LIMITERS):
+        try:
+            limiter.flush(idle_only=idle_only)
+        except Exception:
+            # El rate limiting no debe tumbar el hilo ni la salida del proceso
+            pass
+
+
+def _run_flusher():
+    while True:
+        time.sleep(DEFAULT_FLUSH_SECONDS)
+        _flush_all(idle_only=True)
+
+
+def _ensure_flusher():
+    global _flusher_pid
+    pid = os.getpid()
+    if _flusher_pid == pid:
+        return
+    with _flusher_lock:
+        if _flusher_pid == pid:
+            return
+        _flusher_pid = pid
+        threading.Thread(target=_run_flusher, name="rate-limit-flush", daemon=True).start()
+
+
+atexit.register(_flush_all)
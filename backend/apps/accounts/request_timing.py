@@ -0,0 +1,94 @@
+"""
+Fases de tiempo por request para el header Server-Timing.
+
+ServerTimingMiddleware (el más externo) crea un RequestTimings en
+request.timings. Cada etapa mide su parte con `timing_phase(request, fase)`:
+
+- ratelimit: AdvancedRateLimitMiddleware
+- auth: primera evaluación de request.user (sesión, usuario y OTP)
+- tenant: resolución de perfil/company/sitec (identity, CompanySitecMiddleware)
+- context: construcción diferida de request.user_context
+- abac: evaluación de políticas (evaluate_access_policies)
+- view: cuerpo de la vista, sin el tiempo de abac
+- render: serialización/renderizado de la respuesta (DRF/templates)
+- db: tiempo total en SQL (QueryBudgetMiddleware)
+
+Las fases pueden solaparse (p. ej. abac dentro de context, db dentro de
+todas); una fase anidada dentro de sí misma solo se cuenta una vez.
+
+Los headers de diagnóstico (Server-Timing, X-DB-*) solo se envían a quien
+pasa can_see_diagnostics: DEBUG, usuarios staff o IPs en INTERNAL_IPS.
+"""
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+
+PHASES = ("ratelimit", "auth", "tenant", "context", "abac", "view", "render", "db")
+
+
+class RequestTimings:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.durations = {}
+        self.descriptions = {}
+        self._active = set()
+
+    def elapsed_ms(self):
+        return (time.perf_counter() - self.start) * 1000
+
+    def add(self, phase, duration_ms, description=None):
+        self.durations[phase] = self.durations.get(phase, 0.0) + duration_ms
+        if description:
+            self.descriptions[phase] = description
+
+    @contextmanager
+    def phase(self, name):
+        if name in self._active:
+            yield
+            return
+        self._active.add(name)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._active.discard(name)
+            self.add(name, (time.perf_counter() - start) * 1000)
+
+    def header_value(self, total_ms):
+        entries = []
+        for phase, duration in self.durations.items():
+            entry = f"{phase};dur={duration:.2f}"
+            if phase in self.descriptions:
+                entry += f';desc="{self.descriptions[phase]}"'
+            entries.append(entry)
+        entries.append(f"total;dur={total_ms:.2f}")
+        return ", ".join(entries)
+
+
+def get_timings(request):
+    """RequestTimings del request (acepta Request de DRF) o None."""
+    base = getattr(request, "_request", request)
+    return getattr(base, "timings", None)
+
+
+def can_see_diagnostics(request):
+    """True si la respuesta puede exponer tiempos/queries internos al cliente."""
+    if settings.DEBUG:
+        return True
+    base = getattr(request, "_request", request)
+    if base.META.get("REMOTE_ADDR") in getattr(settings, "INTERNAL_IPS", ()):
+        return True
+    user = getattr(base, "user", None)
+    return bool(user and user.is_authenticated and user.is_staff)
+
+
+@contextmanager
+def timing_phase(request, name):
+    """Mide una fase si el request tiene RequestTimings; si no, no hace nada."""
+    timings = get_timings(request)
+    if timings is None:
+        yield
+        return
+    with timings.phase(name):
+        yield
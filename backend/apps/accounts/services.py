@@ -1,6 +1,22 @@
-from dataclasses import dataclass
+import logging
+from dataclasses import astuple, dataclass
 
-from .models import AccessPolicy, UserProfile
+from .decision_cache import (
+    decision_cache_enabled,
+    decision_cache_stats,
+    get_cached_decisions,
+    store_decisions,
+)
+from .identity import get_request_profile
+from .policy_index import (
+    WRITE_ACTIONS,
+    get_compiled_policies,
+    get_condition_keys,
+    get_policy_version,
+)
+from .request_timing import timing_phase
+
+logger = logging.getLogger(__name__)
 
 
 @dataclass
@@ -69,19 +85,35 @@ def matches_conditions(conditions, context):
 
 
 def evaluate_access_policy(request, action_name):
-    import logging
-    logger = logging.getLogger(__name__)
-    
+    return evaluate_access_policies(request, [action_name])[action_name]
+
+
+def evaluate_access_policies(request, action_names):
+    """
+    Evalúa varias acciones para el mismo request en una sola pasada.
+    Resuelve identidad, contexto y políticas compiladas una vez, y reutiliza
+    el resultado de las condiciones de cada política entre acciones.
+    Retorna {action: PolicyDecision} con las mismas decisiones que
+    evaluate_access_policy.
+    """
+    with timing_phase(request, "abac"):
+        return _evaluate_access_policies(request, action_names)
+
+
+def _evaluate_access_policies(request, action_names):
+    action_names = list(dict.fromkeys(action_names))
+    label = ", ".join(str(action) for action in action_names)
+
     user = getattr(request, "user", None)
     if not user:
-        logger.debug(f"[ABAC] No user found for action: {action_name}")
-        return PolicyDecision(allowed=False)
+        logger.debug(f"[ABAC] No user found for action: {label}")
+        return {action: PolicyDecision(allowed=False) for action in action_names}
     
     # Verificar autenticación - usar el método correcto para Django
     # En Django, is_authenticated es una propiedad, no un método
     if not hasattr(user, 'is_authenticated'):
         logger.debug(f"[ABAC] User {user} has no is_authenticated attribute")
-        return PolicyDecision(allowed=False)
+        return {action: PolicyDecision(allowed=False) for action in action_names}
     
     # Verificar si es una propiedad o método
     is_authenticated = user.is_authenticated
@@ -89,76 +121,106 @@ def evaluate_access_policy(request, action_name):
         is_authenticated = is_authenticated()
     
     if not is_authenticated:
-        logger.debug(f"[ABAC] User {user.username} is not authenticated for action: {action_name}")
-        return PolicyDecision(allowed=False)
+        logger.debug(f"[ABAC] User {user.username} is not authenticated for action: {label}")
+        return {action: PolicyDecision(allowed=False) for action in action_names}
 
-    profile = UserProfile.objects.select_related("company").filter(user=user).first()
+    profile = get_request_profile(request)
     if not profile:
         logger.debug(f"[ABAC] No profile found for user {user.username}")
-        return PolicyDecision(allowed=False)
+        return {action: PolicyDecision(allowed=False) for action in action_names}
     
     if not profile.company:
         logger.debug(f"[ABAC] No company found for user {user.username}")
-        return PolicyDecision(allowed=False)
+        return {action: PolicyDecision(allowed=False) for action in action_names}
 
     # Admin empresa siempre tiene acceso completo
     if profile.role == "admin_empresa":
-        logger.debug(f"[ABAC] Admin empresa {user.username} granted access to {action_name}")
-        return PolicyDecision(
-            allowed=True,
-            policy_action="admin_empresa",
-            policy_effect="allow",
-        )
+        logger.debug(f"[ABAC] Admin empresa {user.username} granted access to {label}")
+        return {
+            action: PolicyDecision(
+                allowed=True,
+                policy_action="admin_empresa",
+                policy_effect="allow",
+            )
+            for action in action_names
+        }
 
     context = build_context(request, profile)
-    
-    # Primero verificar políticas explícitas (tienen máxima prioridad)
-    policies = (
-        AccessPolicy.objects.filter(company=profile.company, is_active=True)
-        .order_by("-priority")
-        .all()
-    )
-    
+    company_id = profile.company_id
+    version = get_policy_version(company_id)
+
+    # Decisiones ya calculadas por cualquier worker para los mismos atributos
+    decisions = {}
+    condition_keys = None
+    if decision_cache_enabled():
+        condition_keys = get_condition_keys(company_id, version)
+        if condition_keys is not None:
+            for action, value in get_cached_decisions(
+                company_id, version, condition_keys, context, action_names
+            ).items():
+                decisions[action] = PolicyDecision(*value)
+    missing = [action for action in action_names if action not in decisions]
+
+    if missing:
+        # Políticas activas de la company, compiladas y cacheadas por versión
+        policies = get_compiled_policies(company_id, version)
+        matched = {}
+        computed = {
+            action: _evaluate_compiled(policies, action, context, profile.role, matched)
+            for action in missing
+        }
+        decisions.update(computed)
+        if decision_cache_enabled():
+            store_decisions(
+                company_id,
+                policies.version,
+                policies.condition_keys,
+                context,
+                {action: astuple(decision) for action, decision in computed.items()},
+            )
+
+    if decision_cache_enabled():
+        decision_cache_stats.record(len(action_names) - len(missing), len(missing))
+    return {action: decisions[action] for action in action_names}
+
+
+def _policy_matches(policy, context, matched):
+    # Las condiciones dependen solo del contexto: se evalúan una vez por política
+    result = matched.get(policy.position)
+    if result is None:
+        result = matched[policy.position] = policy.matches(context)
+    return result
+
+
+def _evaluate_compiled(policies, action_name, context, role, matched):
+    is_write = action_name in WRITE_ACTIONS
+    path = context.get("path", "").lower()
+    is_transactions_path = "transactions" in path or "transacciones" in path
+
     # PRIMERO: Verificar políticas de solo lectura ANTES de buscar políticas específicas o globales
     # Esto asegura que las restricciones de solo lectura tengan máxima prioridad
-    write_actions = ['create', 'update', 'partial_update', 'destroy']
-    if action_name in write_actions:
-        # Buscar políticas de lectura específicas para el mismo recurso
-        # Estas políticas tienen prioridad sobre políticas globales y específicas de escritura
-        for policy in policies.order_by("-priority"):
-            # Verificar si es una política de solo lectura (ej: transactions.read)
-            policy_parts = policy.action.split('.')
-            is_read_only = len(policy_parts) == 2 and policy_parts[1] == 'read'
-            
-            if is_read_only and policy.effect == "allow":
-                # Verificar condiciones (rol, etc.)
-                if matches_conditions(policy.conditions, context):
-                    # Verificar si es para el mismo recurso (ej: transactions.read vs transactions.create)
-                    policy_resource = policy_parts[0]
-                    action_resource = None
-                    if 'transactions' in request.path.lower() or 'transacciones' in request.path.lower():
-                        action_resource = 'transactions'
-                    
-                    if policy_resource and action_resource and policy_resource == action_resource:
-                        logger.debug(
-                            f"[ABAC] Read-only policy found for write action: "
-                            f"policy={policy.action}, action={action_name}, role={context.get('role')}, "
-                            f"resource={action_resource}, priority={policy.priority}, DENYING"
-                        )
-                        return PolicyDecision(
-                            allowed=False,
-                            policy_action=policy.action,
-                            policy_effect="deny",
-                        )
+    if is_write and is_transactions_path:
+        # Políticas "transactions.read" tienen prioridad sobre globales y de escritura
+        for policy in policies.read_only.get("transactions", ()):
+            if _policy_matches(policy, context, matched):
+                logger.debug(
+                    f"[ABAC] Read-only policy found for write action: "
+                    f"policy={policy.action}, action={action_name}, role={context.get('role')}, "
+                    f"resource=transactions, priority={policy.priority}, DENYING"
+                )
+                return PolicyDecision(
+                    allowed=False,
+                    policy_action=policy.action,
+                    policy_effect="deny",
+                )
     
-    # SEGUNDO: Buscar políticas específicas que coincidan exactamente (incluyendo deny)
-    for policy in policies:
-        if not action_matches(policy.action, action_name):
-            continue
-        if matches_conditions(policy.conditions, context):
+    # SEGUNDO: Políticas que coinciden con la acción (exacta, sufijo, prefijo o global "*"),
+    # en orden de prioridad; la primera cuyas condiciones se cumplen decide
+    for policy in policies.candidates(action_name):
+        if _policy_matches(policy, context, matched):
             decision = PolicyDecision(
                 allowed=policy.effect == "allow",
-                policy_id=str(policy.id),
+                policy_id=policy.id,
                 policy_action=policy.action,
                 policy_effect=policy.effect,
             )
@@ -168,48 +230,29 @@ def evaluate_access_policy(request, action_name):
                 f"priority={policy.priority}, allowed={decision.allowed}"
             )
             return decision
-
-    # TERCERO: Si no hay políticas específicas que coincidan, buscar política global "*"
-    # (solo si no es la acción "*" misma para evitar recursión)
-    if action_name != "*":
-        for policy in policies:
-            if policy.action == "*" and matches_conditions(policy.conditions, context):
-                decision = PolicyDecision(
-                    allowed=policy.effect == "allow",
-                    policy_id=str(policy.id),
-                    policy_action=policy.action,
-                    policy_effect=policy.effect,
-                )
-                logger.debug(
-                    f"[ABAC] Global policy matched: action={action_name}, "
-                    f"effect={policy.effect}, allowed={decision.allowed}"
-                )
-                return decision
     
     # Si no hay políticas explícitas, aplicar reglas por defecto
     # Políticas restrictivas por defecto para transacciones
     # Solo ciertos roles pueden realizar operaciones CRUD en transacciones
-    if action_name in ['create', 'update', 'partial_update', 'destroy']:
-        # Verificar si es una acción de transacciones
-        if 'transactions' in request.path.lower() or 'transacciones' in request.path.lower():
-            # Solo admin_empresa, pm, supervisor y tecnico pueden crear/actualizar/eliminar
-            allowed_roles = ['admin_empresa', 'pm', 'supervisor', 'tecnico']
-            if profile.role not in allowed_roles:
-                logger.debug(
-                    f"[ABAC] Access DENIED for transactions {action_name}: "
-                    f"role={profile.role} not in allowed_roles={allowed_roles}"
-                )
-                return PolicyDecision(
-                    allowed=False,
-                    policy_action=action_name,
-                    policy_effect="deny",
-                )
+    if is_write and is_transactions_path:
+        # Solo admin_empresa, pm, supervisor y tecnico pueden crear/actualizar/eliminar
+        allowed_roles = ['admin_empresa', 'pm', 'supervisor', 'tecnico']
+        if role not in allowed_roles:
+            logger.debug(
+                f"[ABAC] Access DENIED for transactions {action_name}: "
+                f"role={role} not in allowed_roles={allowed_roles}"
+            )
+            return PolicyDecision(
+                allowed=False,
+                policy_action=action_name,
+                policy_effect="deny",
+            )
     
     # Si no hay políticas y no es una acción de transacciones, aplicar reglas por defecto
-    if not policies.exists():
+    if not policies:
         # Por defecto, permitir solo lectura para la mayoría de acciones
         # pero denegar escritura si no hay políticas explícitas
-        if action_name in ['create', 'update', 'partial_update', 'destroy']:
+        if is_write:
             # Para acciones de escritura, requerir políticas explícitas
             logger.debug(
                 f"[ABAC] No policies found, denying write action: {action_name}"
@@ -219,7 +262,7 @@ def evaluate_access_policy(request, action_name):
         return PolicyDecision(allowed=True)
     
     # Si hay políticas pero ninguna coincidió, denegar por defecto para escritura
-    if action_name in ['create', 'update', 'partial_update', 'destroy']:
+    if is_write:
         logger.debug(
             f"[ABAC] No matching policy found, denying write action: {action_name}"
         )
@@ -352,9 +395,5 @@ def get_user_permissions(request, actions_to_check=None):
             "roi.export",
         ]
     
-    permissions = {}
-    for action in actions_to_check:
-        decision = evaluate_access_policy(request, action)
-        permissions[action] = decision.allowed
-    
-    return permissions
+    decisions = evaluate_access_policies(request, actions_to_check)
+    return {action: decision.allowed for action, decision in decisions.items()}
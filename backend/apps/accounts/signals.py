@@ -0,0 +1,18 @@
+"""
+Invalidacion de caches ABAC al modificar politicas.
+"""
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .models import AccessPolicy
+from .policy_index import bump_policy_version
+
+
+@receiver([post_save, post_delete], sender=AccessPolicy)
+def invalidate_policy_index(sender, instance, **kwargs):
+    company_id = instance.company_id
+    bump_policy_version(company_id)
+    # Segundo incremento al confirmar la transaccion: evita que otro worker
+    # compile (y cachee con la nueva version) datos aun no confirmados.
+    transaction.on_commit(lambda: bump_policy_version(company_id))
@@ -3,11 +3,13 @@ Tests para el endpoint de contexto de usuario (/api/user/context/).
 Valida que el endpoint devuelve correctamente la información del usuario,
 permisos y configuración de UI según el rol.
 """
+from unittest.mock import patch
+
 from django.contrib.auth import get_user_model
 from rest_framework.test import APITestCase
 
 from apps.companies.models import Company
-from apps.accounts.models import UserProfile
+from apps.accounts.models import AccessPolicy, UserProfile
 
 User = get_user_model()
 
@@ -194,3 +196,38 @@ class UserContextViewTests(APITestCase):
         # (depende de las políticas configuradas)
         self.assertIn("dashboard.view", permissions)
         self.assertIn("projects.create", permissions)
+
+    def test_user_context_sets_etag_and_cache_control(self):
+        """La respuesta incluye ETag y Cache-Control privado."""
+        self.client.force_authenticate(user=self.pm_user)
+        response = self.client.get("/api/user/context/")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response["ETag"].startswith('"'))
+        self.assertIn("private", response["Cache-Control"])
+
+    def test_user_context_conditional_get_returns_304(self):
+        """If-None-Match con el ETag vigente devuelve 304 sin cuerpo."""
+        self.client.force_authenticate(user=self.pm_user)
+        etag = self.client.get("/api/user/context/")["ETag"]
+
+        with patch("apps.accounts.views.get_user_permissions") as mocked:
+            response = self.client.get("/api/user/context/", HTTP_IF_NONE_MATCH=etag)
+            mocked.assert_not_called()
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response["ETag"], etag)
+
+    def test_user_context_etag_changes_with_profile_and_policies(self):
+        """El ETag cambia si cambia el perfil o las políticas de la company."""
+        self.client.force_authenticate(user=self.pm_user)
+        etag = self.client.get("/api/user/context/")["ETag"]
+
+        self.pm_profile.department = "Operaciones"
+        self.pm_profile.save()
+        etag_profile = self.client.get("/api/user/context/")["ETag"]
+        self.assertNotEqual(etag_profile, etag)
+
+        AccessPolicy.objects.create(company=self.company, action="roi.view", effect="deny")
+        response = self.client.get("/api/user/context/", HTTP_IF_NONE_MATCH=etag_profile)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag_profile)
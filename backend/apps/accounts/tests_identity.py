@@ -0,0 +1,83 @@
+"""
+Tests para la identidad compartida por request (request.identity).
+"""
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import AnonymousUser
+from django.test import RequestFactory, TestCase
+
+from apps.audit.models import AuditLog
+from apps.audit.services import log_audit_event
+from apps.companies.models import Company, Sitec
+
+from .identity import get_request_identity, get_request_profile
+from .middleware import CompanySitecMiddleware
+from .models import AccessPolicy, UserProfile
+from .services import evaluate_access_policy
+
+User = get_user_model()
+
+
+class RequestIdentityTests(TestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.company = Company.objects.create(name="SITEC", status="active")
+        self.sitec = Sitec.objects.create(company=self.company, schema_name="sitec", status="active")
+        self.user = User.objects.create_user(username="pm_identity", password="test123")
+        self.profile = UserProfile.objects.create(user=self.user, company=self.company, role="pm")
+        AccessPolicy.objects.create(company=self.company, action="*", effect="allow", priority=0)
+
+    def test_identity_resolved_once_per_request(self):
+        request = self.factory.get("/api/projects/")
+        request.user = self.user
+
+        with self.assertNumQueries(1):
+            identity = get_request_identity(request)
+            self.assertEqual(identity.role, "pm")
+            self.assertEqual(identity.company, self.company)
+            self.assertEqual(get_request_profile(request), self.profile)
+        self.assertIs(request.identity, identity)
+
+    def test_sitec_is_resolved_lazily(self):
+        request = self.factory.get("/api/projects/")
+        request.user = self.user
+        identity = get_request_identity(request)
+
+        with self.assertNumQueries(1):
+            self.assertEqual(identity.sitec, self.sitec)
+            self.assertEqual(identity.sitec, self.sitec)
+
+    def test_middleware_abac_and_audit_share_identity(self):
+        request = self.factory.get("/api/projects/")
+        request.user = self.user
+        middleware = CompanySitecMiddleware(lambda req: req)
+        middleware(request)
+        self.assertEqual(request.company, self.company)
+        self.assertEqual(request.sitec, self.sitec)
+
+        get_request_identity(request)
+        evaluate_access_policy(request, "projects.view")
+        with self.assertNumQueries(0):
+            for action in ("projects.view", "projects.create", "reports.view"):
+                evaluate_access_policy(request, action)
+
+        with self.assertNumQueries(1):
+            log_audit_event(request, "identity_test", self.profile)
+        self.assertEqual(AuditLog.objects.get(action="identity_test").company, self.company)
+
+    def test_identity_follows_user_change(self):
+        request = self.factory.get("/api/projects/")
+        request.user = AnonymousUser()
+        self.assertIsNone(get_request_identity(request).profile)
+
+        request.user = self.user
+        self.assertEqual(get_request_identity(request).profile, self.profile)
+
+    def test_user_without_profile(self):
+        other = User.objects.create_user(username="sin_perfil", password="test123")
+        request = self.factory.get("/api/projects/")
+        request.user = other
+        identity = get_request_identity(request)
+        self.assertIsNone(identity.profile)
+        self.assertIsNone(identity.company)
+        self.assertIsNone(identity.role)
+        self.assertIsNone(identity.sitec)
@@ -0,0 +1,391 @@
+"""
+Tests para métricas de observabilidad (histogramas de latencia)
+"""
+import tempfile
+from unittest.mock import patch
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import connection
+from django.http import StreamingHttpResponse
+from django.test import RequestFactory, TestCase, override_settings
+from rest_framework.test import APITestCase
+
+from . import latency_histogram
+from .latency_histogram import (
+    BUCKET_BOUNDS,
+    ENDPOINTS_KEY,
+    SLOT_SECONDS,
+    Histogram,
+    bucket_index,
+    load_histograms,
+    record_latency,
+)
+from apps.companies.models import Company, Sitec
+
+from .celery_metrics import get_celery_task_counters
+from .metrics_registry import COUNTERS_INDEX_KEY, MetricsRegistry, registry
+from .middleware_query_budget import QueryBudgetMiddleware, fingerprint, get_query_metrics
+from .models import AccessPolicy, UserProfile
+from .middleware_observability import RequestMetricsView
+
+User = get_user_model()
+
+
+class LatencyHistogramTests(TestCase):
+    def setUp(self):
+        # Descartar incrementos pendientes de otros tests
+        registry.flush()
+        cache.clear()
+
+    def test_bucket_index_is_log_scale(self):
+        self.assertEqual(bucket_index(0.1), 0)
+        self.assertEqual(bucket_index(BUCKET_BOUNDS[10]), 10)
+        self.assertEqual(bucket_index(BUCKET_BOUNDS[10] * 1.01), 11)
+        self.assertEqual(bucket_index(10_000_000), len(BUCKET_BOUNDS))
+
+    def test_percentiles_capture_tail(self):
+        histogram = Histogram()
+        for _ in range(98):
+            histogram.counts[bucket_index(10)] += 1
+        for _ in range(2):
+            histogram.counts[bucket_index(2000)] += 1
+        self.assertLess(histogram.percentile(50), 15)
+        self.assertLess(histogram.percentile(90), 15)
+        self.assertGreater(histogram.percentile(99), 1000)
+
+    def test_window_by_hours(self):
+        now = 1_800_000_123.0
+        record_latency("GET:dashboard.kpi", 200, 20, now=now - 2 * SLOT_SECONDS)
+        record_latency("GET:dashboard.kpi", 200, 20, now=now)
+        record_latency("GET:dashboard.kpi", 503, 40, now=now)
+
+        histograms, _ = load_histograms(["GET:dashboard.kpi"], hours=1, now=now)
+        self.assertEqual(histograms["GET:dashboard.kpi"]["2xx"].count, 1)
+        self.assertEqual(histograms["GET:dashboard.kpi"]["5xx"].count, 1)
+
+        histograms, window = load_histograms(["GET:dashboard.kpi"], hours=3, now=now)
+        self.assertEqual(histograms["GET:dashboard.kpi"]["2xx"].count, 2)
+        self.assertGreater(window, 2 * SLOT_SECONDS)
+
+    def test_load_reads_cache_in_batches(self):
+        now = 1_800_000_123.0
+        for endpoint in ("GET:projects", "GET:reports", "GET:risks"):
+            record_latency(endpoint, 200, 20, now=now)
+        registry.flush()
+        with patch.object(latency_histogram, "LOAD_BATCH_SIZE", 50), patch.object(
+            cache, "get_many", wraps=cache.get_many
+        ) as get_many:
+            histograms, _ = load_histograms(["GET:projects", "GET:reports", "GET:risks"], hours=3, now=now)
+        # Un lote se cierra al superar el límite: como mucho un slot (42 claves) de más
+        self.assertLess(max(len(call.args[0]) for call in get_many.call_args_list), 50 + 42)
+        self.assertGreater(get_many.call_count, 1)
+        for endpoint in ("GET:projects", "GET:reports", "GET:risks"):
+            self.assertEqual(histograms[endpoint]["2xx"].count, 1)
+
+    def test_endpoint_index_recovers_from_lost_write(self):
+        record_latency("GET:projects", 200, 12)
+        registry.flush()
+        # Otro worker sobrescribió el índice con su propia lista
+        cache.set(ENDPOINTS_KEY, ["GET:reports"], timeout=None)
+        registry.flush()
+        self.assertLessEqual({"GET:projects", "GET:reports"}, set(cache.get(ENDPOINTS_KEY)))
+
+    def test_get_metrics_reports_percentiles(self):
+        for duration in (5, 10, 15, 900):
+            record_latency("GET:projects", 200, duration)
+        record_latency("GET:projects", 404, 3)
+
+        metrics = RequestMetricsView.get_metrics(hours=1)
+        data = metrics["endpoints"]["GET:projects"]
+        self.assertEqual(data["requests"], 5)
+        self.assertEqual(data["errors"], 1)
+        self.assertEqual(set(data["status_classes"]), {"2xx", "4xx"})
+        self.assertGreater(data["p99_response_time_ms"], 500)
+        self.assertIn("p50_response_time_ms", metrics["summary"])
+        self.assertEqual(metrics["summary"]["total_requests"], 5)
+
+
+class MetricsRegistryTests(TestCase):
+    def setUp(self):
+        # Descartar incrementos pendientes de otros tests
+        registry.flush()
+        cache.clear()
+
+    def test_request_path_does_not_touch_cache(self):
+        registry.flush()
+        with patch.object(cache, "incr") as incr, patch.object(cache, "get") as get:
+            record_latency("GET:projects", 200, 12)
+        incr.assert_not_called()
+        get.assert_not_called()
+
+    def test_counters_merge_across_workers(self):
+        workers = [MetricsRegistry() for _ in range(3)]
+        for worker in workers:
+            for _ in range(5):
+                worker.incr("requests")
+        for worker in workers:
+            worker.flush()
+        self.assertEqual(workers[0].get_counters(["requests"]), {"requests": 15})
+
+    def test_counter_index_recovers_from_lost_write(self):
+        worker = MetricsRegistry()
+        worker.incr("requests")
+        worker.flush()
+        cache.set(COUNTERS_INDEX_KEY, ["other"], timeout=None)
+        worker.flush()
+        self.assertEqual(set(cache.get(COUNTERS_INDEX_KEY)), {"requests", "other"})
+
+    def test_flush_is_incremental(self):
+        worker = MetricsRegistry()
+        worker.incr("requests", 2)
+        worker.flush()
+        worker.flush()
+        worker.incr("requests")
+        self.assertEqual(worker.get_counters(["requests"])["requests"], 3)
+
+
+class ObservabilityMiddlewareTests(APITestCase):
+    def setUp(self):
+        # Descartar incrementos pendientes de otros tests
+        registry.flush()
+        cache.clear()
+        self.user = User.objects.create_user(username="metrics_user", password="test123")
+        self.client.force_authenticate(user=self.user)
+
+    def test_requests_are_recorded(self):
+        self.client.get("/api/metrics/")
+        response = self.client.get("/api/metrics/", {"hours": 2})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["window_hours"], 2)
+        self.assertEqual(response.data["endpoints"]["GET:metrics"]["requests"], 1)
+
+    def test_endpoints_keyed_by_route_name(self):
+        self.client.get("/api/policies/00000000-0000-0000-0000-000000000001/")
+        self.client.get("/api/policies/00000000-0000-0000-0000-000000000002/")
+        self.client.get("/api/no-existe/123/")
+        endpoints = RequestMetricsView.get_metrics()["endpoints"]
+        self.assertEqual(endpoints["GET:policy-detail"]["requests"], 2)
+        self.assertEqual(endpoints["GET:unmatched"]["errors"], 1)
+        self.assertFalse(any("00000000" in name for name in endpoints))
+
+
+class PrometheusExpositionTests(APITestCase):
+    def setUp(self):
+        registry.flush()
+        cache.clear()
+        self.user = User.objects.create_user(username="prom_user", password="test123")
+
+    def test_text_format_series(self):
+        record_latency("GET:user-context", 200, 12)
+        record_latency("GET:user-context", 500, 30)
+        self.client.force_authenticate(user=self.user)
+        response = self.client.get("/api/metrics/prometheus/")
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response["Content-Type"].startswith("text/plain; version=0.0.4"))
+        body = response.content.decode()
+        self.assertIn('sitec_http_requests_total{route="user-context",method="GET",status_class="2xx"} 1', body)
+        self.assertIn('sitec_http_request_errors_total{route="user-context",method="GET"} 1', body)
+        self.assertIn('sitec_http_request_duration_seconds_bucket{route="user-context",method="GET",le="+Inf"} 2', body)
+        self.assertIn('sitec_http_requests_in_flight{route="metrics-prometheus",method="GET"} 1', body)
+
+    def test_requires_auth_or_scrape_token(self):
+        self.assertIn(self.client.get("/api/metrics/prometheus/").status_code, (401, 403))
+        with override_settings(METRICS_SCRAPE_TOKEN="s3cret"):
+            response = self.client.get(
+                "/api/metrics/prometheus/", HTTP_AUTHORIZATION="Bearer s3cret"
+            )
+            self.assertEqual(response.status_code, 200)
+            response = self.client.get(
+                "/api/metrics/prometheus/", HTTP_AUTHORIZATION="Bearer otro"
+            )
+            self.assertIn(response.status_code, (401, 403))
+
+    def test_celery_task_counters(self):
+        from celery.signals import task_failure, task_prerun
+
+        from apps.dashboard.tasks import refresh_dashboard_snapshots as task
+
+        task_prerun.send(sender=task, task_id="1", task=task)
+        task_prerun.send(sender=task, task_id="2", task=task)
+        task_failure.send(sender=task, task_id="2", exception=ValueError())
+        counters = get_celery_task_counters()[task.name]
+        self.assertEqual(counters["started"], 2)
+        self.assertEqual(counters["failed"], 1)
+
+        self.client.force_authenticate(user=self.user)
+        body = self.client.get("/api/metrics/prometheus/").content.decode()
+        self.assertIn(f'sitec_celery_tasks_total{{task="{task.name}",state="started"}} 2', body)
+
+
+@override_settings(SERVER_TIMING_ENABLED=True)
+class QueryBudgetMiddlewareTests(APITestCase):
+    def setUp(self):
+        registry.flush()
+        cache.clear()
+        self.user = User.objects.create_user(
+            username="budget_user", password="test123", is_staff=True
+        )
+        self.client.force_authenticate(user=self.user)
+
+    def test_fingerprint_normalizes_literals_and_in_lists(self):
+        self.assertEqual(
+            fingerprint("SELECT * FROM t WHERE id IN (%s, %s, %s) AND name = 'x' LIMIT 21"),
+            "SELECT * FROM t WHERE id IN (...) AND name = ? LIMIT ?",
+        )
+
+    def test_headers_and_registry(self):
+        response = self.client.get("/api/users/me/")
+        queries = int(response["X-DB-Queries"])
+        self.assertGreater(queries, 0)
+        self.assertIn("db;dur=", response["Server-Timing"])
+        self.assertEqual(get_query_metrics()["GET:me"]["queries"], queries)
+
+    def test_headers_hidden_from_regular_users(self):
+        self.user.is_staff = False
+        self.user.save()
+        response = self.client.get("/api/users/me/")
+        self.assertNotIn("X-DB-Queries", response)
+        self.assertNotIn("X-DB-Time-ms", response)
+        self.assertGreater(get_query_metrics()["GET:me"]["queries"], 0)
+
+    def test_streaming_queries_counted_when_stream_closes(self):
+        def streaming_view(request):
+            def rows():
+                yield str(User.objects.count())
+                yield str(User.objects.count())
+
+            return StreamingHttpResponse(rows())
+
+        request = RequestFactory().get("/stream/")
+        response = QueryBudgetMiddleware(streaming_view)(request)
+        self.assertEqual(request.db_queries.count, 0)
+        self.assertNotIn("X-DB-Queries", response)
+
+        self.assertEqual(b"".join(response.streaming_content), b"11")
+        response.close()
+        self.assertEqual(request.db_queries.count, 2)
+        self.assertEqual(connection.execute_wrappers, [])
+        self.assertEqual(get_query_metrics()["GET:unmatched"]["queries"], 2)
+
+    def test_unconsumed_stream_releases_wrapper_on_close(self):
+        request = RequestFactory().get("/stream/")
+        response = QueryBudgetMiddleware(lambda request: StreamingHttpResponse(iter(["x"])))(request)
+        response.close()
+        self.assertEqual(connection.execute_wrappers, [])
+
+    def test_budget_exceeded_logs_repeated_fingerprints(self):
+        with override_settings(DB_QUERY_BUDGETS={"me": 0}):
+            with self.assertLogs("apps.accounts.middleware_query_budget", level="WARNING") as logs:
+                self.client.get("/api/users/me/")
+        record = logs.records[0]
+        self.assertEqual(record.db_query_budget["endpoint"], "GET:me")
+        self.assertEqual(record.db_query_budget["budget"], 0)
+        self.assertIn("top_repeated", record.db_query_budget)
+        self.assertEqual(get_query_metrics()["GET:me"]["budget_exceeded"], 1)
+
+
+class ProfilingTests(APITestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        overrides = override_settings(PROFILING_DIR=self.tmpdir.name)
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        company = Company.objects.create(name="SITEC", status="active")
+        Sitec.objects.create(company=company, schema_name="sitec", status="active")
+        self.admin = User.objects.create_superuser(username="prof_admin", password="test123")
+        self.user = User.objects.create_user(username="prof_user", password="test123")
+        UserProfile.objects.create(user=self.admin, company=company, role="admin_empresa")
+        UserProfile.objects.create(user=self.user, company=company, role="pm")
+
+    def test_on_demand_profile_for_superuser(self):
+        self.client.force_login(self.admin)
+        response = self.client.get("/api/users/me/", HTTP_X_PROFILE="1")
+        profile_id = response["X-Profile-Id"]
+        self.assertIn("_GET_me_", profile_id)
+
+        listing = self.client.get("/api/metrics/profiles/").json()["profiles"]
+        self.assertEqual([item["id"] for item in listing], [profile_id])
+        self.assertEqual(listing[0]["trigger"], "on-demand")
+
+        text = self.client.get(f"/api/metrics/profiles/{profile_id}/", {"output": "text"})
+        self.assertIn("cumulative", text.content.decode())
+        download = self.client.get(f"/api/metrics/profiles/{profile_id}/")
+        self.assertEqual(download.status_code, 200)
+        self.assertIn("attachment", download["Content-Disposition"])
+
+    def test_header_ignored_for_regular_users(self):
+        self.client.force_login(self.user)
+        response = self.client.get("/api/users/me/", HTTP_X_PROFILE="1")
+        self.assertNotIn("X-Profile-Id", response)
+        self.assertEqual(self.client.get("/api/metrics/profiles/").status_code, 403)
+
+    def test_sampled_requests_kept_only_when_slow(self):
+        self.client.force_login(self.user)
+        with override_settings(PROFILING_SAMPLE_RATE=1, OBS_SLOW_REQUEST_MS=60_000):
+            self.client.get("/api/users/me/")
+        self.client.force_login(self.admin)
+        self.assertEqual(self.client.get("/api/metrics/profiles/").json()["profiles"], [])
+
+        with override_settings(PROFILING_SAMPLE_RATE=1, OBS_SLOW_REQUEST_MS=0, PROFILING_MAX_FILES=2):
+            for _ in range(3):
+                self.client.get("/api/users/me/")
+        profiles = self.client.get("/api/metrics/profiles/").json()["profiles"]
+        self.assertEqual(len(profiles), 2)
+        self.assertTrue(all(item["trigger"] == "slow-sample" for item in profiles))
+
+    def test_invalid_profile_id(self):
+        self.client.force_login(self.admin)
+        self.assertEqual(self.client.get("/api/metrics/profiles/..%2Fsettings/").status_code, 404)
+
+
+@override_settings(SERVER_TIMING_ENABLED=True)
+class ServerTimingTests(APITestCase):
+    def setUp(self):
+        registry.flush()
+        cache.clear()
+        company = Company.objects.create(name="SITEC", status="active")
+        Sitec.objects.create(company=company, schema_name="sitec", status="active")
+        self.user = User.objects.create_user(
+            username="timing_user", password="test123", is_staff=True
+        )
+        UserProfile.objects.create(user=self.user, company=company, role="pm")
+        AccessPolicy.objects.create(company=company, action="*", effect="allow", priority=0)
+        self.client.force_login(self.user)
+
+    def _phases(self, response):
+        return {entry.split(";")[0].strip() for entry in response["Server-Timing"].split(",")}
+
+    def test_phase_breakdown(self):
+        response = self.client.get("/api/policies/")
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(
+            {"auth", "tenant", "abac", "view", "render", "db", "total"} <= self._phases(response)
+        )
+        data = self.client.get("/api/metrics/").json()["phases"]["GET:policy-list"]
+        self.assertEqual(data["view"]["count"], 1)
+        self.assertEqual(data["render"]["count"], 1)
+
+    def test_single_response_time_header(self):
+        response = self.client.get("/api/policies/")
+        self.assertEqual(len(response.headers.get("X-Response-Time-ms").split(",")), 1)
+        total = float(response["Server-Timing"].split("total;dur=")[1])
+        self.assertAlmostEqual(float(response["X-Response-Time-ms"]), total, places=2)
+
+    def test_header_hidden_from_regular_users(self):
+        self.user.is_staff = False
+        self.user.save()
+        response = self.client.get("/api/policies/")
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn("Server-Timing", response)
+        self.assertIn("X-Response-Time-ms", response)
+
+    @override_settings(SERVER_TIMING_ENABLED=False)
+    def test_disabled_by_setting(self):
+        self.assertNotIn("Server-Timing", self.client.get("/api/policies/"))
+
+    @override_settings(RATE_LIMIT_ENABLED=True)
+    def test_rate_limit_phase(self):
+        response = self.client.get("/api/policies/")
+        self.assertIn("ratelimit", self._phases(response))
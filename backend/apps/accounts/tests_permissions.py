@@ -2,11 +2,15 @@
 Tests para el sistema de permisos ABAC y evaluación de políticas
 """
 from django.contrib.auth import get_user_model
+from django.test import RequestFactory, override_settings
 from rest_framework.test import APITestCase
 
 from apps.companies.models import Company, Sitec
 
 from .models import AccessPolicy, UserProfile
+from .decision_cache import get_decision_cache_stats
+from .policy_index import clear_local_index, get_compiled_policies, get_policy_version
+from .services import evaluate_access_policies, evaluate_access_policy, get_user_permissions
 
 
 User = get_user_model()
@@ -233,3 +237,186 @@ class AccessPolicyEvaluateViewTests(APITestCase):
         data = response.json()
         # Admin siempre tiene acceso
         self.assertTrue(data["allowed"])
+
+
+class CompiledPolicyIndexTests(APITestCase):
+    """Tests para el índice compilado de políticas por company"""
+
+    def setUp(self):
+        self.company = Company.objects.create(name="SITEC Index", status="active")
+        AccessPolicy.objects.create(
+            company=self.company, action="*", effect="allow", priority=0, is_active=True
+        )
+        self.wizard_deny = AccessPolicy.objects.create(
+            company=self.company,
+            action="wizard.*",
+            conditions={"role": ["cliente"]},
+            effect="deny",
+            priority=10,
+            is_active=True,
+        )
+        AccessPolicy.objects.create(
+            company=self.company,
+            action="transactions.read",
+            conditions={"role": "cliente"},
+            effect="allow",
+            priority=5,
+            is_active=True,
+        )
+
+    def test_candidates_follow_priority_order(self):
+        compiled = get_compiled_policies(self.company.id)
+        actions = [policy.action for policy in compiled.candidates("wizard.save")]
+        self.assertEqual(actions, ["wizard.*", "*"])
+        self.assertEqual(
+            [policy.action for policy in compiled.candidates("read")],
+            ["transactions.read", "*"],
+        )
+
+    def test_conditions_are_precompiled(self):
+        compiled = get_compiled_policies(self.company.id)
+        policy = compiled.exact["wizard.*"][0]
+        self.assertTrue(policy.matches({"role": "cliente"}))
+        self.assertFalse(policy.matches({"role": "pm"}))
+        self.assertIn("transactions", compiled.read_only)
+
+    def test_compiled_index_is_reused_until_policy_changes(self):
+        first = get_compiled_policies(self.company.id)
+        with self.assertNumQueries(0):
+            self.assertIs(get_compiled_policies(self.company.id), first)
+
+        self.wizard_deny.is_active = False
+        self.wizard_deny.save()
+        second = get_compiled_policies(self.company.id)
+        self.assertIsNot(second, first)
+        self.assertNotIn("wizard.*", second.exact)
+
+    def test_delete_invalidates_index(self):
+        first = get_compiled_policies(self.company.id)
+        version = get_policy_version(self.company.id)
+        self.wizard_deny.delete()
+        self.assertNotEqual(get_policy_version(self.company.id), version)
+        self.assertEqual(len(get_compiled_policies(self.company.id).policies), len(first.policies) - 1)
+
+
+class BatchPolicyEvaluationTests(APITestCase):
+    """Tests para la evaluación por lotes de políticas"""
+
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.company = Company.objects.create(name="SITEC Batch", status="active")
+        self.user = User.objects.create_user(username="pm_batch", password="password123")
+        UserProfile.objects.create(user=self.user, company=self.company, role="pm")
+        AccessPolicy.objects.create(company=self.company, action="*", effect="allow", priority=0)
+        AccessPolicy.objects.create(
+            company=self.company,
+            action="roi.*",
+            conditions={"role": ["pm", "supervisor"]},
+            effect="deny",
+            priority=20,
+        )
+        AccessPolicy.objects.create(
+            company=self.company,
+            action="reports.approve",
+            conditions={"role": "tecnico"},
+            effect="deny",
+            priority=10,
+        )
+
+    def _request(self):
+        request = self.factory.get("/dashboard/")
+        request.user = self.user
+        return request
+
+    def test_batch_matches_single_evaluation(self):
+        actions = ["roi.view", "roi.export", "reports.approve", "projects.create", "update"]
+        batch = evaluate_access_policies(self._request(), actions)
+        self.assertEqual(list(batch), actions)
+        for action in actions:
+            self.assertEqual(batch[action], evaluate_access_policy(self._request(), action))
+        self.assertFalse(batch["roi.view"].allowed)
+        self.assertTrue(batch["reports.approve"].allowed)
+
+    def test_user_permissions_use_single_profile_lookup(self):
+        request = self._request()
+        get_user_permissions(request)  # Compila el índice de políticas
+        request = self._request()
+        with self.assertNumQueries(1):
+            permissions = get_user_permissions(request)
+        self.assertFalse(permissions["roi.view"])
+        self.assertTrue(permissions["dashboard.view"])
+
+
+class SharedDecisionCacheTests(APITestCase):
+    """Tests para el cache compartido de decisiones ABAC"""
+
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.company = Company.objects.create(name="SITEC Decisions", status="active")
+        self.user = User.objects.create_user(username="sup_cache", password="password123")
+        self.profile = UserProfile.objects.create(
+            user=self.user, company=self.company, role="supervisor"
+        )
+        AccessPolicy.objects.create(company=self.company, action="*", effect="allow", priority=0)
+        AccessPolicy.objects.create(
+            company=self.company,
+            action="reports.approve",
+            conditions={"role": "tecnico"},
+            effect="deny",
+            priority=10,
+        )
+
+    def _request(self, method="get"):
+        request = getattr(self.factory, method)("/api/reports/")
+        request.user = self.user
+        return request
+
+    def test_cold_worker_reuses_shared_decisions(self):
+        expected = evaluate_access_policies(self._request(), ["reports.approve", "roi.view"])
+        clear_local_index()
+        with self.assertNumQueries(1):  # Solo el perfil del request
+            decisions = evaluate_access_policies(self._request(), ["reports.approve", "roi.view"])
+        self.assertEqual(decisions, expected)
+
+    def test_policy_change_invalidates_decisions(self):
+        self.assertTrue(evaluate_access_policy(self._request(), "reports.approve").allowed)
+        AccessPolicy.objects.create(
+            company=self.company,
+            action="reports.approve",
+            conditions={"role": "supervisor"},
+            effect="deny",
+            priority=20,
+        )
+        self.assertFalse(evaluate_access_policy(self._request(), "reports.approve").allowed)
+
+    def test_profile_change_uses_new_key(self):
+        self.assertTrue(evaluate_access_policy(self._request(), "reports.approve").allowed)
+        self.profile.role = "tecnico"
+        self.profile.save()
+        self.assertFalse(evaluate_access_policy(self._request(), "reports.approve").allowed)
+
+    def test_extra_condition_keys_are_part_of_key(self):
+        AccessPolicy.objects.create(
+            company=self.company,
+            action="reports.view",
+            conditions={"method": "post"},
+            effect="deny",
+            priority=10,
+        )
+        self.assertTrue(evaluate_access_policy(self._request("get"), "reports.view").allowed)
+        self.assertFalse(evaluate_access_policy(self._request("post"), "reports.view").allowed)
+
+    def test_hits_and_misses_are_counted(self):
+        before = get_decision_cache_stats()
+        evaluate_access_policy(self._request(), "projects.view")
+        evaluate_access_policy(self._request(), "projects.view")
+        after = get_decision_cache_stats()
+        self.assertEqual(after["misses"] - before["misses"], 1)
+        self.assertEqual(after["hits"] - before["hits"], 1)
+
+    @override_settings(ABAC_DECISION_CACHE_ENABLED=False)
+    def test_cache_can_be_disabled(self):
+        evaluate_access_policy(self._request(), "projects.view")
+        clear_local_index()
+        with self.assertNumQueries(2):
+            evaluate_access_policy(self._request(), "projects.view")
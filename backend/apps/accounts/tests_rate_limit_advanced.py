@@ -1,12 +1,21 @@
 """
 Tests para Rate Limiting Avanzado
 """
+from unittest.mock import patch
+
 from django.contrib.auth import get_user_model
 from django.test import TestCase, override_settings
 from django.core.cache import cache
 from rest_framework.test import APITestCase
 
+from apps.accounts.middleware_rate_limit import EndpointMatcher
 from apps.accounts.models import AccessPolicy, UserProfile
+from apps.accounts.rate_limit_engine import (
+    BoundedLRU,
+    LimitRule,
+    LocalTokenBucketLimiter,
+    SlidingWindowLimiter,
+)
 from apps.companies.models import Company, Sitec
 
 User = get_user_model()
@@ -243,3 +252,187 @@ class AdvancedRateLimitTests(APITestCase):
             self.assertIn("limit", data)
             self.assertIn("remaining", data)
             self.assertIn("reset_at", data)
+
+
+class SlidingWindowLimiterTests(TestCase):
+    """Tests para el motor de ventana deslizante con contadores atómicos"""
+
+    def setUp(self):
+        cache.clear()
+        self.limiter = SlidingWindowLimiter(sub_windows=10)
+        self.rules = [LimitRule("ip", "10.0.0.1", 3, 60)]
+
+    def test_blocks_after_limit_and_rejections_do_not_consume(self):
+        now = 1_000_000.0
+        results = [self.limiter.hit(self.rules, "/api/x/", "GET", now=now) for _ in range(3)]
+        self.assertEqual([r["remaining"] for r in results], [2, 1, 0])
+        self.assertFalse(any(r["limited"] for r in results))
+
+        for _ in range(3):
+            blocked = self.limiter.hit(self.rules, "/api/x/", "GET", now=now)
+            self.assertTrue(blocked["limited"])
+            self.assertEqual(blocked["type"], "ip")
+        self.assertEqual(cache.get("rl:ip:10.0.0.1:/api/x/:GET:6:166666"), 3)
+
+    def test_window_slides(self):
+        now = 1_000_002.0
+        for _ in range(3):
+            self.limiter.hit(self.rules, "/api/x/", "GET", now=now)
+        self.assertTrue(self.limiter.hit(self.rules, "/api/x/", "GET", now=now + 30)["limited"])
+        self.assertFalse(self.limiter.hit(self.rules, "/api/x/", "GET", now=now + 67)["limited"])
+
+    def test_most_restrictive_rule_wins(self):
+        rules = [LimitRule("ip", "10.0.0.2", 100, 60), LimitRule("user", "user:1", 2, 60)]
+        first = self.limiter.hit(rules, "/api/x/", "GET")
+        self.assertEqual(first["limit"], 2)
+        self.assertEqual(first["remaining"], 1)
+        self.limiter.hit(rules, "/api/x/", "GET")
+        blocked = self.limiter.hit(rules, "/api/x/", "GET")
+        self.assertTrue(blocked["limited"])
+        self.assertEqual(blocked["type"], "user")
+
+    def test_single_round_trip_for_previous_buckets(self):
+        rules = [LimitRule("ip", "10.0.0.3", 10, 60), LimitRule("user", "user:2", 10, 60)]
+        with patch.object(cache, "get_many", wraps=cache.get_many) as get_many:
+            self.limiter.hit(rules, "/api/x/", "GET")
+        get_many.assert_called_once()
+
+
+class EndpointMatcherTests(TestCase):
+    """Tests para el matcher precompilado de RATE_LIMIT_ENDPOINTS"""
+
+    def setUp(self):
+        self.default = {"ip": {"requests": 100, "window": 60}}
+        self.login = {"ip": {"requests": 5, "window": 60}}
+        self.api_get = {"ip": {"requests": 50, "window": 60}}
+        self.api_default = {"ip": {"requests": 20, "window": 60}}
+        self.export = {"ip": {"requests": 2, "window": 60}}
+        self.matcher = EndpointMatcher(
+            {
+                "/api/*": {"GET": self.api_get, "default": self.api_default},
+                "*/export/": self.export,
+                "/api/token/": self.login,
+            },
+            ["/health/", "/static/*", "*.map"],
+            self.default,
+        )
+
+    def test_exact_match_takes_precedence(self):
+        self.assertIs(self.matcher.resolve("/api/token/", "POST"), self.login)
+
+    def test_first_declared_wildcard_wins(self):
+        self.assertIs(self.matcher.resolve("/api/reports/export/", "GET"), self.api_get)
+        self.assertIs(self.matcher.resolve("/reports/export/", "GET"), self.export)
+
+    def test_method_config_resolution(self):
+        self.assertIs(self.matcher.resolve("/api/projects/", "GET"), self.api_get)
+        self.assertIs(self.matcher.resolve("/api/projects/", "POST"), self.api_default)
+
+    def test_excluded_and_default(self):
+        self.assertIsNone(self.matcher.resolve("/health/", "GET"))
+        self.assertIsNone(self.matcher.resolve("/static/app.js", "GET"))
+        self.assertIsNone(self.matcher.resolve("/assets/app.js.map", "GET"))
+        self.assertIs(self.matcher.resolve("/health/detailed/", "GET"), self.default)
+        self.assertIs(self.matcher.resolve("/dashboard/", "GET"), self.default)
+
+
+class LocalTokenBucketLimiterTests(TestCase):
+    """Tests para el modo de dos niveles (token bucket local + reconciliación)"""
+
+    def setUp(self):
+        cache.clear()
+        self.rules = [LimitRule("ip", "10.0.1.1", 10, 60)]
+
+    def _limiter(self, **kwargs):
+        options = {"sync_interval_ms": 1000, "sync_requests": 5, "over_admission": 0.5}
+        options.update(kwargs)
+        return LocalTokenBucketLimiter(sub_windows=10, **options)
+
+    def test_decides_locally_between_syncs(self):
+        limiter = self._limiter()
+        now = 2_000_000.0
+        with patch.object(cache, "incr", wraps=cache.incr) as incr, patch.object(
+            cache, "get_many", wraps=cache.get_many
+        ) as get_many:
+            results = [limiter.hit(self.rules, "/api/x/", "GET", now=now) for _ in range(5)]
+        self.assertEqual([r["remaining"] for r in results], [9, 8, 7, 6, 5])
+        # Solo la sincronización inicial toca el cache compartido
+        self.assertEqual(get_many.call_count, 1)
+        incr.assert_not_called()
+
+    def test_blocks_and_reconciles_consumption(self):
+        limiter = self._limiter()
+        now = 2_000_000.0
+        results = [limiter.hit(self.rules, "/api/x/", "GET", now=now) for _ in range(12)]
+        self.assertEqual(sum(1 for r in results if not r["limited"]), 10)
+        self.assertEqual(results[-1]["type"], "ip")
+        limiter.flush(now=now)
+        self.assertEqual(cache.get("rl:ip:10.0.1.1:/api/x/:GET:6:333333"), 10)
+
+    def test_over_admission_is_bounded_across_workers(self):
+        workers = [self._limiter(sync_interval_ms=60_000) for _ in range(3)]
+        now = 2_000_000.0
+        admitted = 0
+        for _ in range(10):
+            for worker in workers:
+                if not worker.hit(self.rules, "/api/x/", "GET", now=now)["limited"]:
+                    admitted += 1
+        # Cada worker admite como máximo max_requests * over_admission sin reconciliar
+        self.assertGreaterEqual(admitted, 10)
+        self.assertLessEqual(admitted, 10 + 3 * 5)
+
+    def test_zero_tolerance_syncs_every_request(self):
+        workers = [self._limiter(over_admission=0) for _ in range(2)]
+        now = 2_000_000.0
+        admitted = sum(
+            1
+            for _ in range(10)
+            for worker in workers
+            if not worker.hit(self.rules, "/api/x/", "GET", now=now)["limited"]
+        )
+        self.assertLessEqual(admitted, 11)
+
+
+    def test_evicted_bucket_flushes_pending(self):
+        limiter = self._limiter(max_keys=1)
+        now = 2_000_000.0
+        for _ in range(3):
+            limiter.hit(self.rules, "/api/x/", "GET", now=now)
+        # Otra clave desplaza a la anterior del LRU: su consumo no se pierde
+        limiter.hit([LimitRule("ip", "10.0.1.2", 10, 60)], "/api/x/", "GET", now=now)
+        self.assertEqual(cache.get("rl:ip:10.0.1.1:/api/x/:GET:6:333333"), 3)
+
+    def test_idle_flush_writes_pending(self):
+        limiter = self._limiter(sync_interval_ms=0)
+        now = 2_000_000.0
+        limiter.hit(self.rules, "/api/x/", "GET", now=now)
+        limiter.flush(now=now, idle_only=True)
+        self.assertEqual(cache.get("rl:ip:10.0.1.1:/api/x/:GET:6:333333"), 1)
+
+    def test_cache_io_runs_outside_lock(self):
+        limiter = self._limiter(sync_requests=1, over_admission=0)
+        now = 2_000_000.0
+        held = []
+        original = limiter.store.get_many
+
+        def get_many(keys):
+            held.append(limiter._lock.locked())
+            return original(keys)
+
+        with patch.object(limiter.store, "get_many", side_effect=get_many):
+            for _ in range(3):
+                limiter.hit(self.rules, "/api/x/", "GET", now=now)
+        self.assertTrue(held)
+        self.assertFalse(any(held))
+
+class BoundedLRUTests(TestCase):
+    def test_evicts_least_recently_used(self):
+        lru = BoundedLRU(max_size=2)
+        lru.set("a", 1)
+        lru.set("b", 2)
+        lru.get("a")
+        lru.set("c", 3)
+        self.assertEqual(len(lru), 2)
+        self.assertNotIn("b", lru)
+        self.assertEqual(lru.get("a"), 1)
+        self.assertEqual(lru.get("c"), 3)
@@ -1,3 +1,7 @@
+import hashlib
+
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.utils.http import parse_etags, quote_etag
 from rest_framework import status, viewsets
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
@@ -5,7 +9,9 @@ from rest_framework.views import APIView
 
 from apps.audit.services import log_audit_event
 
+from .identity import get_request_profile
 from .models import AccessPolicy, UserProfile
+from .policy_index import get_policy_version
 from .services import action_from_request, evaluate_access_policy, get_ui_config_for_role, get_user_permissions
 from .permissions import AccessPolicyPermission
 from .serializers import AccessPolicySerializer, UserProfileSerializer
@@ -71,25 +77,36 @@ class UserContextView(APIView):
     """
     Endpoint que devuelve el contexto completo del usuario para el frontend.
     Incluye información del usuario, permisos y configuración de UI.
+    Soporta GET condicional: el ETag cambia con el usuario, su perfil, el
+    sitec activo y la versión de políticas de la company, de modo que el
+    frontend/PWA revalida con If-None-Match y recibe 304 sin recalcular nada.
     """
     permission_classes = [IsAuthenticated]
 
     def get(self, request):
-        try:
-            profile = UserProfile.objects.select_related("company", "user").get(user=request.user)
-        except UserProfile.DoesNotExist:
+        profile = get_request_profile(request)
+        if profile is None:
             return Response(
                 {"error": "User profile not found"},
                 status=status.HTTP_404_NOT_FOUND
             )
 
+        etag = self._get_etag(request, profile)
+        if_none_match = request.META.get("HTTP_IF_NONE_MATCH")
+        if if_none_match:
+            client_etags = parse_etags(if_none_match)
+            if "*" in client_etags or etag in client_etags:
+                return self._with_cache_headers(
+                    Response(status=status.HTTP_304_NOT_MODIFIED), etag
+                )
+
         # Obtener permisos del usuario
         permissions = get_user_permissions(request)
 
         # Obtener configuración de UI según rol
         ui_config = get_ui_config_for_role(profile.role)
 
-        return Response({
+        response = Response({
             "user": {
                 "username": request.user.username,
                 "email": request.user.email,
@@ -108,3 +125,29 @@ class UserContextView(APIView):
             "permissions": permissions,
             "ui_config": ui_config,
         })
+        return self._with_cache_headers(response, etag)
+
+    def _get_etag(self, request, profile):
+        user = request.user
+        company = profile.company
+        parts = [
+            str(user.pk),
+            user.username,
+            user.email,
+            user.first_name,
+            user.last_name,
+            profile.role,
+            profile.updated_at.isoformat() if profile.updated_at else "",
+            str(profile.company_id or ""),
+            company.updated_at.isoformat() if company and company.updated_at else "",
+            str(getattr(request, "sitec", None) or ""),
+            str(get_policy_version(profile.company_id) if profile.company_id else ""),
+        ]
+        digest = hashlib.sha1("\x1f".join(parts).encode("utf-8")).hexdigest()
+        return quote_etag(digest)
+
+    def _with_cache_headers(self, response, etag):
+        response["ETag"] = etag
+        patch_cache_control(response, private=True, no_cache=True)
+        patch_vary_headers(response, ("Cookie", "Authorization"))
+        return response
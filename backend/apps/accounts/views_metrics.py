@@ -1,11 +1,43 @@
 """
 Endpoint para métricas de observabilidad
 """
-from rest_framework.permissions import IsAuthenticated
+import hmac
+
+from django.conf import settings
+from django.http import FileResponse, Http404, HttpResponse
+from rest_framework.permissions import BasePermission, IsAuthenticated
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
+from .celery_metrics import get_celery_task_counters
+from .decision_cache import get_decision_cache_stats
+from .metrics_prometheus import CONTENT_TYPE, render_prometheus
+from .metrics_registry import registry
 from .middleware_observability import RequestMetricsView
+from .middleware_query_budget import get_query_metrics
+from .middleware_server_timing import get_phase_metrics
+from .profiling import get_profile_path, list_profiles, render_profile_text
+
+
+class IsSuperUser(BasePermission):
+    """Solo superusuarios (los perfiles exponen detalles internos de todo el sistema)."""
+
+    def has_permission(self, request, view):
+        return bool(request.user and request.user.is_authenticated and request.user.is_superuser)
+
+
+class IsAuthenticatedOrScrapeToken(BasePermission):
+    """
+    Usuario autenticado, o header "Authorization: Bearer <METRICS_SCRAPE_TOKEN>"
+    para el scraper de Prometheus (si el token está configurado).
+    """
+
+    def has_permission(self, request, view):
+        if request.user and request.user.is_authenticated:
+            return True
+        token = getattr(settings, "METRICS_SCRAPE_TOKEN", "")
+        header = request.META.get("HTTP_AUTHORIZATION", "")
+        return bool(token) and hmac.compare_digest(header, f"Bearer {token}")
 
 
 class MetricsView(APIView):
@@ -21,11 +53,51 @@ class MetricsView(APIView):
         
         Query params:
         - endpoint: Endpoint específico (opcional)
-        - hours: Horas de datos (default: 1)
+        - hours: Horas de datos (default: 1, máximo OBSERVABILITY_RETENTION_HOURS)
         """
         endpoint = request.query_params.get("endpoint")
         hours = int(request.query_params.get("hours", 1))
         
         metrics = RequestMetricsView.get_metrics(endpoint=endpoint, hours=hours)
+        metrics["abac_decision_cache"] = get_decision_cache_stats()
+        metrics["celery_tasks"] = get_celery_task_counters()
+        counters = registry.get_counters()
+        metrics["db"] = get_query_metrics(counters)
+        metrics["phases"] = get_phase_metrics(counters)
         
         return Response(metrics)
+
+
+class PrometheusMetricsView(APIView):
+    """
+    Métricas en formato de texto Prometheus (para scraping)
+    """
+    permission_classes = [IsAuthenticatedOrScrapeToken]
+    
+    def get(self, request):
+        return HttpResponse(render_prometheus(), content_type=CONTENT_TYPE)
+
+
+class ProfileListView(APIView):
+    """
+    Lista los perfiles cProfile capturados (storage/profiles)
+    """
+    permission_classes = [IsSuperUser]
+    
+    def get(self, request):
+        return Response({"profiles": list_profiles()})
+
+
+class ProfileDownloadView(APIView):
+    """
+    Descarga un perfil (.prof para pstats/snakeviz) o su resumen con ?output=text
+    """
+    permission_classes = [IsSuperUser]
+    
+    def get(self, request, profile_id):
+        path = get_profile_path(profile_id)
+        if path is None:
+            raise Http404("Perfil no encontrado")
+        if request.query_params.get("output") == "text":
+            return HttpResponse(render_profile_text(path), content_type="text/plain; charset=utf-8")
+        return FileResponse(open(path, "rb"), as_attachment=True, filename=path.name)
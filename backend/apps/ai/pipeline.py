@@ -18,7 +18,8 @@ from .models import AiTrainingJob
 
 
 def _ensure_dataset_dir(company_id):
-    storage_root = Path(settings.BASE_DIR) / "storage" / "ai" / "datasets" / str(company_id)
+    base = getattr(settings, "AI_DATASET_DIR", Path(settings.BASE_DIR) / "storage" / "ai" / "datasets")
+    storage_root = Path(base) / str(company_id)
     storage_root.mkdir(parents=True, exist_ok=True)
     return storage_root
 
@@ -1,3 +1,5 @@
+import tempfile
+
 from django.contrib.auth import get_user_model
 from django.test import TestCase, override_settings
 from rest_framework.test import APITestCase
@@ -138,8 +140,13 @@ class AiPipelineTests(TestCase):
 
     @override_settings(AI_TRAIN_PROVIDER_URL="")
     def test_run_training_pipeline_creates_job(self):
-        job = run_training_pipeline(self.company, self.sitec, created_by=self.user, since_days=30, limit=10)
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        with override_settings(AI_DATASET_DIR=tmpdir.name):
+            job = run_training_pipeline(
+                self.company, self.sitec, created_by=self.user, since_days=30, limit=10
+            )
         self.assertEqual(job.status, "dataset_ready")
-        self.assertTrue(job.dataset_path)
+        self.assertTrue(job.dataset_path.startswith(tmpdir.name))
         self.assertTrue(job.dataset_size)
         self.assertTrue(job.dataset_checksum)
@@ -5,3 +5,8 @@ class AuditConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "apps.audit"
     verbose_name = "Auditoria"
+
+    def ready(self):
+        from .changes import track_model_changes
+
+        track_model_changes()
@@ -0,0 +1,175 @@
+"""
+Payloads de auditoría por diferencias.
+
+Para los modelos de AUDIT_TRACKED_MODELS se lee la fila guardada justo antes
+del primer save de cada instancia (pre_save), no al cargarla: listados y
+lecturas no pagan nada y cada instancia guardada cuesta una consulta.
+log_audit_event compara contra ese estado (o contra el del último evento
+registrado de la misma instancia) y registra solo los campos modificados:
+
+    before = {campo: valor anterior}, after = {campo: valor nuevo}
+
+Cada AUDIT_CHECKPOINT_EVERY eventos por entidad (y en creaciones, eventos sin
+cambios o instancias sin estado previo) se guarda el snapshot completo, de modo
+que reconstruct_state() puede rehacer el historial partiendo del último
+checkpoint. after["_audit"] indica el modo ("full" o "diff") y, en diffs, los
+campos modificados (after también puede llevar extra_data).
+
+Los campos no editables (auto_now, ids) y los ManyToMany solo aparecen en los
+checkpoints.
+"""
+import copy
+from functools import lru_cache
+
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models.signals import pre_save
+from django.forms.models import model_to_dict
+
+AUDIT_META_KEY = "_audit"
+MODE_FULL = "full"
+MODE_DIFF = "diff"
+SNAPSHOT_ATTR = "_audit_snapshot"
+SEQUENCE_TTL = 30 * 24 * 3600
+
+DEFAULT_TRACKED_MODELS = (
+    "companies.Company",
+    "companies.Sitec",
+    "projects.Proyecto",
+    "projects.Tarea",
+    "reports.ReporteSemanal",
+    "reports.Incidente",
+    "transactions.Transaccion",
+    "transactions.Cliente",
+    "accounts.UserProfile",
+    "accounts.AccessPolicy",
+)
+
+
+_tracked_models = set()
+
+
+@lru_cache(maxsize=None)
+def _tracked_fields(model):
+    # La lista se arma una vez por modelo
+    return tuple(
+        field
+        for field in model._meta.concrete_fields
+        if field.editable and not field.primary_key
+    )
+
+
+def _snapshot_values(instance):
+    # Copia de los valores en memoria. Los valores mutables (JSONField) se
+    # copian a fondo: un cambio in-place posterior no debe alterar el snapshot
+    values = instance.__dict__
+    return {
+        field.attname: copy.deepcopy(value) if isinstance(value, (dict, list)) else value
+        for field in _tracked_fields(instance.__class__)
+        if field.attname in values
+        for value in (values[field.attname],)
+    }
+
+
+def _remember_state(sender, instance, raw=False, **kwargs):
+    # Solo el primer save: los siguientes comparan contra el último evento
+    if raw or SNAPSHOT_ATTR in instance.__dict__ or instance._state.adding or instance.pk is None:
+        return
+    fields = [field.attname for field in _tracked_fields(sender) if field.attname in instance.__dict__]
+    stored = sender._base_manager.filter(pk=instance.pk).values(*fields).first()
+    if stored is not None:
+        setattr(instance, SNAPSHOT_ATTR, stored)
+
+
+def track_model_changes():
+    """Conecta pre_save para los modelos de AUDIT_TRACKED_MODELS (AuditConfig.ready)."""
+    labels = getattr(settings, "AUDIT_TRACKED_MODELS", DEFAULT_TRACKED_MODELS)
+    for label in labels:
+        model = apps.get_model(label)
+        _tracked_models.add(model)
+        pre_save.connect(_remember_state, sender=model, dispatch_uid=f"audit_snapshot_{label}")
+
+
+def _next_sequence(entity_type, entity_id):
+    key = f"audit:seq:{entity_type}:{entity_id}"
+    try:
+        try:
+            return cache.incr(key)
+        except ValueError:
+            if cache.add(key, 1, timeout=SEQUENCE_TTL):
+                return 1
+            return cache.incr(key)
+    except Exception:
+        # Sin cache: cada evento es checkpoint (más volumen, historial completo)
+        return 1
+
+
+def capture_changes(instance):
+    """
+    Retorna (mode, before, after) para la instancia. En modo "diff" before y
+    after contienen solo los campos modificados; en modo "full" before es None
+    y after es el snapshot completo. Actualiza el estado recordado.
+    """
+    snapshot = getattr(instance, SNAPSHOT_ATTR, None)
+    if snapshot is None:
+        # Creación, instancia sin guardar o modelo no rastreado (o request.user
+        # perezoso): snapshot completo, que es la base del siguiente evento
+        if instance.__class__ in _tracked_models:
+            setattr(instance, SNAPSHOT_ATTR, _snapshot_values(instance))
+            # Cuenta como checkpoint en la secuencia de la entidad
+            _next_sequence(instance.__class__.__name__, instance.pk)
+        return MODE_FULL, None, model_to_dict(instance)
+    current = _snapshot_values(instance)
+    setattr(instance, SNAPSHOT_ATTR, current)
+    if not getattr(settings, "AUDIT_DIFF_ENABLED", True):
+        return MODE_FULL, None, model_to_dict(instance)
+
+    changed = []
+    for field in _tracked_fields(instance.__class__):
+        if field.attname not in current:
+            continue
+        if field.attname not in snapshot or current[field.attname] != snapshot[field.attname]:
+            changed.append(field)
+
+    every = int(getattr(settings, "AUDIT_CHECKPOINT_EVERY", 20))
+    sequence = _next_sequence(instance.__class__.__name__, instance.pk)
+    if not changed or every <= 1 or sequence % every == 1:
+        return MODE_FULL, None, model_to_dict(instance)
+
+    before = {field.name: snapshot.get(field.attname) for field in changed if field.attname in snapshot}
+    after = {field.name: current[field.attname] for field in changed}
+    return MODE_DIFF, before, after
+
+
+def reconstruct_state(entity_type, entity_id, until=None):
+    """
+    Estado de una entidad según la auditoría: último checkpoint más los diffs
+    posteriores (hasta `until`, inclusive). Retorna None si no hay checkpoint.
+    """
+    from .models import AuditLog
+
+    events = AuditLog.objects.filter(entity_type=entity_type, entity_id=str(entity_id))
+    if until is not None:
+        events = events.filter(created_at__lte=until)
+    checkpoint = (
+        events.filter(**{f"after__{AUDIT_META_KEY}__mode": MODE_FULL})
+        .order_by("-created_at", "-id")
+        .first()
+    )
+    if checkpoint is None:
+        return None
+    state = _model_fields(checkpoint.after)
+    diffs = events.filter(
+        **{f"after__{AUDIT_META_KEY}__mode": MODE_DIFF},
+        created_at__gt=checkpoint.created_at,
+    ).order_by("created_at", "id")
+    for after in diffs.values_list("after", flat=True):
+        state.update(_model_fields(after))
+    return state
+
+
+def _model_fields(after):
+    # Descarta extra_data: solo los campos del modelo listados en _audit.fields
+    fields = set(after.get(AUDIT_META_KEY, {}).get("fields", ()))
+    return {key: value for key, value in after.items() if key in fields}
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+
+from apps.audit.partitions import archive_closed_months, ensure_partitions
+
+
+class Command(BaseCommand):
+    help = "Archiva en storage/audit_archive los meses de auditoría fuera de la ventana caliente."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--hot-months", type=int, default=None, help="Meses que se conservan (default: AUDIT_HOT_MONTHS).")
+        parser.add_argument("--dry-run", action="store_true", help="Solo lista los meses que se archivarían.")
+
+    def handle(self, *args, **options):
+        if not options["dry_run"]:
+            for name in ensure_partitions():
+                self.stdout.write(f"Partición creada: {name}")
+        results = archive_closed_months(hot_months=options["hot_months"], dry_run=options["dry_run"])
+        if not results:
+            self.stdout.write(self.style.WARNING("No hay meses cerrados para archivar."))
+            return
+        for result in results:
+            if options["dry_run"]:
+                self.stdout.write(f"{result['month']}: se archivaría")
+            else:
+                self.stdout.write(f"{result['month']}: {result['rows']} eventos -> {result['path'] or '-'}")
+        self.stdout.write(self.style.SUCCESS(f"Meses procesados: {len(results)}"))
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from apps.audit.writer import audit_writer
+
+
+class Command(BaseCommand):
+    help = "Guarda los eventos de auditoría pendientes en spools locales (procesos caídos o volcados fallidos)."
+
+    def handle(self, *args, **options):
+        flushed = audit_writer.flush()
+        recovered = audit_writer.recover_spool()
+        self.stdout.write(
+            self.style.SUCCESS(f"Eventos guardados: {flushed} pendientes, {recovered} recuperados del spool.")
+        )
@@ -3,6 +3,8 @@ import uuid
 
 from django.conf import settings
 
+from apps.accounts.request_timing import get_timings
+
 from .services import log_audit_event
 
 
@@ -19,9 +21,13 @@ class RequestMetricsMiddleware:
 
         response = self.get_response(request)
 
-        duration_ms = int((time.monotonic() - start) * 1000)
+        # Mismo reloj que Server-Timing/X-Response-Time-ms (ServerTimingMiddleware)
+        timings = get_timings(request)
+        if timings is not None:
+            duration_ms = int(timings.elapsed_ms())
+        else:
+            duration_ms = int((time.monotonic() - start) * 1000)
         response["X-Request-ID"] = request_id
-        response["X-Response-Time-ms"] = str(duration_ms)
 
         if self._should_log(request, response, duration_ms):
             log_audit_event(
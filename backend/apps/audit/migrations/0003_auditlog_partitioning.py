@@ -0,0 +1,109 @@
+from datetime import datetime, timezone
+
+from django.conf import settings
+from django.db import migrations, models
+
+TABLE = "audit_auditlog"
+LEGACY = "audit_auditlog_legacy"
+MONTHS_AHEAD = 2
+
+
+def _add_months(year, month, delta):
+    index = year * 12 + (month - 1) + delta
+    return index // 12, index % 12 + 1
+
+
+def partition_auditlog(apps, schema_editor):
+    """
+    PostgreSQL: convierte audit_auditlog en tabla particionada por mes de
+    created_at. La llave primaria pasa a ser (id, created_at), requisito de
+    PostgreSQL para tablas particionadas; los ids siguen siendo UUID únicos.
+    En otros motores no hace nada (la tabla única es la ventana rodante).
+    """
+    connection = schema_editor.connection
+    if connection.vendor != "postgresql":
+        return
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT relkind FROM pg_class WHERE relname = %s", [TABLE])
+        row = cursor.fetchone()
+        if not row or row[0] == "p":
+            return
+
+        cursor.execute(
+            "SELECT indexdef FROM pg_indexes WHERE tablename = %s AND indexname NOT LIKE %s",
+            [TABLE, "%_pkey"],
+        )
+        index_defs = [row[0] for row in cursor.fetchall()]
+        cursor.execute(
+            "SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint "
+            "WHERE conrelid = %s::regclass AND contype = 'f'",
+            [TABLE],
+        )
+        foreign_keys = cursor.fetchall()
+        cursor.execute(
+            f"SELECT MIN(created_at) AT TIME ZONE 'UTC' FROM {TABLE}"
+        )
+        oldest = cursor.fetchone()[0]
+
+        cursor.execute(f"ALTER TABLE {TABLE} RENAME TO {LEGACY}")
+        cursor.execute(
+            f"CREATE TABLE {TABLE} (LIKE {LEGACY} INCLUDING DEFAULTS INCLUDING CONSTRAINTS) "
+            f"PARTITION BY RANGE (created_at)"
+        )
+        cursor.execute(f"ALTER TABLE {TABLE} ADD PRIMARY KEY (id, created_at)")
+        cursor.execute(f"CREATE TABLE {TABLE}_default PARTITION OF {TABLE} DEFAULT")
+
+        now = datetime.now(timezone.utc)
+        year, month = (oldest.year, oldest.month) if oldest else (now.year, now.month)
+        last = _add_months(now.year, now.month, MONTHS_AHEAD)
+        while (year, month) <= last:
+            start = datetime(year, month, 1, tzinfo=timezone.utc)
+            end = datetime(*_add_months(year, month, 1), 1, tzinfo=timezone.utc)
+            cursor.execute(
+                f"CREATE TABLE {TABLE}_p{year:04d}{month:02d} PARTITION OF {TABLE} "
+                f"FOR VALUES FROM (%s) TO (%s)",
+                [start, end],
+            )
+            year, month = _add_months(year, month, 1)
+
+        cursor.execute(f"INSERT INTO {TABLE} SELECT * FROM {LEGACY}")
+        cursor.execute(f"DROP TABLE {LEGACY}")
+
+        # Los nombres de índices y FKs quedan libres al borrar la tabla original
+        for index_def in index_defs:
+            cursor.execute(index_def.replace(" ONLY ", " "))
+        for name, definition in foreign_keys:
+            cursor.execute(f"ALTER TABLE {TABLE} ADD CONSTRAINT {name} {definition}")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('audit', '0002_alter_auditlog_created_at'),
+        ('companies', '0001_initial'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RunPython(partition_auditlog, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='auditlog',
+            index=models.Index(fields=['created_at', 'id'], name='audit_created_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='auditlog',
+            index=models.Index(fields=['company', 'created_at', 'id'], name='audit_company_created_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='auditlog',
+            index=models.Index(fields=['company', 'action', 'created_at'], name='audit_company_action_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='auditlog',
+            index=models.Index(fields=['company', 'actor', 'created_at'], name='audit_company_actor_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='auditlog',
+            index=models.Index(fields=['entity_type', 'entity_id', 'created_at'], name='audit_entity_idx'),
+        ),
+    ]
@@ -2,6 +2,7 @@ import uuid
 
 from django.conf import settings
 from django.db import models
+from django.utils import timezone
 
 from apps.companies.models import Company
 
@@ -21,7 +22,19 @@ class AuditLog(models.Model):
     after = models.JSONField(null=True, blank=True)
     ip_address = models.GenericIPAddressField(null=True, blank=True)
     user_agent = models.TextField(blank=True)
-    created_at = models.DateTimeField(auto_now_add=True)
+    # default (no auto_now_add) para conservar la hora del evento en escrituras diferidas
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        # En PostgreSQL la tabla está particionada por mes de created_at (ver partitions.py)
+        # Índices alineados con los filtros de AuditLogViewSet y la paginación keyset
+        indexes = [
+            models.Index(fields=["created_at", "id"], name="audit_created_id_idx"),
+            models.Index(fields=["company", "created_at", "id"], name="audit_company_created_id_idx"),
+            models.Index(fields=["company", "action", "created_at"], name="audit_company_action_idx"),
+            models.Index(fields=["company", "actor", "created_at"], name="audit_company_actor_idx"),
+            models.Index(fields=["entity_type", "entity_id", "created_at"], name="audit_entity_idx"),
+        ]
 
     def __str__(self):
         return f"{self.action} - {self.entity_type}:{self.entity_id}"
@@ -0,0 +1,85 @@
+"""
+Paginación keyset para AuditLog.
+
+Orden fijo (-created_at, -id). El cursor codifica la última fila de la página
+y la siguiente se obtiene con `(created_at, id) < (cursor)`, que usa los
+índices (company, created_at, id) sin OFFSET: el costo por página es constante
+sin importar qué tan atrás esté el historial.
+"""
+import base64
+import binascii
+import uuid
+
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import ValidationError
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+class KeysetPagination(BasePagination):
+    page_size = 50
+    max_page_size = 500
+    page_size_query_param = "page_size"
+    cursor_query_param = "cursor"
+    ordering = ("-created_at", "-id")
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        page_size = self.get_page_size(request)
+        position = self.decode_cursor(request.query_params.get(self.cursor_query_param))
+
+        queryset = queryset.order_by(*self.ordering)
+        if position is not None:
+            created_at, pk = position
+            queryset = queryset.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=pk))
+
+        rows = list(queryset[: page_size + 1])
+        self.has_next = len(rows) > page_size
+        rows = rows[:page_size]
+        self.next_position = (rows[-1].created_at, rows[-1].id) if self.has_next else None
+        return rows
+
+    def get_page_size(self, request):
+        try:
+            size = int(request.query_params.get(self.page_size_query_param, self.page_size))
+        except (TypeError, ValueError):
+            return self.page_size
+        return max(1, min(size, self.max_page_size))
+
+    def encode_cursor(self, position):
+        created_at, pk = position
+        raw = f"{created_at.isoformat()}|{pk}".encode()
+        return base64.urlsafe_b64encode(raw).decode()
+
+    def decode_cursor(self, value):
+        if not value:
+            return None
+        try:
+            created_text, pk_text = base64.urlsafe_b64decode(value.encode()).decode().split("|", 1)
+            created_at = parse_datetime(created_text)
+            pk = uuid.UUID(pk_text)
+        except (binascii.Error, UnicodeDecodeError, ValueError):
+            raise ValidationError({self.cursor_query_param: "Cursor inválido."})
+        if created_at is None:
+            raise ValidationError({self.cursor_query_param: "Cursor inválido."})
+        return created_at, pk
+
+    def get_next_link(self):
+        if self.next_position is None:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, self.encode_cursor(self.next_position))
+
+    def get_paginated_response(self, data):
+        return Response({"next": self.get_next_link(), "results": data})
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            "type": "object",
+            "properties": {
+                "next": {"type": "string", "nullable": True},
+                "results": schema,
+            },
+        }
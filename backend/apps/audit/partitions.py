@@ -0,0 +1,263 @@
+"""
+Particionado mensual de AuditLog y archivado en frío.
+
+- PostgreSQL: audit_auditlog es una tabla particionada por RANGE(created_at)
+  (migración 0003) con una partición por mes (audit_auditlog_pYYYYMM) y una
+  partición DEFAULT de respaldo. ensure_partitions() crea por adelantado las
+  particiones de los próximos meses; las consultas de la ventana caliente solo
+  tocan las particiones recientes (partition pruning) sin importar el histórico.
+- SQLite (desarrollo/tests): la tabla única funciona como ventana rodante; los
+  meses cerrados se exportan y se borran.
+
+archive_closed_months() exporta cada mes fuera de la ventana caliente
+(AUDIT_HOT_MONTHS) a AUDIT_ARCHIVE_DIR/audit_log_YYYY_MM.jsonl.gz y elimina
+solo lo exportado: la partición ya desconectada o, sin particiones, los ids
+escritos en el archivo. Los meses se calculan en UTC. La tarea diaria solo
+archiva con AUDIT_ARCHIVE_ENABLED (el directorio debe ser almacenamiento
+persistente: es la única copia).
+"""
+import gzip
+import json
+import logging
+import os
+from datetime import datetime, timezone as dt_timezone
+from pathlib import Path
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+from .models import AuditLog
+
+logger = logging.getLogger(__name__)
+
+TABLE = AuditLog._meta.db_table
+DEFAULT_PARTITION = f"{TABLE}_default"
+EXPORT_CHUNK_SIZE = 2000
+DELETE_BATCH_SIZE = 5000
+
+
+def month_start(year, month):
+    return datetime(year, month, 1, tzinfo=dt_timezone.utc)
+
+
+def add_months(year, month, delta):
+    index = year * 12 + (month - 1) + delta
+    return index // 12, index % 12 + 1
+
+
+def partition_name(year, month):
+    return f"{TABLE}_p{year:04d}{month:02d}"
+
+
+def is_partitioned():
+    if connection.vendor != "postgresql":
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT relkind FROM pg_class WHERE relname = %s", [TABLE])
+        row = cursor.fetchone()
+    return bool(row) and row[0] == "p"
+
+
+def list_partitions():
+    """[(year, month)] de las particiones mensuales existentes."""
+    if not is_partitioned():
+        return []
+    with connection.cursor() as cursor:
+        cursor.execute(
+            """
+            SELECT child.relname FROM pg_inherits
+            JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+            JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+            WHERE parent.relname = %s
+            """,
+            [TABLE],
+        )
+        names = [row[0] for row in cursor.fetchall()]
+    prefix = f"{TABLE}_p"
+    months = []
+    for name in names:
+        suffix = name[len(prefix):]
+        if name.startswith(prefix) and len(suffix) == 6 and suffix.isdigit():
+            months.append((int(suffix[:4]), int(suffix[4:])))
+    return sorted(months)
+
+
+def create_partition(year, month):
+    """
+    Crea la partición del mes si no existe. Las filas que hayan caído en la
+    partición DEFAULT para ese rango se mueven a la nueva partición.
+    """
+    if not is_partitioned() or (year, month) in list_partitions():
+        return False
+    name = partition_name(year, month)
+    start = month_start(year, month)
+    end = month_start(*add_months(year, month, 1))
+    quoted = connection.ops.quote_name
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(f"CREATE TABLE {quoted(name)} (LIKE {quoted(TABLE)} INCLUDING DEFAULTS)")
+        cursor.execute(
+            f"WITH moved AS (DELETE FROM {quoted(DEFAULT_PARTITION)} "
+            f"WHERE created_at >= %s AND created_at < %s RETURNING *) "
+            f"INSERT INTO {quoted(name)} SELECT * FROM moved",
+            [start, end],
+        )
+        cursor.execute(
+            f"ALTER TABLE {quoted(TABLE)} ATTACH PARTITION {quoted(name)} "
+            f"FOR VALUES FROM (%s) TO (%s)",
+            [start, end],
+        )
+    return True
+
+
+def ensure_partitions(months_ahead=None, now=None):
+    """Crea las particiones del mes actual y de los siguientes meses."""
+    if not is_partitioned():
+        return []
+    months_ahead = (
+        int(getattr(settings, "AUDIT_PARTITION_MONTHS_AHEAD", 2)) if months_ahead is None else months_ahead
+    )
+    now = now or timezone.now()
+    current = now.astimezone(dt_timezone.utc)
+    created = []
+    for offset in range(months_ahead + 1):
+        year, month = add_months(current.year, current.month, offset)
+        if create_partition(year, month):
+            created.append(partition_name(year, month))
+    return created
+
+
+def get_archive_dir():
+    path = Path(getattr(settings, "AUDIT_ARCHIVE_DIR", Path(settings.BASE_DIR) / "storage" / "audit_archive"))
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+def _archive_path(year, month):
+    # Un mes ya archivado puede recibir filas tardías: nunca sobrescribir
+    directory = get_archive_dir()
+    target = directory / f"audit_log_{year:04d}_{month:02d}.jsonl.gz"
+    sequence = 1
+    while target.exists():
+        sequence += 1
+        target = directory / f"audit_log_{year:04d}_{month:02d}.{sequence}.jsonl.gz"
+    return target
+
+
+def _write_archive(year, month, rows):
+    """Escribe las filas (dicts) a JSONL comprimido. Retorna (ruta, ids)."""
+    target = _archive_path(year, month)
+    tmp = target.with_name(target.name + ".tmp")
+    ids = []
+    with gzip.open(tmp, "wt", encoding="utf-8") as handle:
+        for row in rows:
+            handle.write(json.dumps(row, default=str) + "\n")
+            ids.append(row["id"])
+    # Solo un archivo completo queda con el nombre final
+    os.replace(tmp, target)
+    return target, ids
+
+
+def _table_exists(name):
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT 1 FROM pg_class WHERE relname = %s AND relkind = 'r'", [name])
+        return cursor.fetchone() is not None
+
+
+def _table_rows(name):
+    quoted = connection.ops.quote_name
+    with connection.cursor() as cursor:
+        cursor.execute(f"SELECT * FROM {quoted(name)} ORDER BY created_at, id")
+        columns = [column[0] for column in cursor.description]
+        while True:
+            batch = cursor.fetchmany(EXPORT_CHUNK_SIZE)
+            if not batch:
+                break
+            for values in batch:
+                yield dict(zip(columns, values))
+
+
+def _archive_partition(year, month):
+    """
+    PostgreSQL: primero se desconecta la partición (las escrituras nuevas del
+    rango caen en DEFAULT y se archivan en otra corrida), después se exporta
+    la tabla ya aislada y solo entonces se elimina. Si la exportación falla,
+    la tabla desconectada queda y la siguiente corrida la retoma.
+    """
+    name = partition_name(year, month)
+    quoted = connection.ops.quote_name
+    if (year, month) in list_partitions():
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(f"ALTER TABLE {quoted(TABLE)} DETACH PARTITION {quoted(name)}")
+    elif not _table_exists(name):
+        return None, []
+    path, ids = _write_archive(year, month, _table_rows(name))
+    with connection.cursor() as cursor:
+        cursor.execute(f"DROP TABLE {quoted(name)}")
+    return path, ids
+
+
+def _archive_rows(year, month):
+    """Sin particiones: se borran solo los ids que quedaron en el archivo."""
+    start = month_start(year, month)
+    end = month_start(*add_months(year, month, 1))
+    rows = (
+        AuditLog.objects.filter(created_at__gte=start, created_at__lt=end)
+        .order_by("created_at", "id")
+        .values()
+        .iterator(chunk_size=EXPORT_CHUNK_SIZE)
+    )
+    path, ids = _write_archive(year, month, rows)
+    for offset in range(0, len(ids), DELETE_BATCH_SIZE):
+        AuditLog.objects.filter(id__in=ids[offset:offset + DELETE_BATCH_SIZE]).delete()
+    return path, ids
+
+
+def archive_month(year, month):
+    """Exporta un mes y elimina del almacenamiento caliente lo exportado."""
+    if is_partitioned():
+        # Una exportación interrumpida deja la tabla desconectada: se retoma
+        # tal cual; si no, se mueven a su partición las filas del mes que
+        # hayan caído en DEFAULT
+        if not _table_exists(partition_name(year, month)):
+            create_partition(year, month)
+        path, ids = _archive_partition(year, month)
+    else:
+        path, ids = _archive_rows(year, month)
+    if not ids:
+        # Mes sin eventos (hueco o partición vacía): no dejar archivos vacíos
+        if path is not None:
+            path.unlink(missing_ok=True)
+        return {"month": f"{year:04d}-{month:02d}", "path": None, "rows": 0}
+    logger.info("Auditoría %04d-%02d archivada en %s (%d eventos)", year, month, path.name, len(ids))
+    return {"month": f"{year:04d}-{month:02d}", "path": str(path), "rows": len(ids)}
+
+
+def closed_months(hot_months=None, now=None):
+    """Meses (year, month) con datos o partición anteriores a la ventana caliente."""
+    hot_months = int(getattr(settings, "AUDIT_HOT_MONTHS", 6)) if hot_months is None else hot_months
+    now = (now or timezone.now()).astimezone(dt_timezone.utc)
+    cutoff_year, cutoff_month = add_months(now.year, now.month, -(max(1, hot_months) - 1))
+    cutoff = month_start(cutoff_year, cutoff_month)
+
+    months = {month for month in list_partitions() if month_start(*month) < cutoff}
+    oldest = (
+        AuditLog.objects.filter(created_at__lt=cutoff)
+        .order_by("created_at")
+        .values_list("created_at", flat=True)
+        .first()
+    )
+    if oldest is not None:
+        oldest = oldest.astimezone(dt_timezone.utc)
+        year, month = oldest.year, oldest.month
+        while month_start(year, month) < cutoff:
+            months.add((year, month))
+            year, month = add_months(year, month, 1)
+    return sorted(months)
+
+
+def archive_closed_months(hot_months=None, now=None, dry_run=False):
+    months = closed_months(hot_months=hot_months, now=now)
+    if dry_run:
+        return [{"month": f"{year:04d}-{month:02d}"} for year, month in months]
+    return [archive_month(year, month) for year, month in months]
@@ -1,10 +1,12 @@
 import json
 
-from django.forms.models import model_to_dict
+from django.db import transaction
 
-from apps.accounts.models import UserProfile
+from apps.accounts.identity import get_request_profile
 
+from .changes import AUDIT_META_KEY, capture_changes
 from .models import AuditLog
+from .writer import MODE_SYNC, audit_writer, build_row, get_write_mode, is_strict_action
 
 
 def _get_client_ip(request):
@@ -22,20 +24,35 @@ def _to_json_safe(payload):
     return json.loads(json.dumps(payload, default=str))
 
 
-def log_audit_event(request, action, instance, before=None, extra_data=None):
+def log_audit_event(request, action, instance, before=None, extra_data=None, strict=False):
+    """
+    Registra un evento de auditoría.
+
+    Según AUDIT_WRITE_MODE se escribe en el momento o se encola para guardarse
+    en lote al confirmarse la transacción en curso (ver writer.py). strict=True,
+    o una acción en AUDIT_STRICT_ACTIONS, fuerza la escritura síncrona.
+
+    Para instancias se guardan solo los campos modificados respecto a la fila
+    previa a su primer save (o al último evento de la misma instancia), con
+    checkpoints completos periódicos (ver changes.py). Un
+    `before` explícito tiene prioridad sobre el calculado.
+    """
     company = getattr(request, "company", None) if request else None
     actor = None
     user = getattr(request, "user", None) if request else None
     if user is not None and getattr(user, "is_authenticated", False):
         actor = user
-        try:
-            profile = UserProfile.objects.get(user=user)
+        profile = get_request_profile(request)
+        if profile is not None:
             company = profile.company
-        except UserProfile.DoesNotExist:
-            if company is None:
-                company = None
 
-    after = _to_json_safe(model_to_dict(instance)) if instance else None
+    after = None
+    if instance:
+        mode, changed_before, after = capture_changes(instance)
+        after = _to_json_safe(after)
+        after[AUDIT_META_KEY] = {"mode": mode, "fields": sorted(after)}
+        if before is None:
+            before = changed_before
     before = _to_json_safe(before)
     
     # Si hay extra_data, agregarlo al campo after
@@ -49,14 +66,33 @@ def log_audit_event(request, action, instance, before=None, extra_data=None):
     if not entity_id:
         entity_id = "system"
     
-    AuditLog.objects.create(
-        company=company,
-        actor=actor,
+    ip_address = _get_client_ip(request)
+    user_agent = request.META.get("HTTP_USER_AGENT", "") if request else ""
+
+    if strict or get_write_mode() == MODE_SYNC or is_strict_action(action):
+        AuditLog.objects.create(
+            company=company,
+            actor=actor,
+            action=action,
+            entity_type=entity_type,
+            entity_id=entity_id,
+            before=before,
+            after=after,
+            ip_address=ip_address,
+            user_agent=user_agent,
+        )
+        return
+
+    row = build_row(
+        company_id=company.pk if company else None,
+        actor_id=actor.pk if actor else None,
         action=action,
         entity_type=entity_type,
         entity_id=entity_id,
         before=before,
         after=after,
-        ip_address=_get_client_ip(request),
-        user_agent=request.META.get("HTTP_USER_AGENT", "") if request else "",
+        ip_address=ip_address,
+        user_agent=user_agent,
     )
+    # Solo si la transacción del cambio se confirma (inmediato fuera de una)
+    transaction.on_commit(lambda: audit_writer.enqueue(row))
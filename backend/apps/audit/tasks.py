@@ -0,0 +1,26 @@
+from celery import shared_task
+
+from .writer import persist_rows
+
+
+@shared_task(autoretry_for=(Exception,), retry_backoff=True, max_retries=5)
+def persist_audit_batch(rows):
+    """Guarda un lote de eventos encolados por AuditWriter (AUDIT_WRITE_MODE=celery)."""
+    return {"persisted": persist_rows(rows)}
+
+
+@shared_task
+def maintain_audit_partitions(hot_months=None):
+    """
+    Crea particiones futuras y, con AUDIT_ARCHIVE_ENABLED, archiva los meses
+    fuera de la ventana caliente.
+    """
+    from django.conf import settings
+
+    from .partitions import archive_closed_months, ensure_partitions
+
+    created = ensure_partitions()
+    archived = []
+    if getattr(settings, "AUDIT_ARCHIVE_ENABLED", False):
+        archived = archive_closed_months(hot_months=hot_months)
+    return {"created": created, "archived": archived}
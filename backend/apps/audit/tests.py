@@ -1,11 +1,27 @@
+import gzip
+import json
+import socket
+import tempfile
+from datetime import datetime, timezone as dt_timezone
+from pathlib import Path
+from unittest.mock import patch
+
 from django.contrib.auth import get_user_model
-from django.test import TestCase
-from rest_framework.test import APIRequestFactory
+from django.core.cache import cache
+from django.db import IntegrityError, connection, transaction
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIClient, APIRequestFactory
 
-from apps.companies.models import Company
+from apps.accounts.models import AccessPolicy, UserProfile
+from apps.companies.models import Company, Sitec
+from apps.projects.models import Proyecto
 
 from .models import AuditLog
+from .changes import SNAPSHOT_ATTR, reconstruct_state
+from .partitions import add_months, archive_closed_months, closed_months
 from .services import log_audit_event
+from .writer import AuditWriter, build_row
 
 
 User = get_user_model()
@@ -39,3 +55,397 @@ class AuditLogTests(TestCase):
         self.assertEqual(log.company, self.company)
         self.assertEqual(log.actor, self.user)
         self.assertEqual(log.action, "custom_event")
+
+
+class AuditWriterTests(TestCase):
+    def setUp(self):
+        self.company = Company.objects.create(
+            name="SITEC",
+            timezone="America/Mexico_City",
+            locale="es-MX",
+            plan="enterprise",
+            status="active",
+        )
+        self.user = User.objects.create_user(
+            username="auditor",
+            email="auditor@sitec.mx",
+            password="password123",
+        )
+        self.spool_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.spool_dir.cleanup)
+        overrides = override_settings(
+            AUDIT_WRITE_MODE="buffered",
+            AUDIT_FLUSH_SECONDS=3600,
+            AUDIT_SPOOL_DIR=Path(self.spool_dir.name),
+            AUDIT_STRICT_ACTIONS=["policy_updated"],
+        )
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        self.writer = AuditWriter()
+        writer_patch = patch("apps.audit.services.audit_writer", self.writer)
+        writer_patch.start()
+        self.addCleanup(writer_patch.stop)
+
+    def _request(self):
+        request = APIRequestFactory().get("/api/companies/")
+        request.user = self.user
+        request.company = self.company
+        return request
+
+    def test_buffered_event_is_persisted_in_batch_on_flush(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            log_audit_event(self._request(), "company_updated", self.company)
+            log_audit_event(self._request(), "custom_event", self.company)
+        self.assertEqual(AuditLog.objects.count(), 0)
+        self.assertEqual(self.writer.pending(), 2)
+
+        with self.assertNumQueries(1):
+            self.assertEqual(self.writer.flush(), 2)
+
+        log = AuditLog.objects.get(action="company_updated")
+        self.assertEqual(log.company, self.company)
+        self.assertEqual(log.actor, self.user)
+        self.assertEqual(self.writer.pending(), 0)
+        self.assertEqual(list(Path(self.spool_dir.name).glob("*.flushing")), [])
+
+    def test_strict_actions_are_written_synchronously(self):
+        log_audit_event(self._request(), "policy_updated", self.company)
+        log_audit_event(self._request(), "custom_event", self.company, strict=True)
+        self.assertEqual(AuditLog.objects.count(), 2)
+        self.assertEqual(self.writer.pending(), 0)
+
+    def test_rolled_back_event_is_not_enqueued(self):
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            try:
+                with transaction.atomic():
+                    log_audit_event(self._request(), "company_updated", self.company)
+                    raise IntegrityError("rollback")
+            except IntegrityError:
+                pass
+        self.assertEqual(callbacks, [])
+        self.assertEqual(self.writer.pending(), 0)
+        self.assertEqual(list(Path(self.spool_dir.name).glob("*.jsonl")), [])
+
+    def test_events_are_spooled_before_flush(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            log_audit_event(self._request(), "custom_event", self.company)
+        spool_files = list(Path(self.spool_dir.name).glob("*.jsonl"))
+        self.assertEqual(len(spool_files), 1)
+        row = json.loads(spool_files[0].read_text().strip())
+        self.assertEqual(row["action"], "custom_event")
+        self.assertEqual(row["company_id"], str(self.company.pk))
+
+    def test_recover_spool_persists_events_of_dead_process_once(self):
+        row = build_row(
+            company_id=self.company.pk,
+            actor_id=self.user.pk,
+            action="custom_event",
+            entity_type="Company",
+            entity_id=str(self.company.pk),
+            before=None,
+            after={"name": "SITEC"},
+            ip_address="127.0.0.1",
+            user_agent="",
+        )
+        # Spool de un proceso que terminó sin volcar; la última línea quedó truncada
+        dead_spool = Path(self.spool_dir.name) / f"{socket.gethostname()}@999999999.jsonl"
+        dead_spool.write_text(json.dumps(row) + "\n" + '{"id": "trunc')
+        # Segmento ya guardado parcialmente: el reintento no debe duplicar
+        AuditLog.objects.bulk_create([AuditLog(id=row["id"], company=self.company, action="custom_event")])
+
+        with self.assertLogs("apps.audit.writer", "WARNING"):
+            self.assertEqual(self.writer.recover_spool(), 1)
+
+        self.assertEqual(AuditLog.objects.filter(id=row["id"]).count(), 1)
+        self.assertEqual(list(Path(self.spool_dir.name).iterdir()), [])
+
+
+class AuditArchiveTests(TestCase):
+    def setUp(self):
+        self.company = Company.objects.create(
+            name="SITEC",
+            timezone="America/Mexico_City",
+            locale="es-MX",
+            plan="enterprise",
+            status="active",
+        )
+        self.archive_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.archive_dir.cleanup)
+        overrides = override_settings(AUDIT_ARCHIVE_DIR=Path(self.archive_dir.name), AUDIT_HOT_MONTHS=2)
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        self.now = datetime(2026, 5, 15, tzinfo=dt_timezone.utc)
+
+    def _log(self, year, month, day=10):
+        return AuditLog.objects.create(
+            company=self.company,
+            action="custom_event",
+            entity_type="Company",
+            entity_id=str(self.company.pk),
+            created_at=datetime(year, month, day, tzinfo=dt_timezone.utc),
+        )
+
+    def test_add_months_crosses_year_boundaries(self):
+        self.assertEqual(add_months(2026, 1, -1), (2025, 12))
+        self.assertEqual(add_months(2025, 11, 3), (2026, 2))
+
+    def test_closed_months_exclude_hot_window(self):
+        self._log(2026, 1)
+        self._log(2026, 4)
+        self._log(2026, 5)
+        # Ventana caliente de 2 meses: abril y mayo
+        self.assertEqual(closed_months(now=self.now), [(2026, 1), (2026, 2), (2026, 3)])
+
+    def test_archive_exports_closed_months_and_keeps_hot_rows(self):
+        old = self._log(2026, 2, day=28)
+        hot = self._log(2026, 4, day=1)
+
+        results = archive_closed_months(now=self.now)
+
+        self.assertEqual([result["month"] for result in results], ["2026-02", "2026-03"])
+        self.assertEqual(results[1], {"month": "2026-03", "path": None, "rows": 0})
+        self.assertEqual(list(AuditLog.objects.values_list("id", flat=True)), [hot.id])
+        archive = Path(self.archive_dir.name) / "audit_log_2026_02.jsonl.gz"
+        with gzip.open(archive, "rt", encoding="utf-8") as handle:
+            rows = [json.loads(line) for line in handle]
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0]["id"], str(old.id))
+        self.assertEqual(sorted(path.name for path in Path(self.archive_dir.name).iterdir()), [archive.name])
+
+
+    def test_archive_only_deletes_exported_rows(self):
+        from . import partitions
+
+        self._log(2026, 2)
+        write_archive = partitions._write_archive
+
+        def write_then_insert(year, month, rows):
+            result = write_archive(year, month, rows)
+            if month == 2:
+                # Evento del mismo mes que llega durante la exportación
+                self._log(2026, 2, day=20)
+            return result
+
+        with patch.object(partitions, "_write_archive", side_effect=write_then_insert):
+            results = archive_closed_months(now=self.now)
+        self.assertEqual(results[0]["rows"], 1)
+        self.assertEqual(AuditLog.objects.count(), 1)
+
+        # La siguiente corrida lo archiva en otro archivo, sin sobrescribir
+        results = archive_closed_months(now=self.now)
+        self.assertEqual(results[0]["rows"], 1)
+        self.assertEqual(
+            sorted(path.name for path in Path(self.archive_dir.name).iterdir()),
+            ["audit_log_2026_02.2.jsonl.gz", "audit_log_2026_02.jsonl.gz"],
+        )
+
+    def test_maintenance_task_does_not_archive_by_default(self):
+        from .tasks import maintain_audit_partitions
+
+        self._log(2020, 1)
+        self.assertEqual(maintain_audit_partitions()["archived"], [])
+        self.assertEqual(AuditLog.objects.count(), 1)
+
+class AuditLogViewSetTests(TestCase):
+    def setUp(self):
+        self.company = Company.objects.create(
+            name="SITEC",
+            timezone="America/Mexico_City",
+            locale="es-MX",
+            plan="enterprise",
+            status="active",
+        )
+        self.other_company = Company.objects.create(
+            name="Otra",
+            timezone="America/Mexico_City",
+            locale="es-MX",
+            plan="enterprise",
+            status="active",
+        )
+        Sitec.objects.create(company=self.company, schema_name="sitec", status="active")
+        self.user = User.objects.create_user(username="auditor", password="password123")
+        UserProfile.objects.create(user=self.user, company=self.company, role="admin_empresa")
+        AccessPolicy.objects.create(company=self.company, action="*", effect="allow", priority=0)
+        self.client = APIClient()
+        self.client.force_login(self.user)
+
+        base = datetime(2026, 3, 1, tzinfo=dt_timezone.utc)
+        self.logs = [
+            AuditLog.objects.create(
+                company=self.company,
+                actor=self.user,
+                action="reporte_updated" if index % 2 else "reporte_created",
+                entity_type="ReporteSemanal",
+                entity_id=str(index),
+                # Pares con el mismo created_at para probar el desempate por id
+                created_at=base.replace(day=1 + index // 2),
+            )
+            for index in range(7)
+        ]
+        AuditLog.objects.create(company=self.other_company, action="reporte_created", entity_type="ReporteSemanal")
+
+    def _collect(self, url):
+        ids = []
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            ids.extend(row["id"] for row in response.json()["results"])
+            url = response.json()["next"]
+        return ids
+
+    def test_keyset_pages_cover_company_history_without_duplicates(self):
+        ids = self._collect("/api/audit/?page_size=3")
+
+        expected = sorted(self.logs, key=lambda log: (log.created_at, log.id), reverse=True)
+        self.assertEqual(ids, [str(log.id) for log in expected])
+
+    def test_filters_by_action_entity_and_time_range(self):
+        ids = self._collect(
+            "/api/audit/?action=reporte_updated&entity_type=ReporteSemanal"
+            "&created_after=2026-03-02T00:00:00Z&created_before=2026-03-04T00:00:00Z"
+        )
+        self.assertEqual(
+            sorted(ids),
+            sorted(str(log.id) for log in self.logs[2:6] if log.action == "reporte_updated"),
+        )
+        self.assertEqual(self._collect("/api/audit/?entity_id=4"), [str(self.logs[4].id)])
+
+    def test_invalid_cursor_and_dates_return_400(self):
+        self.assertEqual(self.client.get("/api/audit/?cursor=zzz").status_code, 400)
+        self.assertEqual(self.client.get("/api/audit/?created_after=ayer").status_code, 400)
+
+    def test_export_streams_csv_for_company_and_range(self):
+        response = self.client.get(
+            "/api/audit/export/?created_after=2026-03-02T00:00:00Z&created_before=2026-03-03T00:00:00Z"
+        )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        self.assertIn("attachment;", response["Content-Disposition"])
+        lines = b"".join(response.streaming_content).decode().splitlines()
+        self.assertEqual(lines[0].split(",")[:3], ["id", "created_at", "company_id"])
+        self.assertEqual(len(lines), 3)
+
+    def test_export_streams_gzipped_jsonl(self):
+        response = self.client.get("/api/audit/export/?output=jsonl&gzip=1&action=reporte_created")
+
+        self.assertEqual(response["Content-Type"], "application/gzip")
+        rows = [json.loads(line) for line in gzip.decompress(b"".join(response.streaming_content)).splitlines()]
+        self.assertEqual([row["id"] for row in rows], [str(log.id) for log in self.logs if log.action == "reporte_created"])
+        self.assertTrue(all(row["company_id"] == str(self.company.pk) for row in rows))
+
+    def test_export_rejects_unknown_output(self):
+        self.assertEqual(self.client.get("/api/audit/export/?output=xml").status_code, 400)
+
+    def test_next_page_uses_keyset_instead_of_offset(self):
+        next_url = self.client.get("/api/audit/?page_size=2").json()["next"]
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(next_url)
+
+        self.assertEqual(response.status_code, 200)
+        audit_queries = [query["sql"] for query in queries if 'FROM "audit_auditlog"' in query["sql"]]
+        self.assertEqual(len(audit_queries), 1)
+        self.assertNotIn("OFFSET", audit_queries[0])
+        self.assertNotIn("JOIN", audit_queries[0])
+
+
+@override_settings(AUDIT_CHECKPOINT_EVERY=3)
+class AuditDiffTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username="auditor", password="password123")
+        self.company = Company.objects.create(
+            name="SITEC",
+            timezone="America/Mexico_City",
+            locale="es-MX",
+            plan="enterprise",
+            status="active",
+        )
+
+    def _request(self):
+        request = APIRequestFactory().patch("/api/companies/")
+        request.user = self.user
+        request.company = self.company
+        return request
+
+    def _update(self, **changes):
+        company = Company.objects.get(pk=self.company.pk)
+        for field, value in changes.items():
+            setattr(company, field, value)
+        company.save()
+        log_audit_event(self._request(), "company_updated", company)
+        return AuditLog.objects.order_by("-created_at").first()
+
+    def test_update_records_only_changed_fields(self):
+        log_audit_event(self._request(), "company_created", self.company)
+        created = AuditLog.objects.get(action="company_created")
+        self.assertEqual(created.after["_audit"]["mode"], "full")
+        self.assertEqual(created.after["plan"], "enterprise")
+
+        log = self._update(plan="pro")
+
+        self.assertEqual(log.before, {"plan": "enterprise"})
+        self.assertEqual(log.after, {"plan": "pro", "_audit": {"mode": "diff", "fields": ["plan"]}})
+
+    def test_periodic_checkpoint_allows_reconstruction(self):
+        log_audit_event(self._request(), "company_created", self.company)
+        modes = [
+            self._update(plan="pro").after["_audit"]["mode"],
+            self._update(status="inactive").after["_audit"]["mode"],
+            self._update(locale="en-US").after["_audit"]["mode"],
+            self._update(plan="basic").after["_audit"]["mode"],
+        ]
+
+        self.assertEqual(modes, ["diff", "diff", "full", "diff"])
+        state = reconstruct_state("Company", self.company.pk)
+        self.assertEqual(state["plan"], "basic")
+        self.assertEqual(state["status"], "inactive")
+        self.assertEqual(state["locale"], "en-US")
+        self.assertEqual(state["name"], "SITEC")
+
+    def test_explicit_before_is_preserved(self):
+        company = Company.objects.get(pk=self.company.pk)
+        company.plan = "pro"
+        log_audit_event(self._request(), "company_updated", company, before={"plan": "legacy"})
+        self.assertEqual(AuditLog.objects.get().before, {"plan": "legacy"})
+
+    def test_state_is_read_on_save_not_on_load(self):
+        log_audit_event(self._request(), "company_created", self.company)
+        companies = list(Company.objects.all())
+        self.assertFalse(any(SNAPSHOT_ATTR in company.__dict__ for company in companies))
+
+        company = companies[0]
+        company.plan = "pro"
+        company.save()
+        self.assertEqual(getattr(company, SNAPSHOT_ATTR)["plan"], "enterprise")
+
+        # Un segundo save antes del evento conserva el estado previo al primero
+        company.status = "inactive"
+        company.save()
+        log_audit_event(self._request(), "company_updated", company)
+        log = AuditLog.objects.get(action="company_updated")
+        self.assertEqual(log.before, {"plan": "enterprise", "status": "active"})
+
+    def test_in_place_json_change_is_recorded(self):
+        sitec = Sitec.objects.create(company=self.company, schema_name="audit_diff")
+        project = Proyecto.objects.create(
+            company=self.company,
+            sitec=sitec,
+            name="Proyecto",
+            code="P-AUD",
+            site_address="Calle 1",
+            start_date=datetime(2024, 1, 1).date(),
+            project_manager=self.user,
+            metadata={"fase": "diseño"},
+        )
+        log_audit_event(self._request(), "project_created", project)
+
+        project = Proyecto.objects.get(pk=project.pk)
+        project.metadata["fase"] = "obra"
+        project.save()
+        log_audit_event(self._request(), "project_updated", project)
+
+        log = AuditLog.objects.get(action="project_updated")
+        self.assertEqual(log.before, {"metadata": {"fase": "diseño"}})
+        self.assertEqual(log.after["metadata"], {"fase": "obra"})
@@ -1,9 +1,120 @@
+import uuid
+from datetime import datetime, time
+
+from django.http import StreamingHttpResponse
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
 from rest_framework import viewsets
+from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
 
+from .export import EXPORT_FORMATS, stream_export
 from .models import AuditLog
+from .pagination import KeysetPagination
 from .serializers import AuditLogSerializer
 
 
+def _parse_bound(name, value):
+    moment = parse_datetime(value)
+    if moment is None:
+        day = parse_date(value)
+        if day is None:
+            raise ValidationError({name: "Fecha inválida (ISO 8601)."})
+        moment = datetime.combine(day, time.min)
+    if timezone.is_naive(moment):
+        moment = timezone.make_aware(moment)
+    return moment
+
+
+def _parse_uuid(name, value):
+    try:
+        return uuid.UUID(value)
+    except ValueError:
+        raise ValidationError({name: "Identificador inválido."})
+
+
+def _parse_int(name, value):
+    try:
+        return int(value)
+    except ValueError:
+        raise ValidationError({name: "Identificador inválido."})
+
+
 class AuditLogViewSet(viewsets.ReadOnlyModelViewSet):
-    queryset = AuditLog.objects.select_related("company", "actor").all().order_by("-created_at")
+    """
+    Historial de auditoría paginado por cursor (ver pagination.py).
+
+    Usuarios normales solo ven su company; superusuarios ven todas y pueden
+    filtrar con ?company=.
+
+    Filtros: company, actor, action (acepta varias separadas por coma),
+    entity_type, entity_id, created_after (>=) y created_before (<).
+
+    /api/audit/export/ exporta en streaming los mismos resultados:
+    ?output=csv|jsonl (default csv) y ?gzip=1.
+    """
+    queryset = AuditLog.objects.all()
     serializer_class = AuditLogSerializer
+    pagination_class = KeysetPagination
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        params = self.request.query_params
+        user = self.request.user
+
+        if user.is_superuser:
+            company_id = params.get("company")
+            if company_id:
+                queryset = queryset.filter(company_id=_parse_uuid("company", company_id))
+        else:
+            company = getattr(self.request, "company", None)
+            if company is None:
+                return queryset.none()
+            queryset = queryset.filter(company=company)
+
+        actor_id = params.get("actor")
+        if actor_id:
+            queryset = queryset.filter(actor_id=_parse_int("actor", actor_id))
+
+        actions = [action for action in params.get("action", "").split(",") if action]
+        if len(actions) == 1:
+            queryset = queryset.filter(action=actions[0])
+        elif actions:
+            queryset = queryset.filter(action__in=actions)
+
+        entity_type = params.get("entity_type")
+        if entity_type:
+            queryset = queryset.filter(entity_type=entity_type)
+        entity_id = params.get("entity_id")
+        if entity_id:
+            queryset = queryset.filter(entity_id=entity_id)
+
+        created_after = params.get("created_after")
+        if created_after:
+            queryset = queryset.filter(created_at__gte=_parse_bound("created_after", created_after))
+        created_before = params.get("created_before")
+        if created_before:
+            queryset = queryset.filter(created_at__lt=_parse_bound("created_before", created_before))
+
+        return queryset
+
+    @action(detail=False, methods=["get"])
+    def export(self, request):
+        output = request.query_params.get("output", "csv")
+        if output not in EXPORT_FORMATS:
+            raise ValidationError({"output": f"Formato no soportado. Opciones: {', '.join(EXPORT_FORMATS)}."})
+        compress = request.query_params.get("gzip") in ("1", "true")
+
+        filename = f"audit_log_{timezone.now():%Y%m%d_%H%M%S}.{output}"
+        content_type = EXPORT_FORMATS[output]
+        if compress:
+            filename += ".gz"
+            content_type = "application/gzip"
+        response = StreamingHttpResponse(
+            stream_export(self.get_queryset(), output=output, compress=compress),
+            content_type=content_type,
+        )
+        response["Content-Disposition"] = f'attachment; filename="{filename}"'
+        # Evitar que un proxy acumule la respuesta completa antes de enviarla
+        response["X-Accel-Buffering"] = "no"
+        return response
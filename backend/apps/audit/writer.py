@@ -0,0 +1,288 @@
+"""
+Escritor de auditoría en lotes.
+
+Modos (AUDIT_WRITE_MODE):
+- "sync": AuditLog.objects.create en el request (comportamiento original)
+- "buffered": los eventos se acumulan en memoria y se guardan con bulk_create
+  al terminar el request (señal request_finished, después de enviar la
+  respuesta) o cada AUDIT_FLUSH_SECONDS desde un hilo de fondo
+- "celery": igual que "buffered", pero el lote se entrega a una tarea Celery
+
+Durabilidad: cada evento se añade a un archivo spool local (JSON por línea)
+antes de volver al llamador. Al volcar, el spool se rota a un segmento
+".flushing" que se borra cuando el lote quedó guardado. Los segmentos de
+procesos muertos o de volcados fallidos se recuperan con recover_spool()
+(hilo de fondo y comando `flush_audit_spool`). Cada evento lleva su UUID
+desde el origen, así que reintentar un lote no duplica registros.
+
+Transacciones: log_audit_event encola el evento con transaction.on_commit, así
+que una escritura revertida no deja auditoría. A cambio, un proceso que muere
+entre el COMMIT y el encolado pierde el evento; las acciones que no lo toleran
+van en AUDIT_STRICT_ACTIONS (o log_audit_event(strict=True)) y se escriben
+siempre de forma síncrona, dentro de la misma transacción.
+"""
+import atexit
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from pathlib import Path
+
+from django.conf import settings
+from django.core.signals import request_finished
+from django.db import IntegrityError, close_old_connections, connection
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .models import AuditLog
+
+logger = logging.getLogger(__name__)
+
+MODE_SYNC = "sync"
+MODE_BUFFERED = "buffered"
+MODE_CELERY = "celery"
+
+SPOOL_SUFFIX = ".jsonl"
+SEGMENT_SUFFIX = ".flushing"
+CLAIM_SUFFIX = ".recovering"
+STALE_SEGMENT_SECONDS = 60
+RECOVER_EVERY_SECONDS = 60
+
+def get_write_mode():
+    return getattr(settings, "AUDIT_WRITE_MODE", MODE_SYNC)
+
+
+def is_strict_action(action):
+    return action in getattr(settings, "AUDIT_STRICT_ACTIONS", ())
+
+
+def get_spool_dir():
+    path = Path(getattr(settings, "AUDIT_SPOOL_DIR", Path(settings.BASE_DIR) / "storage" / "audit_spool"))
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+def build_row(company_id, actor_id, action, entity_type, entity_id, before, after, ip_address, user_agent):
+    """Evento serializable (JSON) con id y timestamp asignados en el origen."""
+    return {
+        "id": str(uuid.uuid4()),
+        "company_id": str(company_id) if company_id else None,
+        "actor_id": actor_id,
+        "action": action,
+        "entity_type": entity_type,
+        "entity_id": entity_id,
+        "before": before,
+        "after": after,
+        "ip_address": ip_address,
+        "user_agent": user_agent,
+        "created_at": timezone.now().isoformat(),
+    }
+
+
+def _to_instance(row):
+    data = dict(row)
+    data["created_at"] = parse_datetime(data["created_at"])
+    return AuditLog(**data)
+
+
+def persist_rows(rows):
+    """Guarda un lote; ignora ids ya guardados (reintentos/recuperación)."""
+    if not rows:
+        return 0
+    instances = [_to_instance(row) for row in rows]
+    try:
+        AuditLog.objects.bulk_create(instances, ignore_conflicts=True)
+    except IntegrityError:
+        # Un evento inválido (p. ej. company borrada) no debe perder el resto del lote
+        for instance in instances:
+            try:
+                AuditLog.objects.bulk_create([instance], ignore_conflicts=True)
+            except IntegrityError:
+                logger.error("Evento de auditoría descartado: %s", instance.id, exc_info=True)
+    return len(instances)
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class AuditWriter:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buffer = []
+        self._spool_file = None
+        self._spool_path = None
+        self._pid = None
+        self._thread = None
+        self._last_recover = 0.0
+
+    # -- Encolado -------------------------------------------------------------
+
+    def enqueue(self, row):
+        self._ensure_process()
+        with self._lock:
+            self._append_spool(row)
+            self._buffer.append(row)
+            full = len(self._buffer) >= int(getattr(settings, "AUDIT_BATCH_SIZE", 500))
+        if full:
+            self.flush()
+
+    def _append_spool(self, row):
+        if self._spool_file is None:
+            self._spool_file = open(self._spool_path, "a", encoding="utf-8")
+        self._spool_file.write(json.dumps(row, default=str) + "\n")
+        self._spool_file.flush()
+        if getattr(settings, "AUDIT_SPOOL_FSYNC", False):
+            os.fsync(self._spool_file.fileno())
+
+    # -- Volcado --------------------------------------------------------------
+
+    def pending(self):
+        with self._lock:
+            return len(self._buffer)
+
+    def flush(self):
+        """Guarda lo pendiente de este proceso. Retorna el número de eventos."""
+        with self._lock:
+            rows, self._buffer = self._buffer, []
+            if not rows:
+                return 0
+            segment = self._rotate_spool()
+        try:
+            self._deliver(rows)
+        except Exception:
+            # El segmento queda en disco y se reintenta con recover_spool()
+            logger.exception("No se pudo guardar el lote de auditoría (%d eventos)", len(rows))
+            return 0
+        if segment is not None:
+            segment.unlink(missing_ok=True)
+        return len(rows)
+
+    def _deliver(self, rows):
+        if get_write_mode() == MODE_CELERY:
+            from .tasks import persist_audit_batch
+
+            try:
+                persist_audit_batch.delay(rows)
+                return
+            except Exception:
+                logger.warning("Celery no disponible; guardando auditoría localmente", exc_info=True)
+        persist_rows(rows)
+
+    def _rotate_spool(self):
+        if self._spool_file is not None:
+            self._spool_file.close()
+            self._spool_file = None
+        if not self._spool_path.exists():
+            return None
+        segment = self._spool_path.with_name(
+            f"{self._spool_path.stem}-{time.time_ns()}{SEGMENT_SUFFIX}"
+        )
+        os.replace(self._spool_path, segment)
+        return segment
+
+    # -- Recuperación ---------------------------------------------------------
+
+    def recover_spool(self):
+        """
+        Guarda eventos de spools huérfanos: archivos de procesos muertos en este
+        host y segmentos cuyo volcado falló hace más de STALE_SEGMENT_SECONDS.
+        """
+        recovered = 0
+        host = socket.gethostname()
+        now = time.time()
+        for path in sorted(get_spool_dir().iterdir()):
+            if path == self._spool_path or not path.is_file():
+                continue
+            owner_host, _, rest = path.name.rpartition("@")
+            pid_text = rest.split("-", 1)[0].split(".", 1)[0]
+            owner_alive = owner_host == host and pid_text.isdigit() and _pid_alive(int(pid_text))
+            if path.name.endswith(SPOOL_SUFFIX):
+                if owner_alive or owner_host != host:
+                    continue
+            elif path.name.endswith((SEGMENT_SUFFIX, CLAIM_SUFFIX)):
+                if owner_alive and now - path.stat().st_mtime < STALE_SEGMENT_SECONDS:
+                    continue
+            else:
+                continue
+            # Reclamar con rename atómico para que solo un proceso lo procese
+            claimed = path.with_name(f"{path.name}.{os.getpid()}{CLAIM_SUFFIX}")
+            if path.name.endswith(CLAIM_SUFFIX):
+                claimed = path
+            else:
+                try:
+                    os.replace(path, claimed)
+                except FileNotFoundError:
+                    continue
+            rows = []
+            with open(claimed, encoding="utf-8") as handle:
+                for line in handle:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        rows.append(json.loads(line))
+                    except ValueError:
+                        # Línea truncada por un crash a mitad de escritura
+                        logger.warning("Línea inválida en spool de auditoría %s", claimed.name)
+            persist_rows(rows)
+            claimed.unlink(missing_ok=True)
+            recovered += len(rows)
+        return recovered
+
+    # -- Proceso / hilo de fondo ----------------------------------------------
+
+    def _ensure_process(self):
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        with self._lock:
+            if self._pid == pid:
+                return
+            # Tras un fork no heredar buffer ni archivo del padre
+            self._buffer = []
+            self._spool_file = None
+            self._spool_path = get_spool_dir() / f"{socket.gethostname()}@{pid}{SPOOL_SUFFIX}"
+            self._pid = pid
+            self._thread = threading.Thread(target=self._run, name="audit-writer", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(max(0.1, float(getattr(settings, "AUDIT_FLUSH_SECONDS", 2))))
+            try:
+                self.flush()
+                if time.time() - self._last_recover >= RECOVER_EVERY_SECONDS:
+                    self._last_recover = time.time()
+                    self.recover_spool()
+            except Exception:
+                logger.exception("Error en el hilo de auditoría")
+            finally:
+                # El hilo tiene su propia conexión: no dejarla abierta
+                connection.close()
+
+
+audit_writer = AuditWriter()
+
+
+def _flush_on_request_finished(sender, **kwargs):
+    # request_finished llega cuando la respuesta ya se envió al cliente
+    if audit_writer.pending():
+        try:
+            close_old_connections()
+            audit_writer.flush()
+        except Exception:
+            logger.exception("No se pudo volcar la auditoría al terminar el request")
+
+
+request_finished.connect(_flush_on_request_finished, dispatch_uid="audit_writer_flush")
+atexit.register(audit_writer.flush)
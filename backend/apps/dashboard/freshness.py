@@ -0,0 +1,154 @@
+"""
+Marcadores de vigencia de los snapshots del dashboard por sitec.
+
+refresh_dashboard_snapshots marca un sitec como "limpio" (clave en cache con
+la fecha del cálculo) justo antes de leer sus datos; cualquier escritura que
+cambie sus rollups borra la marca al confirmar la transacción. Así una
+escritura concurrente nunca se pierde: o la lectura ya la ve, o la marca
+desaparece y el sitec se recalcula en la siguiente corrida.
+
+Si falta la marca (cache reiniciado, expiración, cambio de día) el sitec se
+considera sucio. La marca expira a los DASHBOARD_SNAPSHOT_MAX_SKIP_MINUTES,
+lo que acota el tiempo que un cambio que no pasa por señales
+(queryset.update()) puede quedar fuera del snapshot.
+
+Los agregados mensuales de meses cerrados (DashboardAggregate.is_final) no
+se recalculan a diario: una escritura tardía con fecha en un mes cerrado lo
+reabre en la misma transacción (reopen_closed_months). Se reabre también el
+mes siguiente, cuyos comparativos contra el mes anterior cambian. Los
+agregados solo guardan campos de esos dos meses (services.MONTH_SCOPED_FIELDS)
+y projects_overdue al cierre de cada mes: un cambio en projects_open_due con
+vencimiento en un mes reabre ese mes y todos los cerrados posteriores.
+
+DashboardKpiView usa un lock por (company, sitec, período) para que solo un
+request (o una tarea de revalidación) calcule el snapshot a la vez.
+"""
+import logging
+import uuid
+from collections import defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache, caches
+from django.core.cache.backends.redis import RedisCache
+from django.utils import timezone
+
+from .models import DashboardAggregate
+
+logger = logging.getLogger(__name__)
+
+CLEAN_KEY = "dashboard:snapshot_clean:{sitec_id}"
+LOCK_KEY = "dashboard:snapshot_lock:{company_id}:{sitec_id}:{period_days}"
+# Borra la clave solo si aún tiene el token del dueño (atómico en Redis)
+RELEASE_LOCK_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+def _key(sitec_id):
+    return CLEAN_KEY.format(sitec_id=sitec_id)
+
+
+def mark_sitecs_dirty(sitec_ids):
+    keys = [_key(sitec_id) for sitec_id in set(sitec_ids)]
+    if not keys:
+        return
+    try:
+        cache.delete_many(keys)
+    except Exception:
+        # La marca expira sola; el sitec se recalcula a más tardar entonces
+        logger.warning("No se pudieron marcar sitecs como modificados", exc_info=True)
+
+
+def mark_sitec_clean(sitec_id, day):
+    timeout = int(getattr(settings, "DASHBOARD_SNAPSHOT_MAX_SKIP_MINUTES", 360)) * 60
+    try:
+        cache.set(_key(sitec_id), day.isoformat(), timeout=timeout)
+    except Exception:
+        logger.warning("No se pudo guardar la marca de snapshot de %s", sitec_id, exc_info=True)
+
+
+def dirty_sitec_ids(sitec_ids, day):
+    """Sitecs sin marca vigente para `day` (todos si el cache no responde)."""
+    keys = {sitec_id: _key(sitec_id) for sitec_id in sitec_ids}
+    try:
+        marks = cache.get_many(list(keys.values()))
+    except Exception:
+        logger.warning("Cache no disponible; se recalculan todos los snapshots", exc_info=True)
+        return list(sitec_ids)
+    return [sitec_id for sitec_id, key in keys.items() if marks.get(key) != day.isoformat()]
+
+
+def acquire_snapshot_lock(company_id, sitec_id, period_days):
+    """
+    Token del lock de cálculo del snapshot, o None si otro proceso lo tiene.
+    Expira a los DASHBOARD_SNAPSHOT_LOCK_SECONDS por si el dueño muere. Sin
+    cache disponible se concede (sin single-flight, como antes).
+    """
+    key = LOCK_KEY.format(company_id=company_id, sitec_id=sitec_id, period_days=period_days)
+    # Entero: RedisCache no lo serializa con pickle y el script lo compara tal cual
+    token = uuid.uuid4().int >> 66
+    timeout = int(getattr(settings, "DASHBOARD_SNAPSHOT_LOCK_SECONDS", 60))
+    try:
+        return token if cache.add(key, token, timeout=timeout) else None
+    except Exception:
+        logger.warning("Cache no disponible para el lock de snapshot", exc_info=True)
+        return token
+
+
+def release_snapshot_lock(company_id, sitec_id, period_days, token):
+    """Libera el lock solo si sigue siendo del dueño (si expiró y otro lo tomó, no se toca)."""
+    key = LOCK_KEY.format(company_id=company_id, sitec_id=sitec_id, period_days=period_days)
+    backend = caches["default"]
+    try:
+        if isinstance(backend, RedisCache):
+            client = backend._cache.get_client(key, write=True)
+            client.eval(RELEASE_LOCK_SCRIPT, 1, backend.make_and_validate_key(key), token)
+        elif backend.get(key) == token:
+            # Cache local (desarrollo/tests): un solo proceso
+            backend.delete(key)
+    except Exception:
+        logger.warning("No se pudo liberar el lock de snapshot", exc_info=True)
+
+
+def month_start(day):
+    return day.replace(day=1)
+
+
+def reopen_closed_months(keys, cumulative_keys=()):
+    """
+    Quita is_final a los meses cerrados tocados por (company_id, sitec_id, día).
+    Los `cumulative_keys` afectan a un acumulado al cierre de mes
+    (projects_overdue) y reabren todos los meses cerrados desde el del día.
+    """
+    current = month_start(timezone.now().date())
+    months = defaultdict(set)
+    for company_id, sitec_id, day in keys:
+        start = month_start(day)
+        following = month_start(start + timedelta(days=31))
+        months[(company_id, sitec_id)].update(month for month in (start, following) if month < current)
+    since = {}
+    for company_id, sitec_id, day in cumulative_keys:
+        start = month_start(day)
+        if start < current:
+            since[(company_id, sitec_id)] = min(start, since.get((company_id, sitec_id), start))
+    for (company_id, sitec_id), starts in months.items():
+        if starts:
+            DashboardAggregate.objects.filter(
+                company_id=company_id,
+                sitec_id=sitec_id,
+                period_label="month",
+                period_start__in=starts,
+                is_final=True,
+            ).update(is_final=False)
+    for (company_id, sitec_id), first in since.items():
+        DashboardAggregate.objects.filter(
+            company_id=company_id,
+            sitec_id=sitec_id,
+            period_label="month",
+            period_start__gte=first,
+            is_final=True,
+        ).update(is_final=False)
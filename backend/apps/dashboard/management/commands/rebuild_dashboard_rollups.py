@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from apps.companies.models import Company, Sitec
+from apps.dashboard.rollups import rebuild_rollups
+
+
+class Command(BaseCommand):
+    help = "Recalcula DailyMetricRollup desde reportes, proyectos y riesgos (backfill o corrección)."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--company", help="ID de la company (default: todas).")
+        parser.add_argument("--sitec", help="ID del sitec (default: todos).")
+
+    def handle(self, *args, **options):
+        company = Company.objects.get(pk=options["company"]) if options["company"] else None
+        sitec = Sitec.objects.get(pk=options["sitec"]) if options["sitec"] else None
+        rows = rebuild_rollups(company=company, sitec=sitec)
+        self.stdout.write(self.style.SUCCESS(f"Rollups recalculados: {rows} filas."))
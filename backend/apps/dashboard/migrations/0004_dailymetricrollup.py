@@ -0,0 +1,107 @@
+# Generated by Django 5.2.18 on 2026-10-18 20:19
+
+from collections import defaultdict
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+# Copia congelada de las reglas de apps.dashboard.rollups a la fecha de esta
+# migración: solo usa modelos históricos, así no depende del código vivo
+SUBMITTED_STATUSES = ("submitted", "approved")
+OPEN_PROJECT_STATUSES = ("planning", "in_progress")
+HIGH_SEVERITIES = ("high", "critical")
+BATCH_SIZE = 1000
+
+
+def backfill_rollups(apps, schema_editor):
+    ReporteSemanal = apps.get_model("reports", "ReporteSemanal")
+    Proyecto = apps.get_model("projects", "Proyecto")
+    Riesgo = apps.get_model("projects", "Riesgo")
+    DailyMetricRollup = apps.get_model("dashboard", "DailyMetricRollup")
+    rows = defaultdict(lambda: defaultdict(int))
+    local_day = TruncDate("created_at", tzinfo=timezone.get_current_timezone())
+
+    reports = (
+        ReporteSemanal.objects.order_by()
+        .values("company_id", "sitec_id", "project_id", "week_start", "status")
+        .annotate(total=models.Count("id"))
+    )
+    for row in reports.iterator():
+        counters = rows[(row["company_id"], row["sitec_id"], row["project_id"], row["week_start"])]
+        counters["reports"] += row["total"]
+        if row["status"] in SUBMITTED_STATUSES:
+            counters["reports_submitted"] += row["total"]
+        if row["status"] == "approved":
+            counters["reports_approved"] += row["total"]
+        if row["status"] == "submitted":
+            counters["reports_pending"] += row["total"]
+
+    projects = (
+        Proyecto.objects.order_by()
+        .values("id", "company_id", "sitec_id", "status", "end_date")
+        .annotate(day=local_day)
+    )
+    for row in projects.iterator():
+        base = (row["company_id"], row["sitec_id"], row["id"])
+        rows[base + (row["day"],)]["projects_created"] += 1
+        if row["status"] == "in_progress":
+            rows[base + (row["day"],)]["projects_in_progress"] += 1
+        if row["status"] in OPEN_PROJECT_STATUSES and row["end_date"]:
+            rows[base + (row["end_date"],)]["projects_open_due"] += 1
+
+    risks = (
+        Riesgo.objects.filter(severity__in=HIGH_SEVERITIES)
+        .order_by()
+        .annotate(day=local_day)
+        .values("project__company_id", "project__sitec_id", "project_id", "day")
+        .annotate(total=models.Count("id"))
+    )
+    for row in risks.iterator():
+        key = (row["project__company_id"], row["project__sitec_id"], row["project_id"], row["day"])
+        rows[key]["risks_high"] += row["total"]
+
+    DailyMetricRollup.objects.bulk_create(
+        [
+            DailyMetricRollup(company_id=company_id, sitec_id=sitec_id, project_id=project_id, day=day, **counters)
+            for (company_id, sitec_id, project_id, day), counters in rows.items()
+        ],
+        batch_size=BATCH_SIZE,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('companies', '0001_initial'),
+        ('dashboard', '0003_rename_dashboard_a_company_2b34cb_idx_dashboard_d_company_83808b_idx_and_more'),
+        ('projects', '0003_add_performance_indexes'),
+        ('reports', '0005_add_rejected_at'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyMetricRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('reports', models.IntegerField(default=0)),
+                ('reports_submitted', models.IntegerField(default=0)),
+                ('reports_approved', models.IntegerField(default=0)),
+                ('reports_pending', models.IntegerField(default=0)),
+                ('projects_created', models.IntegerField(default=0)),
+                ('projects_in_progress', models.IntegerField(default=0)),
+                ('projects_open_due', models.IntegerField(default=0)),
+                ('risks_high', models.IntegerField(default=0)),
+                ('company', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='companies.company')),
+                ('project', models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='projects.proyecto')),
+                ('sitec', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='companies.sitec')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['company', 'sitec', 'day'], name='dashboard_d_company_424f99_idx')],
+                'constraints': [models.UniqueConstraint(condition=models.Q(('project__isnull', False)), fields=('company', 'sitec', 'project', 'day'), name='dashboard_rollup_project_day_uniq'), models.UniqueConstraint(condition=models.Q(('project__isnull', True)), fields=('company', 'sitec', 'day'), name='dashboard_rollup_day_uniq')],
+            },
+        ),
+        migrations.RunPython(backfill_rollups, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 20:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0004_dailymetricrollup'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dashboardaggregate',
+            name='is_final',
+            field=models.BooleanField(default=False),
+        ),
+    ]
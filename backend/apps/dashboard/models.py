@@ -32,6 +32,8 @@ class DashboardAggregate(models.Model):
     period_start = models.DateField()
     period_end = models.DateField()
     payload = models.JSONField(default=dict, blank=True)
+    # Mes cerrado ya calculado: no se recalcula salvo escritura tardía en el mes
+    is_final = models.BooleanField(default=False)
     computed_at = models.DateTimeField()
     created_at = models.DateTimeField(auto_now_add=True)
 
@@ -43,3 +45,54 @@ class DashboardAggregate(models.Model):
 
     def __str__(self):
         return f"{self.company_id} {self.sitec_id} {self.period_label} {self.period_start}"
+
+
+class DailyMetricRollup(models.Model):
+    """
+    Contadores diarios por company/sitec/proyecto, mantenidos por señales
+    (ver rollups.py). El día depende del contador: week_start para reportes,
+    fecha local de created_at para proyectos y riesgos, y end_date para
+    projects_open_due (proyectos abiertos que vencen ese día).
+    """
+
+    company = models.ForeignKey(Company, on_delete=models.CASCADE)
+    sitec = models.ForeignKey(Sitec, on_delete=models.CASCADE)
+    # Sin constraint: al borrar un proyecto sus filas se conservan hasta que
+    # rebuild_rollups() reasigna los reportes (SET_NULL) a project=NULL
+    project = models.ForeignKey(
+        "projects.Proyecto",
+        on_delete=models.DO_NOTHING,
+        db_constraint=False,
+        null=True,
+        blank=True,
+        related_name="+",
+    )
+    day = models.DateField()
+    reports = models.IntegerField(default=0)
+    reports_submitted = models.IntegerField(default=0)
+    reports_approved = models.IntegerField(default=0)
+    reports_pending = models.IntegerField(default=0)
+    projects_created = models.IntegerField(default=0)
+    projects_in_progress = models.IntegerField(default=0)
+    projects_open_due = models.IntegerField(default=0)
+    risks_high = models.IntegerField(default=0)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["company", "sitec", "day"]),
+        ]
+        constraints = [
+            models.UniqueConstraint(
+                fields=["company", "sitec", "project", "day"],
+                condition=models.Q(project__isnull=False),
+                name="dashboard_rollup_project_day_uniq",
+            ),
+            models.UniqueConstraint(
+                fields=["company", "sitec", "day"],
+                condition=models.Q(project__isnull=True),
+                name="dashboard_rollup_day_uniq",
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.company_id} {self.sitec_id} {self.project_id or '-'} {self.day}"
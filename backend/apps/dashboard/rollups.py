@@ -0,0 +1,329 @@
+"""
+Rollups diarios de métricas del dashboard (DailyMetricRollup).
+
+Cada ReporteSemanal, Proyecto o Riesgo aporta +1 a uno o más contadores de
+una fila (company, sitec, proyecto, día). Las señales (signals.py) leen la
+fila fuente antes y después de guardarla y aplican solo la diferencia con
+UPDATE ... SET campo = campo + delta, dentro de la misma transacción. Al
+confirmar, el sitec queda marcado como modificado para el refresco de
+snapshots y se reabren los meses cerrados afectados (freshness.py).
+
+Aportes:
+- ReporteSemanal (día = week_start): reports; reports_submitted (submitted o
+  approved); reports_approved; reports_pending (submitted)
+- Proyecto (día = fecha local de created_at): projects_created;
+  projects_in_progress. Si está abierto (planning/in_progress) y tiene
+  end_date, projects_open_due en el día end_date
+- Riesgo high/critical (día = fecha local de created_at): risks_high
+
+Los cambios que no pasan por señales (queryset.update(), SET_NULL al borrar un
+proyecto, cambio de company/sitec de un proyecto) se corrigen reconstruyendo
+el sitec con rebuild_rollups() (comando `rebuild_dashboard_rollups`).
+"""
+import uuid
+from collections import defaultdict
+from datetime import timedelta
+
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Count, F, Q, Sum
+from django.db.models.functions import Coalesce, TruncDate
+from django.utils import timezone
+
+from apps.companies.models import Sitec
+from apps.projects.models import Proyecto, Riesgo
+from apps.reports.models import ReporteSemanal
+
+from .freshness import mark_sitecs_dirty, reopen_closed_months
+from .models import DailyMetricRollup, DashboardAggregate
+
+SUBMITTED_STATUSES = ("submitted", "approved")
+OPEN_PROJECT_STATUSES = ("planning", "in_progress")
+HIGH_SEVERITIES = ("high", "critical")
+BULK_BATCH_SIZE = 1000
+# Primer entero de pg_advisory_xact_lock(int, int) para los locks de rollups
+ADVISORY_LOCK_NAMESPACE = 22022
+
+REPORT = "report"
+PROJECT = "project"
+RISK = "risk"
+SOURCE_KINDS = {ReporteSemanal: REPORT, Proyecto: PROJECT, Riesgo: RISK}
+SOURCE_FIELDS = {
+    REPORT: ("company_id", "sitec_id", "project_id", "week_start", "status"),
+    PROJECT: ("id", "company_id", "sitec_id", "created_at", "status", "end_date"),
+    RISK: ("project_id", "project__company_id", "project__sitec_id", "created_at", "severity"),
+}
+
+
+def read_source(model, pk):
+    """Valores de la fila fuente que determinan sus aportes (None si no existe)."""
+    return model.objects.filter(pk=pk).values(*SOURCE_FIELDS[SOURCE_KINDS[model]]).first()
+
+
+def contributions(kind, row):
+    """{(company_id, sitec_id, project_id, día): {contador: n}} de una fila fuente."""
+    result = defaultdict(lambda: defaultdict(int))
+    if not row:
+        return result
+    if kind == REPORT:
+        counters = result[(row["company_id"], row["sitec_id"], row["project_id"], row["week_start"])]
+        counters["reports"] += 1
+        if row["status"] in SUBMITTED_STATUSES:
+            counters["reports_submitted"] += 1
+        if row["status"] == "approved":
+            counters["reports_approved"] += 1
+        if row["status"] == "submitted":
+            counters["reports_pending"] += 1
+    elif kind == PROJECT:
+        base = (row["company_id"], row["sitec_id"], row["id"])
+        counters = result[base + (timezone.localdate(row["created_at"]),)]
+        counters["projects_created"] += 1
+        if row["status"] == "in_progress":
+            counters["projects_in_progress"] += 1
+        if row["status"] in OPEN_PROJECT_STATUSES and row["end_date"]:
+            result[base + (row["end_date"],)]["projects_open_due"] += 1
+    elif kind == RISK:
+        if row["severity"] in HIGH_SEVERITIES:
+            key = (
+                row["project__company_id"],
+                row["project__sitec_id"],
+                row["project_id"],
+                timezone.localdate(row["created_at"]),
+            )
+            result[key]["risks_high"] += 1
+    return result
+
+
+def diff_contributions(model, before, after):
+    """Aportes de `after` menos los de `before`, sin entradas en cero."""
+    kind = SOURCE_KINDS[model]
+    deltas = defaultdict(lambda: defaultdict(int))
+    for sign, row in ((-1, before), (1, after)):
+        for key, counters in contributions(kind, row).items():
+            for name, value in counters.items():
+                deltas[key][name] += sign * value
+    return {
+        key: {name: value for name, value in counters.items() if value}
+        for key, counters in deltas.items()
+        if any(counters.values())
+    }
+
+
+def _key_filter(company_id, sitec_id, project_id, day):
+    return DailyMetricRollup.objects.filter(
+        company_id=company_id, sitec_id=sitec_id, project_id=project_id, day=day
+    )
+
+
+def _lock_sitecs(sitec_ids, shared):
+    """
+    Lock transaccional por sitec: apply_deltas lo toma compartido (las
+    escrituras no se bloquean entre sí) y rebuild_rollups exclusivo, de modo
+    que una reconstrucción nunca borra el delta de una escritura que no leyó.
+    Solo PostgreSQL; SQLite ya serializa las escrituras.
+    """
+    if connection.vendor != "postgresql":
+        return
+    function = "pg_advisory_xact_lock_shared" if shared else "pg_advisory_xact_lock"
+    # Orden fijo para no generar deadlocks entre transacciones
+    keys = sorted({uuid.UUID(str(sitec_id)).int & 0x7FFFFFFF for sitec_id in sitec_ids})
+    with connection.cursor() as cursor:
+        for key in keys:
+            cursor.execute(f"SELECT {function}(%s, %s)", [ADVISORY_LOCK_NAMESPACE, key])
+
+
+def apply_deltas(deltas):
+    if not deltas:
+        return
+    sitec_ids = {sitec_id for _, sitec_id, _, _ in deltas}
+    with transaction.atomic():
+        _lock_sitecs(sitec_ids, shared=True)
+        transaction.on_commit(lambda: mark_sitecs_dirty(sitec_ids))
+        reopen_closed_months(
+            [(company_id, sitec_id, day) for company_id, sitec_id, _, day in deltas],
+            [
+                (company_id, sitec_id, day)
+                for (company_id, sitec_id, _, day), counters in deltas.items()
+                if counters.get("projects_open_due")
+            ],
+        )
+        _apply_deltas(deltas)
+
+
+def _apply_deltas(deltas):
+    for (company_id, sitec_id, project_id, day), counters in deltas.items():
+        updates = {name: F(name) + value for name, value in counters.items()}
+        if _key_filter(company_id, sitec_id, project_id, day).update(**updates):
+            continue
+        if not any(value > 0 for value in counters.values()):
+            # Solo restas sobre una fila inexistente: ya se borró en cascada
+            # (company/sitec eliminados); no recrearla
+            continue
+        try:
+            with transaction.atomic():
+                DailyMetricRollup.objects.create(
+                    company_id=company_id,
+                    sitec_id=sitec_id,
+                    project_id=project_id,
+                    day=day,
+                    **{name: max(value, 0) for name, value in counters.items()},
+                )
+        except IntegrityError:
+            # Otra transacción creó la fila entre el UPDATE y el INSERT
+            _key_filter(company_id, sitec_id, project_id, day).update(**updates)
+
+
+def rebuild_rollups(company=None, sitec=None):
+    """Recalcula desde las tablas fuente los rollups del alcance indicado."""
+    scope = Q()
+    if company is not None:
+        scope &= Q(company=company)
+    if sitec is not None:
+        scope &= Q(sitec=sitec)
+    project_scope = Q()
+    if company is not None:
+        project_scope &= Q(project__company=company)
+    if sitec is not None:
+        project_scope &= Q(project__sitec=sitec)
+
+    sitec_scope = Q()
+    if company is not None:
+        sitec_scope &= Q(company=company)
+    if sitec is not None:
+        sitec_scope &= Q(pk=getattr(sitec, "pk", sitec))
+
+    with transaction.atomic():
+        # Las tablas fuente se leen con el lock tomado (ver _lock_sitecs)
+        _lock_sitecs(Sitec.objects.filter(sitec_scope).values_list("id", flat=True), shared=False)
+        rows = defaultdict(lambda: defaultdict(int))
+        local_day = TruncDate("created_at", tzinfo=timezone.get_current_timezone())
+
+        reports = (
+            ReporteSemanal.objects.filter(scope)
+            .order_by()
+            .values("company_id", "sitec_id", "project_id", "week_start", "status")
+            .annotate(total=Count("id"))
+        )
+        for row in reports.iterator():
+            for key, counters in contributions(REPORT, row).items():
+                for name, value in counters.items():
+                    rows[key][name] += value * row["total"]
+
+        projects = (
+            Proyecto.objects.filter(scope)
+            .order_by()
+            .values("id", "company_id", "sitec_id", "status", "end_date")
+            .annotate(day=local_day)
+        )
+        for row in projects.iterator():
+            base = (row["company_id"], row["sitec_id"], row["id"])
+            rows[base + (row["day"],)]["projects_created"] += 1
+            if row["status"] == "in_progress":
+                rows[base + (row["day"],)]["projects_in_progress"] += 1
+            if row["status"] in OPEN_PROJECT_STATUSES and row["end_date"]:
+                rows[base + (row["end_date"],)]["projects_open_due"] += 1
+
+        risks = (
+            Riesgo.objects.filter(project_scope, severity__in=HIGH_SEVERITIES)
+            .order_by()
+            .annotate(day=local_day)
+            .values("project__company_id", "project__sitec_id", "project_id", "day")
+            .annotate(total=Count("id"))
+        )
+        for row in risks.iterator():
+            key = (row["project__company_id"], row["project__sitec_id"], row["project_id"], row["day"])
+            rows[key]["risks_high"] += row["total"]
+
+        sitec_ids = set(DailyMetricRollup.objects.filter(scope).values_list("sitec_id", flat=True).distinct())
+        sitec_ids.update(sitec_id for _, sitec_id, _, _ in rows)
+        transaction.on_commit(lambda: mark_sitecs_dirty(sitec_ids))
+        # La reconstrucción corrige cambios sin señales en cualquier mes
+        DashboardAggregate.objects.filter(sitec_id__in=sitec_ids, is_final=True).update(is_final=False)
+        DailyMetricRollup.objects.filter(scope).delete()
+        DailyMetricRollup.objects.bulk_create(
+            [
+                DailyMetricRollup(
+                    company_id=company_id, sitec_id=sitec_id, project_id=project_id, day=day, **counters
+                )
+                for (company_id, sitec_id, project_id, day), counters in rows.items()
+            ],
+            batch_size=BULK_BATCH_SIZE,
+        )
+    return len(rows)
+
+
+# Contadores que dependen de la ventana last/prev del período; el resto solo
+# depende de end_date y es común a todos los períodos
+WINDOW_COUNTERS = ("reports", "reports_submitted", "projects_created", "risks_high")
+
+
+def _total(field, condition=None):
+    return Coalesce(Sum(field, filter=condition), 0)
+
+
+def _between(start, end):
+    return Q(day__gte=start, day__lt=end)
+
+
+def _shared_totals(ranges, end_date):
+    def in_range(name):
+        return _between(*ranges[name])
+
+    return dict(
+        reports_last_30d=_total("reports", Q(day__gte=end_date - timedelta(days=30))),
+        reports_prev_30d=_total("reports", _between(end_date - timedelta(days=60), end_date - timedelta(days=30))),
+        reports_pending_approval=_total("reports_pending"),
+        reports_month=_total("reports", in_range("month")),
+        reports_prev_month=_total("reports", in_range("prev_month")),
+        reports_submitted_month=_total("reports_submitted", in_range("month")),
+        reports_submitted_prev_month=_total("reports_submitted", in_range("prev_month")),
+        reports_year=_total("reports", in_range("year")),
+        reports_prev_year=_total("reports", in_range("prev_year")),
+        reports_submitted_year=_total("reports_submitted", in_range("year")),
+        reports_submitted_prev_year=_total("reports_submitted", in_range("prev_year")),
+        projects_total=_total("projects_created"),
+        projects_in_progress=_total("projects_in_progress"),
+        projects_overdue=_total("projects_open_due", Q(day__lt=end_date)),
+        projects_created_month=_total("projects_created", in_range("month")),
+        projects_created_prev_month=_total("projects_created", in_range("prev_month")),
+        projects_created_year=_total("projects_created", in_range("year")),
+        projects_created_prev_year=_total("projects_created", in_range("prev_year")),
+        risks_high=_total("risks_high"),
+    )
+
+
+def rollup_counts(company, sitec, ranges, end_date, project_id=None):
+    """
+    Contadores de build_dashboard_payload_range sumando rollups en una sola
+    consulta. `ranges` = {nombre: (inicio, fin)} de fechas [inicio, fin).
+    """
+    windows = {None: {"last": ranges["last"], "prev": ranges["prev"]}}
+    return rollup_counts_by_window(company, sitec, ranges, windows, end_date, project_id=project_id)[None]
+
+
+def rollup_counts_by_window(company, sitec, ranges, windows, end_date, project_id=None):
+    """
+    Contadores de varias ventanas (p. ej. todos los períodos de snapshot) en
+    una sola consulta. `windows` = {clave: {"last": (inicio, fin), "prev":
+    (inicio, fin)}}; `ranges` aporta los rangos comunes (mes y año). Retorna
+    {clave: contadores}.
+    """
+    queryset = DailyMetricRollup.objects.filter(company=company, sitec=sitec)
+    if project_id:
+        queryset = queryset.filter(project_id=project_id)
+
+    # Alias con prefijo: algunos nombres coinciden con campos del modelo
+    aggregates = {f"agg_{name}": expression for name, expression in _shared_totals(ranges, end_date).items()}
+    for index, window in enumerate(windows.values()):
+        for counter in WINDOW_COUNTERS:
+            for side in ("last", "prev"):
+                aggregates[f"w{index}_{counter}_{side}"] = _total(counter, _between(*window[side]))
+    result = queryset.aggregate(**aggregates)
+
+    shared = {name[len("agg_"):]: value for name, value in result.items() if name.startswith("agg_")}
+    counts = {}
+    for index, key in enumerate(windows):
+        counts[key] = dict(shared)
+        for counter in WINDOW_COUNTERS:
+            for side in ("last", "prev"):
+                counts[key][f"{counter}_{side}"] = result[f"w{index}_{counter}_{side}"]
+    return counts
@@ -1,11 +1,15 @@
-from datetime import date, timedelta
+from collections import defaultdict
+from datetime import date, datetime, time, timedelta
 
+from django.conf import settings
+from django.db.models import Count, Max, Q
 from django.utils import timezone
 
 from apps.projects.models import Proyecto, Riesgo
 from apps.reports.models import ReporteSemanal
 
 from .models import DashboardAggregate, DashboardSnapshot
+from .rollups import rollup_counts, rollup_counts_by_window
 
 
 def _pct_delta(current, previous):
@@ -22,69 +26,178 @@ def build_dashboard_payload(company, sitec, period_days=7, project_id=None):
     return build_dashboard_payload_range(company, sitec, start_date, now.date(), prev_start, prev_end, project_id=project_id)
 
 
-def build_dashboard_payload_range(company, sitec, start_date, end_date, prev_start, prev_end, project_id=None):
-    # Optimizar consultas con select_related/prefetch_related
-    # Usar only() para reducir datos transferidos cuando solo necesitamos campos específicos
+SUBMITTED_STATUSES = ["submitted", "approved"]
+HIGH_SEVERITIES = ["high", "critical"]
+
+
+def _day_start(day):
+    """Inicio del día en la zona horaria activa (equivale a created_at__date)."""
+    return timezone.make_aware(datetime.combine(day, time.min))
+
+
+def _comparison_ranges(end_date):
+    """Mes y año de end_date y sus anteriores como rangos [inicio, fin)."""
+    month_start = date(end_date.year, end_date.month, 1)
+    if end_date.month == 12:
+        month_end = date(end_date.year + 1, 1, 1)
+        prev_month_start = date(end_date.year, 11, 1)
+    else:
+        month_end = date(end_date.year, end_date.month + 1, 1)
+        if end_date.month == 1:
+            prev_month_start = date(end_date.year - 1, 12, 1)
+        else:
+            prev_month_start = date(end_date.year, end_date.month - 1, 1)
+    year_start = date(end_date.year, 1, 1)
+    return {
+        "month": (month_start, month_end),
+        "prev_month": (prev_month_start, month_start),
+        "year": (year_start, date(end_date.year + 1, 1, 1)),
+        "prev_year": (date(end_date.year - 1, 1, 1), year_start),
+    }
+
+
+def _table_counts(company, sitec, ranges, end_date, project_id=None):
+    """
+    Contadores del dashboard con una consulta agregada por tabla (reportes,
+    proyectos, riesgos): cada ventana es un Count(filter=Q(...)). Los filtros
+    por fecha de created_at usan rangos [inicio, fin) sobre el datetime para
+    aprovechar los índices.
+    """
     projects_qs = Proyecto.objects.filter(company=company, sitec=sitec)
-    if project_id:
-        projects_qs = projects_qs.filter(id=project_id)
-    projects = (
-        projects_qs
-        .select_related("company", "sitec")
-        .only("id", "status", "end_date", "created_at")
-    )
-    
     reports_qs = ReporteSemanal.objects.filter(company=company, sitec=sitec)
-    if project_id:
-        reports_qs = reports_qs.filter(project_id=project_id)
-    reports = (
-        reports_qs
-        .select_related("company", "sitec")
-        .only("id", "week_start", "status", "created_at")
-    )
-    
     risks_qs = Riesgo.objects.filter(project__company=company, project__sitec=sitec)
     if project_id:
+        projects_qs = projects_qs.filter(id=project_id)
+        reports_qs = reports_qs.filter(project_id=project_id)
         risks_qs = risks_qs.filter(project_id=project_id)
-    risks = (
-        risks_qs
-        .select_related("project")
-        .only("id", "severity", "created_at")
+
+    def week(name):
+        start, end = ranges[name]
+        return Q(week_start__gte=start, week_start__lt=end)
+
+    def created(name):
+        start, end = ranges[name]
+        return Q(created_at__gte=_day_start(start), created_at__lt=_day_start(end))
+
+    submitted = Q(status__in=SUBMITTED_STATUSES)
+    counts = reports_qs.aggregate(
+        reports_last=Count("id", filter=week("last")),
+        reports_prev=Count("id", filter=week("prev")),
+        reports_submitted_last=Count("id", filter=week("last") & submitted),
+        reports_submitted_prev=Count("id", filter=week("prev") & submitted),
+        reports_last_30d=Count("id", filter=Q(week_start__gte=end_date - timedelta(days=30))),
+        reports_prev_30d=Count(
+            "id",
+            filter=Q(
+                week_start__gte=end_date - timedelta(days=60),
+                week_start__lt=end_date - timedelta(days=30),
+            ),
+        ),
+        reports_pending_approval=Count("id", filter=Q(status="submitted")),
+        reports_month=Count("id", filter=week("month")),
+        reports_prev_month=Count("id", filter=week("prev_month")),
+        reports_submitted_month=Count("id", filter=week("month") & submitted),
+        reports_submitted_prev_month=Count("id", filter=week("prev_month") & submitted),
+        reports_year=Count("id", filter=week("year")),
+        reports_prev_year=Count("id", filter=week("prev_year")),
+        reports_submitted_year=Count("id", filter=week("year") & submitted),
+        reports_submitted_prev_year=Count("id", filter=week("prev_year") & submitted),
+    )
+    counts.update(
+        projects_qs.aggregate(
+            projects_total=Count("id"),
+            projects_in_progress=Count("id", filter=Q(status="in_progress")),
+            projects_overdue=Count(
+                "id", filter=Q(status__in=["planning", "in_progress"], end_date__lt=end_date)
+            ),
+            projects_created_last=Count("id", filter=created("last")),
+            projects_created_prev=Count("id", filter=created("prev")),
+            projects_created_month=Count("id", filter=created("month")),
+            projects_created_prev_month=Count("id", filter=created("prev_month")),
+            projects_created_year=Count("id", filter=created("year")),
+            projects_created_prev_year=Count("id", filter=created("prev_year")),
+        )
     )
+    high = Q(severity__in=HIGH_SEVERITIES)
+    counts.update(
+        risks_qs.aggregate(
+            risks_high=Count("id", filter=high),
+            risks_high_last=Count("id", filter=high & created("last")),
+            risks_high_prev=Count("id", filter=high & created("prev")),
+        )
+    )
+    return counts
+
 
-    reports_last = reports.filter(week_start__gte=start_date, week_start__lt=end_date).count()
-    reports_prev = reports.filter(week_start__gte=prev_start, week_start__lt=prev_end).count()
-    reports_submitted_last = reports.filter(
-        week_start__gte=start_date, week_start__lt=end_date, status__in=["submitted", "approved"]
-    ).count()
-    reports_submitted_prev = reports.filter(
-        week_start__gte=prev_start, week_start__lt=prev_end, status__in=["submitted", "approved"]
-    ).count()
-    reports_last_30d = reports.filter(week_start__gte=end_date - timedelta(days=30)).count()
-    reports_prev_30d = reports.filter(
-        week_start__gte=end_date - timedelta(days=60),
-        week_start__lt=end_date - timedelta(days=30),
-    ).count()
-
-    projects_overdue = projects.filter(status__in=["planning", "in_progress"], end_date__lt=end_date).count()
-    risks_high = risks.filter(severity__in=["high", "critical"]).count()
-    projects_created_last = projects.filter(
-        created_at__date__gte=start_date, created_at__date__lt=end_date
-    ).count()
-    projects_created_prev = projects.filter(
-        created_at__date__gte=prev_start, created_at__date__lt=prev_end
-    ).count()
-    risks_high_last = risks.filter(
-        severity__in=["high", "critical"],
-        created_at__date__gte=start_date,
-        created_at__date__lt=end_date,
-    ).count()
-    risks_high_prev = risks.filter(
-        severity__in=["high", "critical"],
-        created_at__date__gte=prev_start,
-        created_at__date__lt=prev_end,
-    ).count()
-    reports_pending_approval = reports.filter(status="submitted").count()
+def build_dashboard_payload_range(company, sitec, start_date, end_date, prev_start, prev_end, project_id=None):
+    """
+    KPIs del dashboard para [start_date, end_date) y su período anterior.
+
+    Con DASHBOARD_ROLLUPS_ENABLED los contadores salen de DailyMetricRollup
+    (una consulta, costo proporcional al número de días); si no, de las
+    tablas fuente (una consulta por tabla).
+    """
+    ranges = {"last": (start_date, end_date), "prev": (prev_start, prev_end)}
+    ranges.update(_comparison_ranges(end_date))
+    if getattr(settings, "DASHBOARD_ROLLUPS_ENABLED", True):
+        counts = rollup_counts(company, sitec, ranges, end_date, project_id=project_id)
+    else:
+        counts = _table_counts(company, sitec, ranges, end_date, project_id=project_id)
+    return _payload_from_counts(counts, (end_date - start_date).days)
+
+
+def build_dashboard_payloads(company, sitec, periods):
+    """
+    {period_days: payload} de build_dashboard_payload para varios períodos en
+    una pasada: con rollups, una sola consulta para todos.
+    """
+    today = timezone.now().date()
+    ranges = _comparison_ranges(today)
+    windows = {
+        period: {
+            "last": (today - timedelta(days=period), today),
+            "prev": (today - timedelta(days=period * 2), today - timedelta(days=period)),
+        }
+        for period in periods
+    }
+    if getattr(settings, "DASHBOARD_ROLLUPS_ENABLED", True):
+        counts = rollup_counts_by_window(company, sitec, ranges, windows, today)
+    else:
+        counts = {
+            period: _table_counts(company, sitec, {**ranges, **window}, today)
+            for period, window in windows.items()
+        }
+    return {period: _payload_from_counts(counts[period], period) for period in periods}
+
+
+def _payload_from_counts(counts, period_days):
+    reports_last = counts["reports_last"]
+    reports_prev = counts["reports_prev"]
+    reports_submitted_last = counts["reports_submitted_last"]
+    reports_submitted_prev = counts["reports_submitted_prev"]
+    reports_last_30d = counts["reports_last_30d"]
+    reports_prev_30d = counts["reports_prev_30d"]
+    reports_pending_approval = counts["reports_pending_approval"]
+    reports_month = counts["reports_month"]
+    reports_prev_month = counts["reports_prev_month"]
+    reports_submitted_month = counts["reports_submitted_month"]
+    reports_submitted_prev_month = counts["reports_submitted_prev_month"]
+    reports_year = counts["reports_year"]
+    reports_prev_year = counts["reports_prev_year"]
+    reports_submitted_year = counts["reports_submitted_year"]
+    reports_submitted_prev_year = counts["reports_submitted_prev_year"]
+
+    projects_overdue = counts["projects_overdue"]
+    projects_created_last = counts["projects_created_last"]
+    projects_created_prev = counts["projects_created_prev"]
+    projects_created_month = counts["projects_created_month"]
+    projects_created_prev_month = counts["projects_created_prev_month"]
+    projects_created_year = counts["projects_created_year"]
+    projects_created_prev_year = counts["projects_created_prev_year"]
+
+    risks_high = counts["risks_high"]
+    risks_high_last = counts["risks_high_last"]
+    risks_high_prev = counts["risks_high_prev"]
 
     alerts = []
     if projects_overdue:
@@ -99,66 +212,15 @@ def build_dashboard_payload_range(company, sitec, start_date, end_date, prev_sta
             }
         )
 
-    # Calcular comparativos mes anterior
-    month_start = date(end_date.year, end_date.month, 1)
-    if end_date.month == 12:
-        month_end = date(end_date.year + 1, 1, 1)
-        prev_month_start = date(end_date.year, 11, 1)
-        prev_month_end = month_start
-    else:
-        month_end = date(end_date.year, end_date.month + 1, 1)
-        if end_date.month == 1:
-            prev_month_start = date(end_date.year - 1, 12, 1)
-            prev_month_end = month_start
-        else:
-            prev_month_start = date(end_date.year, end_date.month - 1, 1)
-            prev_month_end = month_start
-    
-    reports_month = reports.filter(week_start__gte=month_start, week_start__lt=month_end).count()
-    reports_prev_month = reports.filter(week_start__gte=prev_month_start, week_start__lt=prev_month_end).count()
-    reports_submitted_month = reports.filter(
-        week_start__gte=month_start, week_start__lt=month_end, status__in=["submitted", "approved"]
-    ).count()
-    reports_submitted_prev_month = reports.filter(
-        week_start__gte=prev_month_start, week_start__lt=prev_month_end, status__in=["submitted", "approved"]
-    ).count()
-    projects_created_month = projects.filter(
-        created_at__date__gte=month_start, created_at__date__lt=month_end
-    ).count()
-    projects_created_prev_month = projects.filter(
-        created_at__date__gte=prev_month_start, created_at__date__lt=prev_month_end
-    ).count()
-    
-    # Calcular comparativos año anterior
-    year_start = date(end_date.year, 1, 1)
-    year_end = date(end_date.year + 1, 1, 1)
-    prev_year_start = date(end_date.year - 1, 1, 1)
-    prev_year_end = year_start
-    
-    reports_year = reports.filter(week_start__gte=year_start, week_start__lt=year_end).count()
-    reports_prev_year = reports.filter(week_start__gte=prev_year_start, week_start__lt=prev_year_end).count()
-    reports_submitted_year = reports.filter(
-        week_start__gte=year_start, week_start__lt=year_end, status__in=["submitted", "approved"]
-    ).count()
-    reports_submitted_prev_year = reports.filter(
-        week_start__gte=prev_year_start, week_start__lt=prev_year_end, status__in=["submitted", "approved"]
-    ).count()
-    projects_created_year = projects.filter(
-        created_at__date__gte=year_start, created_at__date__lt=year_end
-    ).count()
-    projects_created_prev_year = projects.filter(
-        created_at__date__gte=prev_year_start, created_at__date__lt=prev_year_end
-    ).count()
-
     return {
-        "projects_total": projects.count(),
-        "projects_in_progress": projects.filter(status="in_progress").count(),
+        "projects_total": counts["projects_total"],
+        "projects_in_progress": counts["projects_in_progress"],
         "projects_overdue": projects_overdue,
         "reports_last_7d": reports_last,
         "reports_submitted_last_7d": reports_submitted_last,
         "reports_last_period": reports_last,
         "reports_submitted_last_period": reports_submitted_last,
-        "period_days": (end_date - start_date).days,
+        "period_days": period_days,
         "risks_high": risks_high,
         "projects_created_last_period": projects_created_last,
         "risks_high_last_period": risks_high_last,
@@ -209,19 +271,19 @@ def build_dashboard_payload_range(company, sitec, start_date, end_date, prev_sta
     }
 
 
-def get_recent_snapshot(company, sitec, ttl_minutes=15):
+def get_recent_snapshot(company, sitec, ttl_minutes=15, period_days=None):
     ttl = timezone.now() - timedelta(minutes=ttl_minutes)
-    return (
-        DashboardSnapshot.objects.filter(company=company, sitec=sitec, computed_at__gte=ttl)
-        .order_by("-computed_at")
-        .first()
-    )
+    snapshots = DashboardSnapshot.objects.filter(company=company, sitec=sitec, computed_at__gte=ttl)
+    if period_days is not None:
+        snapshots = snapshots.filter(period_days=period_days)
+    return snapshots.order_by("-computed_at").first()
 
 
-def create_snapshot(company, sitec, period_days=7, computed_at=None):
+def create_snapshot(company, sitec, period_days=7, computed_at=None, payload=None):
     computed_at = computed_at or timezone.now()
     computed_at = computed_at.replace(second=0, microsecond=0)
-    payload = build_dashboard_payload(company, sitec, period_days=period_days)
+    if payload is None:
+        payload = build_dashboard_payload(company, sitec, period_days=period_days)
     snapshot, _ = DashboardSnapshot.objects.update_or_create(
         company=company,
         sitec=sitec,
@@ -232,6 +294,47 @@ def create_snapshot(company, sitec, period_days=7, computed_at=None):
     return snapshot
 
 
+def create_snapshots(company, sitec, periods, computed_at=None):
+    """create_snapshot para varios períodos calculando los payloads en una pasada."""
+    computed_at = (computed_at or timezone.now()).replace(second=0, microsecond=0)
+    payloads = build_dashboard_payloads(company, sitec, periods)
+    return [
+        DashboardSnapshot.objects.update_or_create(
+            company=company,
+            sitec=sitec,
+            period_days=period,
+            computed_at=computed_at,
+            defaults={"payload": payload},
+        )[0]
+        for period, payload in payloads.items()
+    ]
+
+
+def restamp_snapshots(sitec_ids, periods, computed_at):
+    """
+    Adelanta a `computed_at` el último snapshot de cada período de los sitecs
+    sin cambios (su payload sigue vigente). Retorna los sitecs que no tenían
+    todos los períodos y deben recalcularse.
+    """
+    computed_at = computed_at.replace(second=0, microsecond=0)
+    latest = (
+        DashboardSnapshot.objects.filter(sitec_id__in=sitec_ids, period_days__in=periods)
+        .values("sitec_id", "period_days")
+        .annotate(last=Max("computed_at"))
+    )
+    groups = defaultdict(list)
+    found = defaultdict(set)
+    for row in latest:
+        found[row["sitec_id"]].add(row["period_days"])
+        if row["last"] != computed_at:
+            groups[(row["period_days"], row["last"])].append(row["sitec_id"])
+    for (period, last), ids in groups.items():
+        DashboardSnapshot.objects.filter(sitec_id__in=ids, period_days=period, computed_at=last).update(
+            computed_at=computed_at
+        )
+    return [sitec_id for sitec_id in sitec_ids if not set(periods) <= found[sitec_id]]
+
+
 def _month_range(anchor):
     start = date(anchor.year, anchor.month, 1)
     if anchor.month == 12:
@@ -241,11 +344,58 @@ def _month_range(anchor):
     return start, end
 
 
-def create_monthly_aggregate(company, sitec, anchor_date=None):
+# Campos del payload que se guardan en los agregados mensuales: los acotados al
+# mes y a su mes anterior, más projects_overdue al cierre del mes (proyectos
+# abiertos con end_date anterior a period_end; una escritura con vencimiento
+# en un mes reabre ese mes y todos los siguientes, ver reopen_closed_months).
+# El resto (totales actuales, acumulados del año, comparativos del mes de
+# end_date) cambia con escrituras de otros meses y no se guarda
+MONTH_SCOPED_FIELDS = (
+    "reports_last_7d",
+    "reports_submitted_last_7d",
+    "reports_last_period",
+    "reports_submitted_last_period",
+    "period_days",
+    "projects_created_last_period",
+    "projects_overdue",
+    "risks_high_last_period",
+)
+MONTH_SCOPED_COMPARATIVES = (
+    "reports_last_period_",
+    "reports_submitted_last_period_",
+    "projects_created_last_period_",
+    "risks_high_last_period_",
+    "reports_last_7d_",
+    "reports_submitted_last_7d_",
+)
+
+
+def _month_scoped(payload):
+    scoped = {key: payload[key] for key in MONTH_SCOPED_FIELDS}
+    scoped["comparatives"] = {
+        key: value
+        for key, value in payload["comparatives"].items()
+        if key.startswith(MONTH_SCOPED_COMPARATIVES)
+    }
+    return scoped
+
+
+def create_monthly_aggregate(company, sitec, anchor_date=None, final=False):
+    """
+    Calcula el agregado del mes de anchor_date. Con `final` (mes cerrado) el
+    agregado existente se marca is_final antes de leer los datos: una
+    escritura tardía posterior lo desmarca y se recalcula en la siguiente
+    corrida. Un agregado nuevo se crea sin marcar y se finaliza en la
+    siguiente corrida.
+    """
     anchor_date = anchor_date or timezone.now().date()
     start, end = _month_range(anchor_date)
     prev_start, prev_end = _month_range(start - timedelta(days=1))
-    payload = build_dashboard_payload_range(company, sitec, start, end, prev_start, prev_end)
+    if final:
+        DashboardAggregate.objects.filter(
+            company=company, sitec=sitec, period_label="month", period_start=start
+        ).update(is_final=True)
+    payload = _month_scoped(build_dashboard_payload_range(company, sitec, start, end, prev_start, prev_end))
     aggregate, _ = DashboardAggregate.objects.update_or_create(
         company=company,
         sitec=sitec,
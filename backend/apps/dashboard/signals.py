@@ -0,0 +1,60 @@
+"""
+Mantenimiento incremental de DailyMetricRollup (ver rollups.py).
+"""
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_delete, pre_save
+
+from apps.projects.models import Proyecto, Riesgo
+from apps.reports.models import ReporteSemanal
+
+from .rollups import apply_deltas, diff_contributions, read_source
+from .tasks import rebuild_sitec_rollups
+
+ROLLUP_SOURCES = (ReporteSemanal, Proyecto, Riesgo)
+
+
+def remember_rollup_source(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    instance._rollup_before = None if instance._state.adding else read_source(sender, instance.pk)
+
+
+def update_rollups_on_save(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    before = getattr(instance, "_rollup_before", None)
+    after = read_source(sender, instance.pk)
+    apply_deltas(diff_contributions(sender, before, after))
+    instance._rollup_before = after
+
+    if sender is Proyecto and before and (
+        (before["company_id"], before["sitec_id"]) != (after["company_id"], after["sitec_id"])
+    ):
+        # Los reportes y riesgos del proyecto cambian de sitec sin pasar por señales
+        _rebuild_on_commit(before["company_id"], before["sitec_id"])
+        _rebuild_on_commit(after["company_id"], after["sitec_id"])
+
+
+def remember_rollup_source_on_delete(sender, instance, **kwargs):
+    instance._rollup_before = read_source(sender, instance.pk)
+
+
+def update_rollups_on_delete(sender, instance, **kwargs):
+    before = getattr(instance, "_rollup_before", None)
+    apply_deltas(diff_contributions(sender, before, None))
+    if sender is Proyecto and before:
+        # Los reportes pasan a project=NULL con SET_NULL (sin señales)
+        _rebuild_on_commit(before["company_id"], before["sitec_id"])
+
+
+def _rebuild_on_commit(company_id, sitec_id):
+    # Recorre todo el sitec: en Celery, fuera del request
+    transaction.on_commit(lambda: rebuild_sitec_rollups.delay(str(company_id), str(sitec_id)))
+
+
+for model in ROLLUP_SOURCES:
+    label = model._meta.label_lower
+    pre_save.connect(remember_rollup_source, sender=model, dispatch_uid=f"rollup_pre_save_{label}")
+    post_save.connect(update_rollups_on_save, sender=model, dispatch_uid=f"rollup_post_save_{label}")
+    pre_delete.connect(remember_rollup_source_on_delete, sender=model, dispatch_uid=f"rollup_pre_delete_{label}")
+    post_delete.connect(update_rollups_on_delete, sender=model, dispatch_uid=f"rollup_post_delete_{label}")
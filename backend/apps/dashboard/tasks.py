@@ -1,45 +1,135 @@
-from datetime import timedelta
+import logging
 
-from celery import shared_task
+from celery import group, shared_task
 from django.conf import settings
 from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 
 from apps.companies.models import Sitec
 
-from .services import create_monthly_aggregate, create_snapshot
+from .freshness import dirty_sitec_ids, mark_sitec_clean, mark_sitecs_dirty, release_snapshot_lock
+from .models import DashboardAggregate
+from .rollups import rebuild_rollups
+from .services import create_monthly_aggregate, create_snapshot, create_snapshots, restamp_snapshots
+
+logger = logging.getLogger(__name__)
 
 
 @shared_task
-def refresh_dashboard_snapshots(period_days=None):
-    active_sitecs = Sitec.objects.filter(status="active", company__status="active")
+def refresh_dashboard_snapshots(period_days=None, force=False):
+    """
+    Refresca los snapshots de los sitecs activos. Los sitecs sin escrituras
+    desde su último cálculo (ver freshness.py) solo adelantan el computed_at
+    de sus snapshots; el resto se reparte en a lo sumo
+    DASHBOARD_REFRESH_CONCURRENCY tareas paralelas (group), cada una con
+    todos los períodos de sus sitecs en una pasada.
+    """
+    active_sitecs = list(
+        Sitec.objects.filter(status="active", company__status="active").values_list("id", flat=True)
+    )
     computed_at = timezone.now()
     periods = period_days if isinstance(period_days, list) else None
     if period_days is None:
         periods = getattr(settings, "DASHBOARD_SNAPSHOT_PERIOD_DAYS", [7])
     if isinstance(period_days, int):
         periods = [period_days]
+
+    if force:
+        dirty = active_sitecs
+    else:
+        dirty = set(dirty_sitec_ids(active_sitecs, computed_at.date()))
+        clean = [sitec_id for sitec_id in active_sitecs if sitec_id not in dirty]
+        dirty.update(restamp_snapshots(clean, periods, computed_at))
+        dirty = [sitec_id for sitec_id in active_sitecs if sitec_id in dirty]
+
+    concurrency = max(1, int(getattr(settings, "DASHBOARD_REFRESH_CONCURRENCY", 8)))
+    batches = [[str(sitec_id) for sitec_id in dirty[index::concurrency]] for index in range(concurrency)]
+    batches = [batch for batch in batches if batch]
+    if batches:
+        group(
+            refresh_sitec_snapshots.s(batch, periods, computed_at.isoformat()) for batch in batches
+        ).apply_async()
+    return {
+        "snapshots": len(dirty) * len(periods),
+        "period_days": periods,
+        "sitecs_refreshed": len(dirty),
+        "sitecs_skipped": len(active_sitecs) - len(dirty),
+        "batches": len(batches),
+    }
+
+
+@shared_task
+def refresh_sitec_snapshots(sitec_ids, periods, computed_at):
+    """Recalcula en serie los snapshots de un lote de sitecs."""
+    computed_at = parse_datetime(computed_at)
     count = 0
-    for sitec in active_sitecs:
-        for period in periods:
-            create_snapshot(sitec.company, sitec, period_days=period, computed_at=computed_at)
-            count += 1
-    return {"snapshots": count, "period_days": periods}
+    for sitec in Sitec.objects.filter(id__in=sitec_ids).select_related("company"):
+        # La marca va antes de leer: una escritura posterior la borra
+        mark_sitec_clean(sitec.id, timezone.now().date())
+        try:
+            create_snapshots(sitec.company, sitec, periods, computed_at=computed_at)
+        except Exception:
+            logger.exception("Error refrescando snapshots del sitec %s", sitec.id)
+            mark_sitecs_dirty([sitec.id])
+            continue
+        count += len(periods)
+    return {"snapshots": count}
 
 
 @shared_task
-def refresh_dashboard_aggregates(months=None):
-    active_sitecs = Sitec.objects.filter(status="active", company__status="active")
+def revalidate_dashboard_snapshot(company_id, sitec_id, period_days, lock_token):
+    """Recalcula un snapshot vencido servido por DashboardKpiView y libera su lock."""
+    try:
+        sitec = Sitec.objects.select_related("company").filter(id=sitec_id, company_id=company_id).first()
+        if sitec is not None:
+            create_snapshot(sitec.company, sitec, period_days=period_days)
+    finally:
+        release_snapshot_lock(company_id, sitec_id, period_days, lock_token)
+
+
+@shared_task
+def rebuild_sitec_rollups(company_id, sitec_id):
+    """Reconstruye los rollups de un sitec (borrado o cambio de sitec de un proyecto)."""
+    return {"rows": rebuild_rollups(company=company_id, sitec=sitec_id)}
+
+
+@shared_task
+def refresh_dashboard_aggregates(months=None, force=False):
+    """
+    Recalcula el mes en curso de cada sitec activo. Los meses cerrados se
+    calculan hasta quedar finales (is_final) y después solo cuando una
+    escritura tardía los reabre (ver freshness.py); `force` recalcula todos.
+    """
+    active_sitecs = list(Sitec.objects.filter(status="active", company__status="active").select_related("company"))
     total = 0
+    skipped = 0
     months_back = months or int(getattr(settings, "DASHBOARD_AGGREGATE_MONTHS", 12))
     today = timezone.now().date()
+    current = today.replace(day=1)
+    anchors = []
+    for offset in range(months_back):
+        year = today.year
+        month = today.month - offset
+        while month <= 0:
+            month += 12
+            year -= 1
+        anchors.append(today.replace(year=year, month=month, day=1))
+
+    final = set()
+    if not force:
+        final = set(
+            DashboardAggregate.objects.filter(
+                sitec__in=active_sitecs,
+                period_label="month",
+                period_start__gte=anchors[-1],
+                is_final=True,
+            ).values_list("sitec_id", "period_start")
+        )
     for sitec in active_sitecs:
-        for offset in range(months_back):
-            year = today.year
-            month = today.month - offset
-            while month <= 0:
-                month += 12
-                year -= 1
-            anchor = today.replace(year=year, month=month, day=1)
-            create_monthly_aggregate(sitec.company, sitec, anchor_date=anchor)
+        for anchor in anchors:
+            if (sitec.id, anchor) in final:
+                skipped += 1
+                continue
+            create_monthly_aggregate(sitec.company, sitec, anchor_date=anchor, final=anchor < current)
             total += 1
-    return {"aggregates": total, "months": months_back}
+    return {"aggregates": total, "months": months_back, "skipped": skipped}
@@ -2,16 +2,24 @@
 Tests para filtros avanzados del dashboard
 """
 from datetime import date, timedelta
+from unittest.mock import patch
 
 from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.test import override_settings
 from django.utils import timezone
 from rest_framework.test import APITestCase
 
 from apps.companies.models import Company, Sitec
-from apps.projects.models import Proyecto
+from apps.projects.models import Proyecto, Riesgo
 from apps.reports.models import ReporteSemanal
 
 from apps.accounts.models import UserProfile
+from apps.dashboard.models import DailyMetricRollup, DashboardAggregate, DashboardSnapshot
+from apps.dashboard.rollups import rebuild_rollups
+from apps.dashboard.freshness import acquire_snapshot_lock, release_snapshot_lock
+from apps.dashboard.services import build_dashboard_payload, build_dashboard_payloads
+from apps.dashboard.tasks import refresh_dashboard_aggregates, refresh_dashboard_snapshots
 
 User = get_user_model()
 
@@ -185,3 +193,254 @@ class DashboardFiltersTests(APITestCase):
         # Con filtros, debe indicar que se calcularon en tiempo real
         self.assertEqual(data["snapshot"]["source"], "live")
         self.assertTrue(data["snapshot"].get("filters_applied", False))
+
+    @override_settings(DASHBOARD_ROLLUPS_ENABLED=False)
+    def test_dashboard_payload_uses_one_query_per_table(self):
+        """Test que los KPIs se calculan con una consulta agregada por tabla"""
+        with self.assertNumQueries(3):
+            payload = build_dashboard_payload(self.company, self.sitec, period_days=7)
+        self.assertEqual(payload["projects_total"], 2)
+        self.assertEqual(payload["reports_last_7d"], 2)
+        self.assertEqual(payload["reports_submitted_last_7d"], 2)
+        self.assertEqual(payload["projects_created_last_period"], 0)
+
+    def test_dashboard_payload_from_rollups_uses_one_query(self):
+        """Test que con rollups los KPIs salen de una sola consulta"""
+        with self.assertNumQueries(1):
+            payload = build_dashboard_payload(self.company, self.sitec, period_days=7)
+        self.assertEqual(payload["projects_total"], 2)
+        self.assertEqual(payload["reports_last_7d"], 2)
+        self.assertEqual(payload["reports_submitted_last_7d"], 2)
+
+    def _rollup_rows(self):
+        # Las filas que quedan en cero tras restar no aportan a los KPIs
+        rows = DailyMetricRollup.objects.filter(sitec=self.sitec).values_list(
+            "project_id", "day", "reports", "reports_submitted", "reports_approved",
+            "reports_pending", "projects_created", "projects_in_progress",
+            "projects_open_due", "risks_high",
+        )
+        return sorted((row for row in rows if any(row[2:])), key=str)
+
+    def test_rollups_follow_saves_and_deletes(self):
+        """Test que los rollups incrementales coinciden con las tablas fuente"""
+        self.project1.status = "in_progress"
+        self.project1.end_date = timezone.localdate() - timedelta(days=1)
+        self.project1.save()
+        self.report1.status = "approved"
+        self.report1.save()
+        risk = Riesgo.objects.create(
+            project=self.project2, title="Riesgo", description="Detalle", severity="critical"
+        )
+        ReporteSemanal.objects.create(
+            company=self.company,
+            sitec=self.sitec,
+            project=self.project1,
+            week_start=timezone.localdate() - timedelta(days=40),
+            status="draft",
+        )
+        self.report2.delete()
+        risk.severity = "low"
+        risk.save()
+
+        with override_settings(DASHBOARD_ROLLUPS_ENABLED=False):
+            expected = build_dashboard_payload(self.company, self.sitec, period_days=7)
+        self.assertEqual(build_dashboard_payload(self.company, self.sitec, period_days=7), expected)
+        self.assertEqual(expected["projects_in_progress"], 1)
+        self.assertEqual(expected["projects_overdue"], 1)
+
+        incremental = self._rollup_rows()
+        rebuild_rollups(company=self.company, sitec=self.sitec)
+        self.assertEqual(self._rollup_rows(), incremental)
+
+    def test_project_delete_rebuilds_rollups(self):
+        """Test que borrar un proyecto reconstruye los rollups del sitec al confirmar"""
+        with self.captureOnCommitCallbacks(execute=True):
+            self.project1.delete()
+        self.assertTrue(
+            DailyMetricRollup.objects.filter(sitec=self.sitec, project__isnull=True, reports=1).exists()
+        )
+        incremental = self._rollup_rows()
+        rebuild_rollups(company=self.company, sitec=self.sitec)
+        self.assertEqual(self._rollup_rows(), incremental)
+
+    def test_dashboard_payloads_match_single_period(self):
+        """Test que el cálculo multi-período coincide con el de un período"""
+        with self.assertNumQueries(1):
+            payloads = build_dashboard_payloads(self.company, self.sitec, [7, 30, 90])
+        for period in (7, 30, 90):
+            self.assertEqual(
+                payloads[period], build_dashboard_payload(self.company, self.sitec, period_days=period)
+            )
+
+    @override_settings(DASHBOARD_SNAPSHOT_PERIOD_DAYS=[7, 30])
+    def test_refresh_snapshots_skips_clean_sitecs(self):
+        """Test que el refresco omite sitecs sin escrituras y recalcula los modificados"""
+        cache.clear()
+        result = refresh_dashboard_snapshots()
+        self.assertEqual(result["sitecs_refreshed"], 1)
+        self.assertEqual(DashboardSnapshot.objects.filter(sitec=self.sitec).count(), 2)
+
+        first = DashboardSnapshot.objects.filter(sitec=self.sitec).order_by("period_days").first()
+        DashboardSnapshot.objects.filter(sitec=self.sitec).update(
+            computed_at=first.computed_at - timedelta(minutes=15)
+        )
+        result = refresh_dashboard_snapshots()
+        self.assertEqual(result["sitecs_skipped"], 1)
+        self.assertEqual(result["sitecs_refreshed"], 0)
+        # Los snapshots vigentes solo adelantan su computed_at
+        self.assertEqual(DashboardSnapshot.objects.filter(sitec=self.sitec).count(), 2)
+        self.assertGreaterEqual(
+            DashboardSnapshot.objects.filter(sitec=self.sitec).order_by("period_days").first().computed_at,
+            first.computed_at,
+        )
+
+        with self.captureOnCommitCallbacks(execute=True):
+            ReporteSemanal.objects.create(
+                company=self.company,
+                sitec=self.sitec,
+                project=self.project1,
+                week_start=timezone.now().date() - timedelta(days=1),
+                status="draft",
+            )
+        DashboardSnapshot.objects.filter(sitec=self.sitec).update(
+            computed_at=first.computed_at - timedelta(minutes=15)
+        )
+        result = refresh_dashboard_snapshots()
+        self.assertEqual(result["sitecs_refreshed"], 1)
+        snapshot = DashboardSnapshot.objects.filter(sitec=self.sitec, period_days=7).latest("computed_at")
+        self.assertEqual(snapshot.payload["reports_last_7d"], 3)
+
+    def test_closed_month_aggregates_are_final_until_late_write(self):
+        """Test que los meses cerrados solo se recalculan tras una escritura tardía"""
+        # Primera corrida crea los meses; la segunda finaliza los cerrados
+        refresh_dashboard_aggregates(months=3)
+        refresh_dashboard_aggregates(months=3)
+        result = refresh_dashboard_aggregates(months=3)
+        self.assertEqual((result["aggregates"], result["skipped"]), (1, 2))
+
+        prev_month = (timezone.now().date().replace(day=1) - timedelta(days=1)).replace(day=1)
+        ReporteSemanal.objects.create(
+            company=self.company,
+            sitec=self.sitec,
+            project=self.project1,
+            week_start=prev_month,
+            status="draft",
+        )
+        self.assertFalse(
+            DashboardAggregate.objects.get(sitec=self.sitec, period_start=prev_month).is_final
+        )
+        result = refresh_dashboard_aggregates(months=3)
+        self.assertEqual((result["aggregates"], result["skipped"]), (2, 1))
+        aggregate = DashboardAggregate.objects.get(sitec=self.sitec, period_start=prev_month)
+        self.assertEqual(
+            aggregate.payload["reports_last_period"],
+            ReporteSemanal.objects.filter(
+                sitec=self.sitec, week_start__year=prev_month.year, week_start__month=prev_month.month
+            ).count(),
+        )
+
+        # Solo campos del mes: los acumulados del año cambiarían con otros meses
+        self.assertNotIn("projects_total", aggregate.payload)
+        self.assertNotIn("reports_year", aggregate.payload["comparatives"])
+        self.assertIn("reports_last_period_pct", aggregate.payload["comparatives"])
+
+        result = refresh_dashboard_aggregates(months=3, force=True)
+        self.assertEqual((result["aggregates"], result["skipped"]), (3, 0))
+
+    def test_aggregate_payload_contract(self):
+        """Test que /aggregates/ expone los campos que muestra el frontend"""
+        months = [timezone.now().date().replace(day=1)]
+        for _ in range(3):
+            months.append((months[-1] - timedelta(days=1)).replace(day=1))
+        project = Proyecto.objects.create(
+            company=self.company,
+            sitec=self.sitec,
+            name="Proyecto vencido",
+            code="P3",
+            site_address="789 Test St",
+            start_date=date(2023, 3, 1),
+            end_date=months[3] + timedelta(days=2),
+            status="in_progress",
+            project_manager=self.user,
+        )
+        refresh_dashboard_aggregates(months=4)
+        refresh_dashboard_aggregates(months=4)
+
+        rows = self.client.get("/api/dashboard/aggregates/?limit=12").json()
+        self.assertEqual(len(rows), 4)
+        for row in rows:
+            for field in ("reports_last_period", "reports_submitted_last_period", "projects_overdue"):
+                self.assertIn(field, row["payload"])
+        overdue = {date.fromisoformat(row["period_start"]): row["payload"]["projects_overdue"] for row in rows}
+        self.assertEqual(overdue, {month: 1 for month in months})
+
+        # Cerrar el proyecto cambia projects_overdue de todos los meses desde su vencimiento
+        project.status = "completed"
+        project.save()
+        self.assertFalse(
+            DashboardAggregate.objects.filter(sitec=self.sitec, is_final=True).exists()
+        )
+        refresh_dashboard_aggregates(months=4)
+        rows = self.client.get("/api/dashboard/aggregates/?limit=12").json()
+        self.assertEqual([row["payload"]["projects_overdue"] for row in rows], [0, 0, 0, 0])
+
+    def test_dashboard_serves_stale_snapshot_and_revalidates(self):
+        """Test que un snapshot vencido se sirve de inmediato y se revalida una vez"""
+        cache.clear()
+        response = self.client.get("/api/dashboard/")
+        self.assertEqual(response.json()["snapshot"]["source"], "live")
+        DashboardSnapshot.objects.filter(sitec=self.sitec).update(
+            computed_at=timezone.now() - timedelta(hours=2)
+        )
+
+        response = self.client.get("/api/dashboard/")
+        self.assertEqual(response.json()["snapshot"]["source"], "stale")
+        # En modo eager la revalidación ya guardó un snapshot vigente
+        response = self.client.get("/api/dashboard/")
+        self.assertEqual(response.json()["snapshot"]["source"], "snapshot")
+        self.assertEqual(DashboardSnapshot.objects.filter(sitec=self.sitec, period_days=7).count(), 2)
+
+    @override_settings(DASHBOARD_SNAPSHOT_LOCK_WAIT_SECONDS=0.2)
+    def test_dashboard_single_flight_lock(self):
+        """Test que sin snapshot y con el lock tomado no se escribe otro snapshot"""
+        cache.clear()
+        token = acquire_snapshot_lock(self.company.id, self.sitec.id, 7)
+        self.assertIsNotNone(token)
+        self.assertIsNone(acquire_snapshot_lock(self.company.id, self.sitec.id, 7))
+        try:
+            response = self.client.get("/api/dashboard/")
+        finally:
+            release_snapshot_lock(self.company.id, self.sitec.id, 7, token)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["snapshot"]["source"], "live")
+        self.assertFalse(DashboardSnapshot.objects.filter(sitec=self.sitec).exists())
+        token = acquire_snapshot_lock(self.company.id, self.sitec.id, 7)
+        self.assertIsNotNone(token)
+        release_snapshot_lock(self.company.id, self.sitec.id, 7, token)
+
+    @override_settings(DASHBOARD_SNAPSHOT_STALE_WHILE_REVALIDATE=False)
+    def test_dashboard_lock_loser_gets_stale_snapshot(self):
+        """Test que un request sin lock sirve el snapshot vencido sin esperar"""
+        cache.clear()
+        self.client.get("/api/dashboard/")
+        DashboardSnapshot.objects.filter(sitec=self.sitec).update(
+            computed_at=timezone.now() - timedelta(hours=2)
+        )
+        token = acquire_snapshot_lock(self.company.id, self.sitec.id, 7)
+        try:
+            with patch("apps.dashboard.views.time.sleep") as sleep:
+                response = self.client.get("/api/dashboard/")
+        finally:
+            release_snapshot_lock(self.company.id, self.sitec.id, 7, token)
+        self.assertEqual(response.json()["snapshot"]["source"], "stale")
+        sleep.assert_not_called()
+
+    def test_release_lock_keeps_new_owner(self):
+        """Test que liberar con un token vencido no suelta el lock de otro dueño"""
+        cache.clear()
+        old_token = acquire_snapshot_lock(self.company.id, self.sitec.id, 7)
+        cache.clear()  # el lock expira
+        new_token = acquire_snapshot_lock(self.company.id, self.sitec.id, 7)
+        release_snapshot_lock(self.company.id, self.sitec.id, 7, old_token)
+        self.assertIsNone(acquire_snapshot_lock(self.company.id, self.sitec.id, 7))
+        release_snapshot_lock(self.company.id, self.sitec.id, 7, new_token)
@@ -1,12 +1,16 @@
+import logging
+import time
 from datetime import timedelta
 
 from django.conf import settings
 from django.core.cache import cache
+from django.utils import timezone
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
 from apps.accounts.permissions import AccessPolicyPermission
+from .freshness import acquire_snapshot_lock, release_snapshot_lock
 from .models import DashboardSnapshot
 from .services import (
     build_dashboard_payload,
@@ -15,6 +19,12 @@ from .services import (
     get_recent_aggregates,
     get_recent_snapshot,
 )
+from .tasks import revalidate_dashboard_snapshot
+
+logger = logging.getLogger(__name__)
+
+# Primera espera del request sin lock; se duplica en cada intento
+SNAPSHOT_POLL_SECONDS = 0.05
 
 
 class DashboardKpiView(APIView):
@@ -42,16 +52,93 @@ class DashboardKpiView(APIView):
         # Si hay filtros personalizados, no usar snapshot
         has_custom_filters = project_id or start_date_str or end_date_str or period_days != 7
         
+        if use_snapshot and not has_custom_filters:
+            payload = self._snapshot_payload(company, sitec, period_days)
+            if payload is not None:
+                return Response(payload)
+
+        lock_token = None
+        if not has_custom_filters:
+            # Single-flight: solo un request calcula el snapshot de la llave
+            lock_token = acquire_snapshot_lock(company.id, sitec.id, period_days)
+            if lock_token is None:
+                payload = self._wait_for_snapshot(company, sitec, period_days)
+                if payload is not None:
+                    return Response(payload)
+        try:
+            payload = self._live_payload(company, sitec, period_days, project_id, start_date_str, end_date_str)
+            if lock_token is not None:
+                snapshot = create_snapshot(company, sitec, period_days=period_days, payload=payload)
+                payload["snapshot"] = {"computed_at": snapshot.computed_at, "source": "live"}
+        finally:
+            if lock_token is not None:
+                release_snapshot_lock(company.id, sitec.id, period_days, lock_token)
+        if has_custom_filters:
+            payload["snapshot"] = {"source": "live", "filters_applied": True}
+        elif lock_token is None:
+            payload["snapshot"] = {"source": "live"}
+        return Response(payload)
+
+    def _snapshot_payload(self, company, sitec, period_days):
+        """
+        Payload del último snapshot vigente. Con stale-while-revalidate, un
+        snapshot vencido (hasta DASHBOARD_SNAPSHOT_STALE_MAX_MINUTES) se sirve
+        de inmediato y se encola una sola revalidación. None = calcular.
+        """
         ttl_minutes = int(getattr(settings, "DASHBOARD_SNAPSHOT_TTL_MINUTES", 15))
-        snapshot = get_recent_snapshot(company, sitec, ttl_minutes=ttl_minutes) if use_snapshot and not has_custom_filters else None
-        if snapshot:
-            payload = snapshot.payload or {}
-            payload["snapshot"] = {
-                "computed_at": snapshot.computed_at,
-                "source": "snapshot",
-            }
-            return Response(payload)
+        max_age = ttl_minutes
+        if getattr(settings, "DASHBOARD_SNAPSHOT_STALE_WHILE_REVALIDATE", True):
+            max_age = max(ttl_minutes, int(getattr(settings, "DASHBOARD_SNAPSHOT_STALE_MAX_MINUTES", 1440)))
+        snapshot = get_recent_snapshot(company, sitec, ttl_minutes=max_age, period_days=period_days)
+        if snapshot is None:
+            return None
+        if snapshot.computed_at >= timezone.now() - timedelta(minutes=ttl_minutes):
+            return self._with_snapshot_meta(snapshot, "snapshot")
+
+        lock_token = acquire_snapshot_lock(company.id, sitec.id, period_days)
+        if lock_token is not None:
+            try:
+                revalidate_dashboard_snapshot.delay(str(company.id), str(sitec.id), period_days, lock_token)
+            except Exception:
+                logger.warning("No se pudo encolar la revalidación del dashboard", exc_info=True)
+                release_snapshot_lock(company.id, sitec.id, period_days, lock_token)
+        return self._with_snapshot_meta(snapshot, "stale")
 
+    def _wait_for_snapshot(self, company, sitec, period_days):
+        """
+        Request que no obtuvo el lock: sirve el último snapshot aunque esté
+        vencido; si no hay ninguno, espera al dueño con backoff hasta
+        DASHBOARD_SNAPSHOT_LOCK_WAIT_SECONDS (None si no llega a tiempo).
+        """
+        ttl_minutes = int(getattr(settings, "DASHBOARD_SNAPSHOT_TTL_MINUTES", 15))
+        stale_minutes = max(ttl_minutes, int(getattr(settings, "DASHBOARD_SNAPSHOT_STALE_MAX_MINUTES", 1440)))
+        snapshot = get_recent_snapshot(company, sitec, ttl_minutes=stale_minutes, period_days=period_days)
+        if snapshot is not None:
+            fresh = snapshot.computed_at >= timezone.now() - timedelta(minutes=ttl_minutes)
+            return self._with_snapshot_meta(snapshot, "snapshot" if fresh else "stale")
+
+        deadline = time.monotonic() + float(getattr(settings, "DASHBOARD_SNAPSHOT_LOCK_WAIT_SECONDS", 1))
+        delay = SNAPSHOT_POLL_SECONDS
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            time.sleep(min(delay, remaining))
+            delay *= 2
+            snapshot = get_recent_snapshot(company, sitec, ttl_minutes=ttl_minutes, period_days=period_days)
+            if snapshot is not None:
+                return self._with_snapshot_meta(snapshot, "snapshot")
+
+    @staticmethod
+    def _with_snapshot_meta(snapshot, source):
+        payload = snapshot.payload or {}
+        payload["snapshot"] = {
+            "computed_at": snapshot.computed_at,
+            "source": source,
+        }
+        return payload
+
+    def _live_payload(self, company, sitec, period_days, project_id, start_date_str, end_date_str):
         # Construir payload con filtros opcionales
         if start_date_str and end_date_str:
             from datetime import datetime
@@ -73,13 +160,7 @@ class DashboardKpiView(APIView):
         else:
             from .services import build_dashboard_payload
             payload = build_dashboard_payload(company, sitec, period_days=period_days, project_id=project_id)
-        
-        if not has_custom_filters:
-            snapshot = create_snapshot(company, sitec, period_days=period_days)
-            payload["snapshot"] = {"computed_at": snapshot.computed_at, "source": "live"}
-        else:
-            payload["snapshot"] = {"source": "live", "filters_applied": True}
-        return Response(payload)
+        return payload
 
 
 class DashboardSnapshotHistoryView(APIView):
@@ -13,7 +13,7 @@ from django.db.models import Q
 
 from apps.accounts.mixins import CompanySitecQuerysetMixin
 from apps.accounts.permissions import AccessPolicyPermission
-from apps.accounts.models import UserProfile
+from apps.accounts.identity import get_request_profile
 from apps.audit.services import log_audit_event
 from apps.reports.models import ReporteSemanal
 
@@ -25,7 +25,7 @@ from .tasks import generate_report_document
 def _can_access_document(request, document):
     if document.company_id != request.company.id or document.sitec_id != request.sitec.id:
         return False
-    profile = UserProfile.objects.select_related("company").filter(user=request.user).first()
+    profile = get_request_profile(request)
     if profile and profile.role == "admin_empresa":
         return True
     report = document.report
@@ -52,7 +52,7 @@ class DocumentViewSet(CompanySitecQuerysetMixin, viewsets.ReadOnlyModelViewSet):
 
     def get_queryset(self):
         queryset = super().get_queryset()
-        profile = UserProfile.objects.select_related("company").filter(user=self.request.user).first()
+        profile = get_request_profile(self.request)
         if not profile or profile.role != "admin_empresa":
             queryset = queryset.filter(
                 Q(report__technician=self.request.user)
@@ -13,7 +13,8 @@ from rest_framework.views import APIView
 
 from apps.audit.services import log_audit_event
 from apps.accounts.permissions import AccessPolicyPermission
-from apps.accounts.models import AccessPolicy, UserProfile
+from apps.accounts.identity import get_request_profile
+from apps.accounts.models import AccessPolicy
 from apps.accounts.services import build_context, matches_conditions
 
 from .models import WizardDraft, WizardStepData
@@ -92,7 +93,7 @@ class WizardValidateView(APIView):
 
         critical = []
         warnings = []
-        profile = UserProfile.objects.filter(user=request.user).first()
+        profile = get_request_profile(request)
         role = profile.role if profile else None
         policy_required = self._get_policy_signature_requirements(request, profile, data)
         signature_requirements = set(policy_required)
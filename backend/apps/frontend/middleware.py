@@ -3,14 +3,43 @@ Middleware para agregar contexto de usuario a las requests.
 Proporciona información del usuario, permisos y configuración de UI
 para uso en templates y vistas.
 """
-from apps.accounts.models import UserProfile
+from django.utils.functional import SimpleLazyObject
+
+from apps.accounts.identity import get_request_profile
+from apps.accounts.request_timing import timing_phase
 from apps.accounts.services import get_ui_config_for_role, get_user_permissions
 
 
+def build_user_context(request, profile):
+    """Construye el user_context (perfil, permisos y configuración de UI)."""
+    with timing_phase(request, "context"):
+        # Obtener permisos del usuario
+        permissions = get_user_permissions(request)
+
+        # Obtener configuración de UI según rol
+        ui_config = get_ui_config_for_role(profile.role)
+
+    return {
+        "profile": {
+            "role": profile.role,
+            "department": profile.department,
+            "location": profile.location,
+            "company": {
+                "id": str(profile.company.id) if profile.company else None,
+                "name": profile.company.name if profile.company else None,
+            } if profile.company else None,
+        },
+        "permissions": permissions,
+        "ui_config": ui_config,
+    }
+
+
 class UserContextMiddleware:
     """
     Middleware que agrega user_context a request para usuarios autenticados.
     El contexto incluye información del perfil, permisos y configuración de UI.
+    Es un objeto diferido: las llamadas JSON, el service worker y los beacons
+    de analytics que no lo leen no pagan el cálculo de permisos.
     """
 
     def __init__(self, get_response):
@@ -20,37 +49,22 @@ class UserContextMiddleware:
         # Agregar contexto de usuario si está autenticado
         # Nota: algunos tests/escenarios pueden inyectar un User() no guardado;
         # en ese caso, tratamos como no autenticado para evitar queries inválidas.
-        if (
-            hasattr(request, "user")
-            and getattr(request.user, "is_authenticated", False)
-            and getattr(request.user, "pk", None)
-        ):
-            try:
-                profile = UserProfile.objects.select_related("company", "user").get(
-                    user=request.user
+        # Es el primer acceso a request.user (diferido): aquí se paga sesión, usuario y OTP
+        with timing_phase(request, "auth"):
+            authenticated = (
+                hasattr(request, "user")
+                and getattr(request.user, "is_authenticated", False)
+                and getattr(request.user, "pk", None)
+            )
+        if authenticated:
+            profile = get_request_profile(request)
+            if profile is not None:
+                # Contexto diferido: permisos y UI solo se calculan si un
+                # template o vista lo lee; se memoriza para el resto del request
+                request.user_context = SimpleLazyObject(
+                    lambda: build_user_context(request, profile)
                 )
-                
-                # Obtener permisos del usuario
-                permissions = get_user_permissions(request)
-                
-                # Obtener configuración de UI según rol
-                ui_config = get_ui_config_for_role(profile.role)
-                
-                # Agregar contexto a request
-                request.user_context = {
-                    "profile": {
-                        "role": profile.role,
-                        "department": profile.department,
-                        "location": profile.location,
-                        "company": {
-                            "id": str(profile.company.id) if profile.company else None,
-                            "name": profile.company.name if profile.company else None,
-                        } if profile.company else None,
-                    },
-                    "permissions": permissions,
-                    "ui_config": ui_config,
-                }
-            except UserProfile.DoesNotExist:
+            else:
                 # Usuario sin perfil - contexto vacío
                 request.user_context = None
         else:
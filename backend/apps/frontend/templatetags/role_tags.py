@@ -3,6 +3,8 @@ Template tags para controlar la visibilidad de elementos según el rol del usuar
 """
 from django import template
 
+from apps.accounts.services import evaluate_access_policies
+
 register = template.Library()
 
 
@@ -53,6 +55,8 @@ def dashboard_section_visible(context, section_name):
 def has_permission(context, permission_name):
     """
     Retorna True si el usuario tiene el permiso especificado.
+    Los permisos fuera del mapa precalculado se evalúan con el evaluador por
+    lotes y se memorizan en user_context para el resto del render.
     
     Uso:
         {% has_permission "projects.create" as can_create %}
@@ -64,7 +68,15 @@ def has_permission(context, permission_name):
     if not user_context:
         return False
     
-    permissions = user_context.get("permissions", {})
+    permissions = user_context.get("permissions")
+    if permissions is None:
+        return False
+    if permission_name not in permissions:
+        request = context.get("request")
+        if request is None:
+            return False
+        decisions = evaluate_access_policies(request, [permission_name])
+        permissions[permission_name] = decisions[permission_name].allowed
     return permissions.get(permission_name, False)
 
 
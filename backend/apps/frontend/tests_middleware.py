@@ -2,6 +2,8 @@
 Tests para el middleware de contexto de usuario.
 Valida que el middleware agrega correctamente el contexto a las requests.
 """
+from unittest.mock import patch
+
 from django.contrib.auth import get_user_model
 from django.contrib.auth.models import AnonymousUser
 from django.test import RequestFactory, TestCase
@@ -100,3 +102,18 @@ class UserContextMiddlewareTests(TestCase):
         permissions = request.user_context["permissions"]
         self.assertIsInstance(permissions, dict)
         self.assertIn("dashboard.view", permissions)
+
+    def test_middleware_context_is_lazy(self):
+        """El contexto solo se calcula al leerlo y se memoriza."""
+        middleware = UserContextMiddleware(self.get_response)
+        request = self.factory.get("/api/wizard/analytics/")
+        request.user = self.user
+
+        with patch("apps.frontend.middleware.get_user_permissions") as mocked:
+            mocked.return_value = {"dashboard.view": True}
+            middleware(request)
+            mocked.assert_not_called()
+
+            self.assertEqual(request.user_context["profile"]["role"], "pm")
+            self.assertTrue(request.user_context["permissions"]["dashboard.view"])
+            mocked.assert_called_once()
@@ -103,6 +103,11 @@ CELERY_BEAT_SCHEDULE = {
         "schedule": 86400.0,
         "args": (None,),
     },
+    "audit_partitions_daily": {
+        "task": "apps.audit.tasks.maintain_audit_partitions",
+        "schedule": 86400.0,
+        "args": (None,),
+    },
 }
 
 if "test" in sys.argv:
@@ -119,6 +124,8 @@ if WHITENOISE_AVAILABLE:
     MIDDLEWARE.append("whitenoise.middleware.WhiteNoiseMiddleware")  # WhiteNoise para archivos estáticos (producción)
 
 MIDDLEWARE.extend([
+    "apps.accounts.middleware_server_timing.ServerTimingMiddleware",  # Server-Timing por fases y X-Response-Time-ms
+    "apps.accounts.middleware_query_budget.QueryBudgetMiddleware",  # Conteo de queries SQL por request
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
     "django.middleware.csrf.CsrfViewMiddleware",
@@ -128,6 +135,7 @@ MIDDLEWARE.extend([
     "apps.frontend.middleware.UserContextMiddleware",  # Contexto de usuario para frontend
     "apps.accounts.middleware.CompanySitecMiddleware",
     "apps.accounts.middleware_security.SecurityHeadersMiddleware",  # Security headers (CSP, etc.)
+    "apps.accounts.middleware_profiling.ProfilingMiddleware",  # Perfiles cProfile bajo demanda / muestreo de lentos
     "apps.audit.middleware.RequestMetricsMiddleware",
     "apps.accounts.middleware_observability.ObservabilityMiddleware",  # Métricas de observabilidad
     "django.contrib.messages.middleware.MessageMiddleware",
@@ -275,10 +283,25 @@ NOM151_SEND_PDF = os.getenv("NOM151_SEND_PDF", "false").lower() == "true"
 
 # Dashboard snapshots
 DASHBOARD_SNAPSHOT_TTL_MINUTES = int(os.getenv("DASHBOARD_SNAPSHOT_TTL_MINUTES", "15"))
+# DASHBOARD_SNAPSHOT_STALE_WHILE_REVALIDATE: servir el snapshot vencido y revalidarlo en segundo plano (default: True)
+DASHBOARD_SNAPSHOT_STALE_WHILE_REVALIDATE = (
+    os.getenv("DASHBOARD_SNAPSHOT_STALE_WHILE_REVALIDATE", "true").lower() == "true"
+)
+# DASHBOARD_SNAPSHOT_STALE_MAX_MINUTES: antigüedad máxima de un snapshot vencido que aún se sirve (default: 1440)
+DASHBOARD_SNAPSHOT_STALE_MAX_MINUTES = int(os.getenv("DASHBOARD_SNAPSHOT_STALE_MAX_MINUTES", "1440"))
+# DASHBOARD_SNAPSHOT_LOCK_SECONDS / _WAIT_SECONDS: expiración del lock single-flight y espera de los demás requests
+DASHBOARD_SNAPSHOT_LOCK_SECONDS = int(os.getenv("DASHBOARD_SNAPSHOT_LOCK_SECONDS", "60"))
+DASHBOARD_SNAPSHOT_LOCK_WAIT_SECONDS = float(os.getenv("DASHBOARD_SNAPSHOT_LOCK_WAIT_SECONDS", "1"))
 DASHBOARD_SNAPSHOT_PERIOD_DAYS = [
     int(value) for value in os.getenv("DASHBOARD_SNAPSHOT_PERIOD_DAYS", "7,30,90,180").split(",")
 ]
 DASHBOARD_AGGREGATE_MONTHS = int(os.getenv("DASHBOARD_AGGREGATE_MONTHS", "12"))
+# DASHBOARD_REFRESH_CONCURRENCY: máximo de tareas paralelas al refrescar snapshots (default: 8)
+DASHBOARD_REFRESH_CONCURRENCY = int(os.getenv("DASHBOARD_REFRESH_CONCURRENCY", "8"))
+# DASHBOARD_SNAPSHOT_MAX_SKIP_MINUTES: tiempo máximo que un sitec sin cambios omite el recálculo (default: 360)
+DASHBOARD_SNAPSHOT_MAX_SKIP_MINUTES = int(os.getenv("DASHBOARD_SNAPSHOT_MAX_SKIP_MINUTES", "360"))
+# DASHBOARD_ROLLUPS_ENABLED: KPIs desde DailyMetricRollup en lugar de las tablas fuente (default: True)
+DASHBOARD_ROLLUPS_ENABLED = os.getenv("DASHBOARD_ROLLUPS_ENABLED", "true").lower() == "true"
 
 # ROI snapshots
 ROI_SNAPSHOT_PERIOD_DAYS = [
@@ -290,6 +313,76 @@ OBS_SLOW_REQUEST_MS = int(os.getenv("OBS_SLOW_REQUEST_MS", "800"))
 # OBSERVABILITY_ENABLED: Habilita métricas de observabilidad (default: True)
 # El middleware recopila: timing de requests, conteo de requests, errores por endpoint
 OBSERVABILITY_ENABLED = os.getenv("OBSERVABILITY_ENABLED", "true").lower() == "true"
+# OBSERVABILITY_RETENTION_HOURS: Horas de histogramas de latencia conservadas (máximo de ?hours=) (default: 24)
+OBSERVABILITY_RETENTION_HOURS = int(os.getenv("OBSERVABILITY_RETENTION_HOURS", "24"))
+# OBSERVABILITY_FLUSH_SECONDS: Intervalo de volcado de métricas en memoria al cache compartido (default: 5)
+OBSERVABILITY_FLUSH_SECONDS = float(os.getenv("OBSERVABILITY_FLUSH_SECONDS", "5"))
+# SERVER_TIMING_ENABLED: Emite el header Server-Timing con fases del request, solo en DEBUG o para staff/INTERNAL_IPS (default: False)
+SERVER_TIMING_ENABLED = os.getenv("SERVER_TIMING_ENABLED", "false").lower() == "true"
+# DB_QUERY_INSTRUMENTATION_ENABLED: Cuenta queries SQL por request (headers X-DB-Queries, Server-Timing) (default: True)
+# DB_QUERY_BUDGET: Máximo de queries por request antes de emitir warning (default: 10)
+# DB_QUERY_BUDGETS: Presupuesto por ruta, p. ej. {"dashboard-kpi": 25, "POST:wizard-sync": 20}
+DB_QUERY_INSTRUMENTATION_ENABLED = os.getenv("DB_QUERY_INSTRUMENTATION_ENABLED", "true").lower() == "true"
+DB_QUERY_BUDGET = int(os.getenv("DB_QUERY_BUDGET", "10"))
+DB_QUERY_BUDGETS = {}
+# PROFILING_ENABLED: Permite perfilar requests con cProfile (default: True)
+# PROFILING_TOKEN: Valor del header X-Profile-Token para pedir perfiles sin ser superusuario (vacío = deshabilitado)
+# PROFILING_SAMPLE_RATE: Fracción de requests perfilados; se guardan solo si superan OBS_SLOW_REQUEST_MS (default: 0)
+# PROFILING_MAX_FILES: Máximo de perfiles conservados en PROFILING_DIR (default: 50)
+PROFILING_ENABLED = os.getenv("PROFILING_ENABLED", "true").lower() == "true"
+PROFILING_TOKEN = os.getenv("PROFILING_TOKEN", "")
+PROFILING_SAMPLE_RATE = float(os.getenv("PROFILING_SAMPLE_RATE", "0"))
+PROFILING_MAX_FILES = int(os.getenv("PROFILING_MAX_FILES", "50"))
+PROFILING_DIR = BASE_DIR / "storage" / "profiles"
+# METRICS_SCRAPE_TOKEN: Token Bearer para /api/metrics/prometheus/ sin sesión (vacío = solo usuarios autenticados)
+METRICS_SCRAPE_TOKEN = os.getenv("METRICS_SCRAPE_TOKEN", "")
+
+# Auditoría - escritura en lotes
+# AUDIT_WRITE_MODE: "sync" (create por evento), "buffered" (bulk_create al terminar el
+#   request o por temporizador) o "celery" (lote entregado a una tarea); en estos dos
+#   modos el evento se encola al confirmarse la transacción del cambio (default: buffered)
+# AUDIT_BATCH_SIZE: Eventos por bulk_create; al llenarse se vuelca de inmediato (default: 500)
+# AUDIT_FLUSH_SECONDS: Intervalo del volcado en segundo plano (default: 2)
+# AUDIT_SPOOL_FSYNC: fsync por evento en el spool local (más durable, más lento) (default: False)
+# AUDIT_STRICT_ACTIONS: Acciones que siempre se escriben de forma síncrona, dentro de
+#   la transacción del cambio (única lista; no hay otra por defecto en el código)
+AUDIT_WRITE_MODE = os.getenv("AUDIT_WRITE_MODE", "buffered")
+AUDIT_BATCH_SIZE = int(os.getenv("AUDIT_BATCH_SIZE", "500"))
+AUDIT_FLUSH_SECONDS = float(os.getenv("AUDIT_FLUSH_SECONDS", "2"))
+AUDIT_SPOOL_FSYNC = os.getenv("AUDIT_SPOOL_FSYNC", "false").lower() == "true"
+AUDIT_SPOOL_DIR = BASE_DIR / "storage" / "audit_spool"
+AUDIT_STRICT_ACTIONS = [
+    "policy_created",
+    "policy_updated",
+    "reauthentication_failed",
+    "reauthentication_success",
+    "reporte_approved",
+    "reporte_rejected",
+    "user_profile_updated",
+]
+# AUDIT_DIFF_ENABLED: Guarda solo los campos modificados en before/after (default: True)
+# AUDIT_CHECKPOINT_EVERY: Cada cuántos eventos por entidad se guarda el snapshot completo (default: 20)
+AUDIT_DIFF_ENABLED = os.getenv("AUDIT_DIFF_ENABLED", "true").lower() == "true"
+AUDIT_CHECKPOINT_EVERY = int(os.getenv("AUDIT_CHECKPOINT_EVERY", "20"))
+# AUDIT_ARCHIVE_ENABLED: La tarea diaria archiva y BORRA de la base los meses fuera de
+#   la ventana caliente; AUDIT_ARCHIVE_DIR debe ser almacenamiento persistente (default: False)
+# AUDIT_HOT_MONTHS: Meses (incluido el actual) que se conservan en la base; los
+#   anteriores se archivan en AUDIT_ARCHIVE_DIR como JSONL comprimido (default: 6)
+# AUDIT_PARTITION_MONTHS_AHEAD: Particiones mensuales creadas por adelantado en PostgreSQL (default: 2)
+AUDIT_ARCHIVE_ENABLED = os.getenv("AUDIT_ARCHIVE_ENABLED", "false").lower() == "true"
+AUDIT_HOT_MONTHS = int(os.getenv("AUDIT_HOT_MONTHS", "6"))
+AUDIT_PARTITION_MONTHS_AHEAD = int(os.getenv("AUDIT_PARTITION_MONTHS_AHEAD", "2"))
+AUDIT_ARCHIVE_DIR = Path(os.getenv("AUDIT_ARCHIVE_DIR", str(BASE_DIR / "storage" / "audit_archive")))
+if "test" in sys.argv:
+    # Los tests leen AuditLog inmediatamente después de cada acción
+    AUDIT_WRITE_MODE = "sync"
+
+# ABAC - cache compartido de decisiones
+# ABAC_DECISION_CACHE_ENABLED: Comparte decisiones entre workers vía cache (default: True)
+# ABAC_DECISION_CACHE_TTL: Segundos que vive una decisión; la versión de políticas
+#   invalida antes cualquier decisión obsoleta (default: 3600)
+ABAC_DECISION_CACHE_ENABLED = os.getenv("ABAC_DECISION_CACHE_ENABLED", "true").lower() == "true"
+ABAC_DECISION_CACHE_TTL = int(os.getenv("ABAC_DECISION_CACHE_TTL", "3600"))
 
 # Rate Limiting Avanzado - OPCIONAL
 # El sistema funciona sin rate limiting, pero se recomienda habilitarlo en producción.
@@ -303,6 +396,18 @@ RATE_LIMIT_REQUESTS = int(os.getenv("RATE_LIMIT_REQUESTS", "100"))
 RATE_LIMIT_WINDOW = int(os.getenv("RATE_LIMIT_WINDOW", "60"))
 RATE_LIMIT_USER_REQUESTS = int(os.getenv("RATE_LIMIT_USER_REQUESTS", "200"))
 RATE_LIMIT_USER_WINDOW = int(os.getenv("RATE_LIMIT_USER_WINDOW", "60"))
+# RATE_LIMIT_SUB_WINDOWS: Sub-ventanas (buckets) por ventana del contador deslizante (default: 10)
+RATE_LIMIT_SUB_WINDOWS = int(os.getenv("RATE_LIMIT_SUB_WINDOWS", "10"))
+# RATE_LIMIT_MEMORY_MAX_KEYS: Máximo de contadores en memoria (fallback sin cache, LRU) (default: 1000)
+RATE_LIMIT_MEMORY_MAX_KEYS = int(os.getenv("RATE_LIMIT_MEMORY_MAX_KEYS", "1000"))
+# RATE_LIMIT_LOCAL_BUCKETS: Token bucket local por worker con reconciliación por lotes (default: False)
+# RATE_LIMIT_SYNC_INTERVAL_MS: Máximo tiempo entre reconciliaciones con el cache compartido (default: 250)
+# RATE_LIMIT_SYNC_REQUESTS: Máximo de requests admitidos por worker entre reconciliaciones (default: 20)
+# RATE_LIMIT_OVER_ADMISSION: Exceso tolerado por worker entre reconciliaciones, fracción del límite (default: 0.1)
+RATE_LIMIT_LOCAL_BUCKETS = os.getenv("RATE_LIMIT_LOCAL_BUCKETS", "false").lower() == "true"
+RATE_LIMIT_SYNC_INTERVAL_MS = int(os.getenv("RATE_LIMIT_SYNC_INTERVAL_MS", "250"))
+RATE_LIMIT_SYNC_REQUESTS = int(os.getenv("RATE_LIMIT_SYNC_REQUESTS", "20"))
+RATE_LIMIT_OVER_ADMISSION = float(os.getenv("RATE_LIMIT_OVER_ADMISSION", "0.1"))
 
 # Configuración de rate limiting por endpoint
 # Formato: {"path_pattern": {"method": {"ip": {...}, "user": {...}}}}
@@ -328,6 +433,7 @@ RATE_LIMIT_EXCLUDED_PATHS = [
     "/health/",
     "/health/detailed/",
     "/api/metrics/",
+    "/api/metrics/prometheus/",
 ]
 
 # Security Headers
@@ -360,6 +466,8 @@ AI_TRAIN_VERIFY_SSL = os.getenv("AI_TRAIN_VERIFY_SSL", "true").lower() == "true"
 AI_TRAIN_RETRIES = int(os.getenv("AI_TRAIN_RETRIES", "1"))
 AI_TRAIN_BACKOFF_BASE = float(os.getenv("AI_TRAIN_BACKOFF_BASE", "0.5"))
 AI_TRAIN_SEND_FILE = os.getenv("AI_TRAIN_SEND_FILE", "false").lower() == "true"
+# AI_DATASET_DIR: Carpeta de los datasets JSONL de entrenamiento, uno por company
+AI_DATASET_DIR = Path(os.getenv("AI_DATASET_DIR", str(BASE_DIR / "storage" / "ai" / "datasets")))
 
 # IA Throttling y Costos - OPCIONAL
 # El sistema funciona sin throttling, pero se recomienda habilitarlo en producción.
@@ -7,7 +7,12 @@ from apps.accounts.views import AccessPolicyEvaluateView, AccessPolicyViewSet, M
 from apps.accounts.views_auth import LoginView, LogoutView
 from apps.accounts.views_mfa import MFASetupView, MFAVerifyView, MFADisableView, MFAStatusView
 from apps.accounts.views_health import HealthCheckView, HealthCheckDetailedView
-from apps.accounts.views_metrics import MetricsView
+from apps.accounts.views_metrics import (
+    MetricsView,
+    ProfileDownloadView,
+    ProfileListView,
+    PrometheusMetricsView,
+)
 from apps.audit.views import AuditLogViewSet
 
 
@@ -28,6 +33,9 @@ urlpatterns = [
     path("health/", HealthCheckView.as_view(), name="health"),
     path("health/detailed/", HealthCheckDetailedView.as_view(), name="health-detailed"),
     path("api/metrics/", MetricsView.as_view(), name="metrics"),
+    path("api/metrics/prometheus/", PrometheusMetricsView.as_view(), name="metrics-prometheus"),
+    path("api/metrics/profiles/", ProfileListView.as_view(), name="metrics-profiles"),
+    path("api/metrics/profiles/<str:profile_id>/", ProfileDownloadView.as_view(), name="metrics-profile-download"),
     path("api/users/me/", MeView.as_view(), name="me"),
     path("api/user/context/", UserContextView.as_view(), name="user-context"),
     path("api/policies/evaluate/", AccessPolicyEvaluateView.as_view(), name="policy-evaluate"),